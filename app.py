@@ -1,11 +1,44 @@
 import os
+import json
+import base64
+import datetime
+import hashlib
+import hmac
+import itertools
 import logging
-from flask import Flask, request, jsonify, render_template
+import queue
+import secrets
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, request, jsonify, render_template, stream_with_context
 from google.cloud import storage
 import vertexai
 from vertexai.generative_models import GenerativeModel, Tool, grounding
 from google.cloud import discoveryengine_v1 as discoveryengine
 from google.api_core import exceptions
+import google.auth.transport.requests
+import google.auth.exceptions
+import google.oauth2.id_token
+import requests
+from requests.adapters import HTTPAdapter
+from cache import ResultCache, MemoryStore, DiskStore, GCSStore, fingerprint
+from singleflight import SingleFlight
+import metrics
+import tracing
+from clients import registry
+from events import EventBus
+from background import BackgroundQueue, InFlightCounter
+from catalog import FileCatalog, SharedVersion
+from retrieval import HashingEmbedder, LocalRetriever, VertexEmbedder
+from resilience import (
+    AdaptiveLimiter, CircuitBreaker, CircuitOpen, Hedger, Overloaded, RetryBudget, RetryPolicy
+)
+from jobs import GCSJobStore, JobQueue, MemoryJobStore, SQLiteJobStore, PRIORITIES, FINISHED
+from uploads import (
+    CHUNK_GRANULARITY, UploadSessionError, decode_session_token, encode_session_token,
+    forward_chunk, parse_content_range, query_offset, session_url
+)
 
 # --- Configuration ---
 # Load configuration from environment variables.
@@ -15,9 +48,149 @@ GCP_REGION = os.getenv("GCP_REGION", "europe-west1") # Used for Vertex AI client
 DATA_STORE_LOCATION = os.getenv("DATA_STORE_LOCATION") # Used for Data Store path
 DATA_STORE_ID = os.getenv("DATA_STORE_ID")
 GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
+MODEL_NAME = os.getenv("MODEL_NAME", "gemini-2.5-flash")
+
+# Analysis result cache: memory | disk | gcs | none
+ANALYSIS_CACHE_BACKEND = os.getenv("ANALYSIS_CACHE_BACKEND", "memory").lower()
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", 7 * 24 * 3600))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 1000))
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "/tmp/analysis-cache")
+ANALYSIS_CACHE_BUCKET = os.getenv("ANALYSIS_CACHE_BUCKET", GCS_BUCKET_NAME)
+# Lock directory shared by the gunicorn workers of an instance (only used with a disk or gcs analysis
+# cache); empty disables cross-worker coalescing
+SINGLEFLIGHT_LOCK_DIR = os.getenv("SINGLEFLIGHT_LOCK_DIR", "/tmp/analysis-locks")
+SINGLEFLIGHT_WAIT_TIMEOUT = int(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT", 120))
+# HTTP connection pool size of the shared storage client (should cover gunicorn threads)
+GCS_POOL_SIZE = int(os.getenv("GCS_POOL_SIZE", 16))
+# How long an index status answer is shared between pollers
+STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", 5))
+# Direct-to-GCS uploads via V4 signed resumable-upload URLs (bucket needs a CORS policy for the app origin)
+DIRECT_UPLOADS = os.getenv("DIRECT_UPLOADS", "false").lower() == "true"
+SIGNED_URL_EXPIRATION = int(os.getenv("SIGNED_URL_EXPIRATION", 15 * 60))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 512 * 1024 * 1024))
+# Secret the upload IDs of chunked uploads through the app are signed with; chunked uploads are
+# disabled without it (must be the same on all instances)
+UPLOAD_SESSION_SECRET = os.getenv("UPLOAD_SESSION_SECRET")
+# Recommended chunk size for uploads through the app; must stay below Cloud Run's 32 MiB request limit
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+# Multi-file uploads: files per request, parallel GCS writes per worker, and how long batch records are kept
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 50))
+BATCH_UPLOAD_WORKERS = int(os.getenv("BATCH_UPLOAD_WORKERS", 8))
+BATCH_TTL = int(os.getenv("BATCH_TTL", 7 * 24 * 3600))
+# Content-hash deduplication of uploads: gcs (hash index in the bucket) | memory | none
+DEDUP_INDEX_BACKEND = os.getenv("DEDUP_INDEX_BACKEND", "gcs").lower()
+# Full reload interval of the cached /files catalog; uploads and GCS notifications update it in between
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", 300))
+# How often a worker checks the bucket's catalog version object for changes made by other workers/instances
+CATALOG_VERSION_CHECK_INTERVAL = float(os.getenv("CATALOG_VERSION_CHECK_INTERVAL", 1))
+# Authentication of the bucket notifications pushed to /internal/gcs_events: the OIDC token of the push
+# subscription (audience and service account as configured on it), or else a shared secret passed as
+# ?token=... in the push endpoint URL. Without either the endpoint refuses all events.
+GCS_EVENTS_AUDIENCE = os.getenv("GCS_EVENTS_AUDIENCE")
+GCS_EVENTS_SERVICE_ACCOUNT = os.getenv("GCS_EVENTS_SERVICE_ACCOUNT")
+GCS_EVENTS_TOKEN = os.getenv("GCS_EVENTS_TOKEN")
+# Precompute analyses as soon as the indexer reports a document as INDEXED.
+# Only pays off with a shared analysis cache (ANALYSIS_CACHE_BACKEND=disk or gcs).
+PRECOMPUTE_ANALYSES = os.getenv("PRECOMPUTE_ANALYSES", "false").lower() == "true"
+PRECOMPUTE_WORKERS = int(os.getenv("PRECOMPUTE_WORKERS", 1))
+PRECOMPUTE_MAX_PENDING = int(os.getenv("PRECOMPUTE_MAX_PENDING", 100))
+# Precomputation waits while this many interactive analyses are running in the worker
+PRECOMPUTE_PAUSE_AT = int(os.getenv("PRECOMPUTE_PAUSE_AT", 2))
+# Background analysis jobs (/analyze with "async": true): gcs (objects in GCS_BUCKET_NAME, shared by all
+# instances) | sqlite (shared by the workers of one instance) | memory
+JOB_BACKEND = os.getenv("JOB_BACKEND", "gcs").lower()
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "/tmp/analysis-jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+# Seconds between checks for jobs this worker wasn't woken up for (submitted elsewhere, due retries, expired leases)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 5))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# First retry delay in seconds, doubled per attempt; "not yet indexed" usually clears within minutes
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 60))
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", 24 * 3600))
+# Adaptive (AIMD) concurrency limit for model calls, per worker. Calls beyond the limit wait up to
+# MODEL_QUEUE_TIMEOUT seconds (at most MODEL_MAX_QUEUE of them), then get a 503 with Retry-After.
+MODEL_CONCURRENCY_INITIAL = int(os.getenv("MODEL_CONCURRENCY_INITIAL", 8))
+MODEL_CONCURRENCY_MIN = int(os.getenv("MODEL_CONCURRENCY_MIN", 1))
+MODEL_CONCURRENCY_MAX = int(os.getenv("MODEL_CONCURRENCY_MAX", 64))
+MODEL_QUEUE_TIMEOUT = float(os.getenv("MODEL_QUEUE_TIMEOUT", 2))
+MODEL_MAX_QUEUE = int(os.getenv("MODEL_MAX_QUEUE", 32))
+# Retries of transient upstream errors: capped exponential backoff with full jitter. Each upstream
+# may retry at most RETRY_BUDGET_RATIO of its calls, so retries can't multiply an outage.
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", 3))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", 0.2))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.2))
+# Overall deadlines (seconds, retries included) of a model call and of a storage / data store read
+MODEL_DEADLINE = float(os.getenv("MODEL_DEADLINE", 120))
+READ_DEADLINE = float(os.getenv("READ_DEADLINE", 15))
+# Hedge idempotent reads that take longer than this quantile of their recent latencies
+HEDGE_READS = os.getenv("HEDGE_READS", "true").lower() == "true"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", 0.95))
+# Circuit breakers per upstream (model, datastore, gcs): open when at least CIRCUIT_FAILURE_RATE of
+# the last CIRCUIT_WINDOW seconds' calls (and at least CIRCUIT_MIN_CALLS) failed or were slower than
+# the slow-call threshold, fail fast for CIRCUIT_OPEN_SECONDS, then let one probe call through
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", 0.5))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", 10))
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", 60))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+MODEL_SLOW_CALL_SECONDS = float(os.getenv("MODEL_SLOW_CALL_SECONDS", 90))
+READ_SLOW_CALL_SECONDS = float(os.getenv("READ_SLOW_CALL_SECONDS", 10))
+# Bucket holding the indexer's per-URI import outcomes (.index-status/<document id>.json)
+INDEX_STATUS_BUCKET = os.getenv("INDEX_STATUS_BUCKET")
+# Shared secret the indexer service sends with status reports (header X-Status-Token); without it reports are refused
+STATUS_CALLBACK_TOKEN = os.getenv("STATUS_CALLBACK_TOKEN")
+# Status streams re-check the data store at this interval and end before Cloud Run's request timeout
+STATUS_STREAM_RECHECK = float(os.getenv("STATUS_STREAM_RECHECK", 5))
+STATUS_STREAM_MAX_SECONDS = int(os.getenv("STATUS_STREAM_MAX_SECONDS", 240))
+# Grounding source: vertex (Vertex AI Search data store tool) | local (PDFs indexed on this instance, see retrieval.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "vertex").lower()
+# Local retrieval: index file shared by the workers of an instance, embeddings ("hashing" works
+# offline, or a Vertex AI embedding model such as text-multilingual-embedding-002) and passages per analysis
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "/tmp/local-index/index.sqlite3")
+LOCAL_EMBEDDINGS = os.getenv("LOCAL_EMBEDDINGS", "hashing")
+LOCAL_PASSAGES = int(os.getenv("LOCAL_PASSAGES", 12))
+# Storage of the chunk embeddings: float16 (half the size of float32) | int8 (a quarter, slightly coarser scores)
+LOCAL_VECTOR_DTYPE = os.getenv("LOCAL_VECTOR_DTYPE", "float16").lower()
+# Per-stage request spans: appended as JSON lines to TRACE_EXPORT_FILE and/or sent to an OTLP/HTTP
+# collector (e.g. http://localhost:4318/v1/traces); SERVER_TIMING adds the stage durations as a header
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
 
 # --- App Initialization ---
 app = Flask(__name__)
+tracer = tracing.Tracer("study-companion-app", file_path=TRACE_EXPORT_FILE, otlp_endpoint=TRACE_OTLP_ENDPOINT)
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.monotonic()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    g.trace = tracer.start(
+        f"{request.method} {metrics.route_label(request)}",
+        traceparent=request.headers.get("traceparent"), **{"http.target": request.path}
+    )
+
+@app.after_request
+def _record_request_metrics(response):
+    route = metrics.route_label(request)
+    metrics.REQUESTS.labels(request.method, route, response.status_code).inc()
+    metrics.REQUEST_LATENCY.labels(request.method, route).observe(time.monotonic() - g.request_started)
+    if "trace" in g:
+        root = g.trace[0]
+        root.set(**{"http.status_code": response.status_code})
+        tracer.finish(*g.pop("trace"))
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = tracer.server_timing(root)
+    return response
+
+@app.teardown_request
+def _finish_request_metrics(error=None):
+    # Also runs for failed requests, which skip after_request
+    if "request_started" in g:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+    if "trace" in g:
+        root, token = g.pop("trace")
+        root.error = f"{type(error).__name__}: {error}" if error else None
+        tracer.finish(root, token)
 logging.basicConfig(level=logging.INFO)
 
 # --- Vertex AI Initialization ---
@@ -32,7 +205,13 @@ except Exception as e:
 
 # --- Tool Definition for Data Store ---
 tools = []
-if PROJECT_ID and DATA_STORE_ID and DATA_STORE_LOCATION:
+local_retriever = None
+if RETRIEVAL_BACKEND == "local":
+    # Passages are retrieved here and put into the prompt, so the model gets no tool
+    local_embedder = HashingEmbedder() if LOCAL_EMBEDDINGS == "hashing" else VertexEmbedder(LOCAL_EMBEDDINGS)
+    local_retriever = LocalRetriever(LOCAL_INDEX_PATH, local_embedder, vector_dtype=LOCAL_VECTOR_DTYPE)
+    app.logger.info(f"Local retrieval configured ({LOCAL_INDEX_PATH}, {local_embedder.name} embeddings as {LOCAL_VECTOR_DTYPE}).")
+elif PROJECT_ID and DATA_STORE_ID and DATA_STORE_LOCATION:
     # Check if the user provided the full path or just the ID
     if DATA_STORE_ID.startswith("projects/"):
         datastore_resource_name = DATA_STORE_ID
@@ -55,9 +234,18 @@ if PROJECT_ID and DATA_STORE_ID and DATA_STORE_LOCATION:
 else:
     app.logger.warning("PROJECT_ID, DATA_STORE_ID, or DATA_STORE_LOCATION not found. Vertex AI Search tool not configured.")
 
+def retrieval_configured():
+    """True if analyses can be grounded (data store tool or local retrieval)."""
+    return bool(tools) or local_retriever is not None
+
+def index_status_configured():
+    """True if /check_file_status can answer (data store configured or local retrieval)."""
+    return local_retriever is not None or all([PROJECT_ID, DATA_STORE_LOCATION, DATA_STORE_ID])
+
 # --- System Prompt ---
-SYSTEM_PROMPT = """
-Sie sind ein hochspezialisierter KI-Studienbegleiter. Ihre Aufgabe ist es, die vom Data Store Tool bereitgestellten Informationen zu analysieren und eine strukturierte Markdown-Antwort zu generieren.
+# {source}: where the facts come from, which depends on the retrieval backend
+SYSTEM_PROMPT_TEMPLATE = """
+Sie sind ein hochspezialisierter KI-Studienbegleiter. Ihre Aufgabe ist es, {source} zu analysieren und eine strukturierte Markdown-Antwort zu generieren.
 
 **ABSOLUTE FORMATIERUNGSREGELN:**
 
@@ -85,6 +273,786 @@ Dies ist eine prägnante Zusammenfassung des Inhalts.
 - Der Studierende kann Konzept A definieren.
 - Der Studierende kann Prozess B analysieren.
 """
+SYSTEM_PROMPT = SYSTEM_PROMPT_TEMPLATE.format(source="die vom Data Store Tool bereitgestellten Informationen")
+# Local retrieval: the model has no tool, the passages come with the user prompt
+LOCAL_SYSTEM_PROMPT = SYSTEM_PROMPT_TEMPLATE.format(source="die in der Anfrage mitgelieferten Auszüge aus dem Dokument")
+
+USER_PROMPT_TEMPLATE = "Analysiere den Inhalt der Datei '{file_name}'. Nutze dafür das Data Store Tool. Erstelle die drei geforderten Abschnitte (Zusammenfassung, Thematische Übersicht, Lernziele) basierend auf den abgerufenen Fakten."
+# Local retrieval: the passages are part of the prompt instead of coming from the tool
+LOCAL_PROMPT_TEMPLATE = "Analysiere den Inhalt der Datei '{file_name}' anhand der folgenden Auszüge. Erstelle die drei geforderten Abschnitte (Zusammenfassung, Thematische Übersicht, Lernziele) ausschließlich basierend auf diesen Fakten.\n\n{passages}"
+
+# --- Shared Clients ---
+# Created lazily on first use and reused by all requests of a worker process.
+def _create_storage_client():
+    client = storage.Client(project=PROJECT_ID)
+    adapter = HTTPAdapter(pool_connections=GCS_POOL_SIZE, pool_maxsize=GCS_POOL_SIZE)
+    client._http.mount("https://", adapter)
+    return client
+
+def document_client_options():
+    # KORREKTUR: Expliziter EU-Endpoint für Discovery Engine
+    if not DATA_STORE_LOCATION:
+        return None
+    # Für Europa ist 'eu' der korrekte Präfix für die Discovery Engine API
+    endpoint = "eu-discoveryengine.googleapis.com" if DATA_STORE_LOCATION.lower() in ["eu", "europe-west1"] else f"{DATA_STORE_LOCATION}-discoveryengine.googleapis.com"
+    return {"api_endpoint": endpoint}
+
+def _create_document_client():
+    # gRPC multiplexes all calls over one HTTP/2 channel, so no pool to size here
+    return discoveryengine.DocumentServiceClient(client_options=document_client_options())
+
+def _create_model():
+    # KORREKTUR: Kurzname verwenden (verhindert 404) und Upgrade auf 2.5 Flash
+    return GenerativeModel(
+        model_name=MODEL_NAME,
+        system_instruction=SYSTEM_PROMPT if local_retriever is None else LOCAL_SYSTEM_PROMPT,
+        tools=tools
+    )
+
+registry.register("storage", _create_storage_client)
+registry.register("documents", _create_document_client)
+registry.register("model", _create_model)
+
+# --- Upstream Resilience ---
+def is_transient(error):
+    """Errors worth retrying: server-side failures, timeouts and dropped connections."""
+    return isinstance(error, (
+        exceptions.InternalServerError, exceptions.BadGateway, exceptions.ServiceUnavailable,
+        exceptions.GatewayTimeout, exceptions.DeadlineExceeded,
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError
+    ))
+
+def is_upstream_overload(error):
+    """True for the errors an overloaded Google API answers with (429 / RESOURCE_EXHAUSTED, 503)."""
+    return isinstance(error, (exceptions.ResourceExhausted, exceptions.TooManyRequests, exceptions.ServiceUnavailable))
+
+def _retry_policy(name, deadline, is_retryable=is_transient):
+    return RetryPolicy(
+        name, is_retryable,
+        max_attempts=UPSTREAM_MAX_ATTEMPTS,
+        base_delay=UPSTREAM_RETRY_BASE_DELAY,
+        deadline=deadline,
+        budget=RetryBudget(ratio=RETRY_BUDGET_RATIO)
+    )
+
+# Overload is left to the model limiter (shed, not retried)
+model_retry = _retry_policy("model", MODEL_DEADLINE, lambda e: is_transient(e) and not is_upstream_overload(e))
+storage_retry = _retry_policy("storage", READ_DEADLINE)
+documents_retry = _retry_policy("documents", READ_DEADLINE)
+
+def _hedger(name):
+    return Hedger(name, quantile=HEDGE_QUANTILE, budget=RetryBudget(ratio=RETRY_BUDGET_RATIO)) if HEDGE_READS else None
+
+# One hedger per kind of read, since each has its own latency distribution
+object_metadata_hedger = _hedger("object-metadata")
+document_lookup_hedger = _hedger("document-lookup")
+
+def is_upstream_failure(error):
+    """Errors that say an upstream is unhealthy, unlike e.g. a NotFound answer."""
+    return is_transient(error) or is_upstream_overload(error)
+
+def _breaker(name, slow_call_seconds):
+    return CircuitBreaker(
+        name, is_upstream_failure,
+        failure_rate=CIRCUIT_FAILURE_RATE,
+        min_calls=CIRCUIT_MIN_CALLS,
+        window=CIRCUIT_WINDOW,
+        slow_call_seconds=slow_call_seconds,
+        open_seconds=CIRCUIT_OPEN_SECONDS
+    )
+
+# The grounded model call covers Vertex AI Search retrieval too; "datastore" guards the document lookups
+model_breaker = _breaker("model", MODEL_SLOW_CALL_SECONDS)
+datastore_breaker = _breaker("datastore", READ_SLOW_CALL_SECONDS)
+gcs_breaker = _breaker("gcs", READ_SLOW_CALL_SECONDS)
+circuit_breakers = (model_breaker, datastore_breaker, gcs_breaker)
+
+def idempotent_read(policy, fn, hedger=None, breaker=None):
+    """Runs fn(timeout) with retries and, if given, hedged attempts behind a circuit breaker."""
+    def attempt(timeout):
+        call = (lambda: hedger.call(lambda: fn(timeout))) if hedger is not None else (lambda: fn(timeout))
+        if breaker is None:
+            return call()
+        with breaker.guard():
+            return call()
+
+    # CircuitOpen isn't transient, so an open circuit is never retried
+    return policy.call(attempt)
+
+# --- Analysis Cache ---
+def _cache_lookup_counter(cache):
+    return lambda hit: metrics.CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+def _build_analysis_cache():
+    """Creates the analysis cache for the configured backend, or None if disabled."""
+    if ANALYSIS_CACHE_BACKEND == "none":
+        return None
+    if ANALYSIS_CACHE_BACKEND == "disk":
+        store = DiskStore(ANALYSIS_CACHE_DIR, max_entries=ANALYSIS_CACHE_MAX_ENTRIES)
+    elif ANALYSIS_CACHE_BACKEND == "gcs" and ANALYSIS_CACHE_BUCKET:
+        store = GCSStore(lambda: registry.get("storage").bucket(ANALYSIS_CACHE_BUCKET), max_entries=ANALYSIS_CACHE_MAX_ENTRIES)
+    else:
+        store = MemoryStore(max_entries=ANALYSIS_CACHE_MAX_ENTRIES)
+    app.logger.info(f"Analysis cache enabled ({type(store).__name__}, TTL {ANALYSIS_CACHE_TTL}s).")
+    return ResultCache(store, ttl_seconds=ANALYSIS_CACHE_TTL, on_lookup=_cache_lookup_counter("analysis"))
+
+try:
+    analysis_cache = _build_analysis_cache()
+except Exception as e:
+    app.logger.error(f"Error initializing analysis cache: {e}")
+    analysis_cache = None
+
+if local_retriever is None:
+    PROMPT_HASH = fingerprint(SYSTEM_PROMPT, USER_PROMPT_TEMPLATE)
+else:
+    PROMPT_HASH = fingerprint(LOCAL_SYSTEM_PROMPT, LOCAL_PROMPT_TEMPLATE, local_retriever.embedder.name, LOCAL_PASSAGES)
+
+def document_fingerprint(file_path):
+    """Returns a content fingerprint for a gs:// path, or None if the object can't be resolved."""
+    if not file_path.startswith("gs://"):
+        return None
+    bucket_name, _, blob_name = file_path[len("gs://"):].partition("/")
+    bucket = registry.get("storage").bucket(bucket_name)
+
+    def get_blob(timeout):
+        with metrics.observe_upstream("gcs", "get_blob"):
+            return bucket.get_blob(blob_name, timeout=timeout)
+
+    blob = idempotent_read(storage_retry, get_blob, object_metadata_hedger, gcs_breaker)
+    if blob is None:
+        return None
+    metadata = blob.metadata or {}
+    if metadata.get("alias_of"):
+        # Alias objects are empty; their content is the target's as of the generation they were linked to
+        return metadata.get("sha256") or f"{metadata['alias_of']}#{metadata.get('alias_generation')}"
+    # md5 identifies the content itself; composite objects only carry crc32c
+    return blob.md5_hash or blob.crc32c or f"{blob_name}#{blob.generation}"
+
+def analysis_cache_key(file_path):
+    """Builds the cache key (document content, model, prompts) for an analysis."""
+    if analysis_cache is None:
+        return None
+    try:
+        with tracing.span("cache_key"):
+            doc_fingerprint = document_fingerprint(file_path)
+    except Exception as e:
+        app.logger.warning(f"Could not fingerprint '{file_path}', skipping cache: {e}")
+        return None
+    if doc_fingerprint is None:
+        return None
+    return fingerprint(doc_fingerprint, MODEL_NAME, PROMPT_HASH)
+
+NOT_YET_INDEXED = (
+    "Inhalt noch nicht verfügbar.",
+    "Die Datei wurde gefunden, aber die KI kann die Inhalte noch nicht lesen. Bitte warte ca. 2-3 Minuten, bis die automatische Indizierung abgeschlossen ist."
+)
+
+model_limiter = AdaptiveLimiter(
+    "model",
+    initial_limit=MODEL_CONCURRENCY_INITIAL,
+    min_limit=MODEL_CONCURRENCY_MIN,
+    max_limit=MODEL_CONCURRENCY_MAX,
+    queue_timeout=MODEL_QUEUE_TIMEOUT,
+    max_queue=MODEL_MAX_QUEUE,
+    is_overload=is_upstream_overload
+)
+
+def unavailable_body(e):
+    """Response body for a shed (Overloaded) or short-circuited (CircuitOpen) call."""
+    if isinstance(e, CircuitOpen):
+        error = f"Ein benötigter Dienst ({e.name}) ist vorübergehend nicht erreichbar."
+    else:
+        error = "Der Dienst ist gerade ausgelastet."
+    return {
+        "error": error,
+        "details": f"Bitte versuche es in {e.retry_after} Sekunden erneut.",
+        "retry_after": e.retry_after
+    }
+
+class AnalysisUnavailable(Exception):
+    """Raised when the model returned no usable content for a document."""
+
+    def __init__(self, error, details):
+        super().__init__(details)
+        self.error = error
+        self.details = details
+
+def parse_analysis_response(response):
+    """Validates a model response and turns it into the analysis payload."""
+    # NEU: Sicherheitscheck (verhindert Abstürze bei leeren Antworten)
+    if not response.candidates or not response.candidates[0].content.parts:
+        raise AnalysisUnavailable(
+            "Keine Inhalte generiert.",
+            "Das Modell konnte keine Informationen extrahieren. Eventuell ist die Indizierung noch nicht fertig."
+        )
+    # Prüfung auf "Finish Reason" (oft SAFETY oder OTHER, wenn Grounding fehlschlägt)
+    if response.candidates[0].finish_reason != 1: # 1 = STOP (Erfolg)
+        app.logger.warning(f"Modell beendete mit Grund: {response.candidates[0].finish_reason}")
+
+    full_text = ""
+    if response and response.candidates:
+        full_text = "".join(part.text for part in response.candidates[0].content.parts if hasattr(part, "text"))
+
+    # Falls Text leer ist, ist das Dokument meist noch nicht im Vektor-Index verfügbar
+    if not full_text.strip():
+        raise AnalysisUnavailable(*NOT_YET_INDEXED)
+
+    return {
+        "analysis_result": full_text,
+        "used_sources": extract_sources(response.candidates[0])
+    }
+
+def generate_analysis(file_path, file_name):
+    """Runs the grounded model call for a file and returns the analysis payload."""
+    model = registry.get("model")
+    prompt, sources = analysis_prompt(file_path, file_name)
+
+    def attempt(timeout):
+        # The SDK takes no per-call timeout; the deadline only bounds the retries
+        with model_limiter.slot(), model_breaker.guard(), metrics.observe_upstream("model", "generate_content"):
+            return model.generate_content(prompt)
+
+    # Retrieval from the data store runs inside the grounded call, so "generate" includes it
+    with tracing.span("generate", model=MODEL_NAME) as span:
+        response = model_retry.call(attempt)
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            span.set(prompt_tokens=usage.prompt_token_count, candidates_tokens=usage.candidates_token_count)
+    metrics.record_token_usage(response)
+    with tracing.span("parse") as span:
+        result = parse_analysis_response(response)
+        if sources:
+            result["used_sources"] = sources
+        span.set(sources=len(result["used_sources"]))
+    return result
+
+def extract_sources(candidate):
+    """Safely extracts the grounding source URIs of a response candidate."""
+    used_sources = []
+    if hasattr(candidate, 'grounding_metadata') and candidate.grounding_metadata:
+        for chunk in candidate.grounding_metadata.grounding_chunks:
+            if hasattr(chunk, "retrieved_context") and chunk.retrieved_context:
+                used_sources.append(chunk.retrieved_context.uri)
+    return used_sources
+
+def stream_analysis(file_path, file_name):
+    """Streams the grounded model call for a file, yielding ("chunk", text) and finally ("sources", list)."""
+    model = registry.get("model")
+    prompt, sources = analysis_prompt(file_path, file_name)
+
+    used_sources = list(sources)
+    produced_text = False
+    def open_stream(timeout):
+        # Errors of a streamed call surface with its first response; only that part is retried,
+        # text already sent to the client can't be taken back
+        with model_breaker.guard():
+            responses = model.generate_content(prompt, stream=True)
+            first = next(responses, None)
+        return itertools.chain([first] if first is not None else [], responses)
+
+    # The slot is held for the whole stream, since that's how long the model works on it
+    response = None
+    with model_limiter.slot(), metrics.observe_upstream("model", "generate_content_stream"):
+        for response in model_retry.call(open_stream):
+            text, sources = parse_stream_chunk(response)
+            used_sources.extend(sources)
+            if text:
+                produced_text = produced_text or bool(text.strip())
+                yield "chunk", text
+
+    # Usage metadata of a stream is complete on its last response
+    metrics.record_token_usage(response)
+    if not produced_text:
+        raise AnalysisUnavailable(*NOT_YET_INDEXED)
+    yield "sources", list(set(used_sources))
+
+def parse_stream_chunk(response):
+    """Returns (text, grounding sources) of one streamed model response."""
+    if not response.candidates:
+        return "", []
+    candidate = response.candidates[0]
+    # Grounding metadata usually only arrives with the last chunk
+    sources = extract_sources(candidate)
+    if not candidate.content.parts:
+        return "", sources
+    return "".join(part.text for part in candidate.content.parts if hasattr(part, "text")), sources
+
+def sse_event(event, data):
+    """Formats a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Concurrent requests for the same document wait on one upstream generation.
+# Across workers only a shared cache store (disk or gcs) hands the leader's result to the
+# followers; with per-worker memory the lock would just make them wait before generating again.
+shared_analysis_cache = analysis_cache is not None and isinstance(analysis_cache.store, (DiskStore, GCSStore))
+analysis_flight = SingleFlight(
+    lock_dir=(SINGLEFLIGHT_LOCK_DIR or None) if shared_analysis_cache else None,
+    wait_timeout=SINGLEFLIGHT_WAIT_TIMEOUT
+)
+
+def run_analysis(file_path, file_name, cache_key):
+    """Generates (and caches) an analysis, coalescing concurrent identical requests.
+
+    Returns (result, coalesced).
+    """
+    def compute():
+        result = generate_analysis(file_path, file_name)
+        if cache_key:
+            analysis_cache.set(cache_key, result)
+        return result
+
+    lookup = (lambda: analysis_cache.get(cache_key)) if cache_key else None
+    with tracing.span("analysis") as span:
+        result, coalesced = analysis_flight.do(cache_key or file_path, compute, lookup=lookup)
+        span.set(coalesced=coalesced)
+    return result, coalesced
+
+# --- File Catalog ---
+def _list_bucket(timeout):
+    # Only the fields the catalog keeps; materialized here, inside the retry, since listing errors surface while paging
+    with metrics.observe_upstream("gcs", "list_blobs"):
+        return list(registry.get("storage").bucket(GCS_BUCKET_NAME).list_blobs(
+            fields="items(name,size,updated,generation,metadata),nextPageToken", timeout=timeout
+        ))
+
+# Rewritten on every catalog change, so all workers and instances notice it by its generation
+CATALOG_VERSION_OBJECT = ".catalog/version"
+
+def _read_catalog_version(timeout):
+    with metrics.observe_upstream("gcs", "get_blob"):
+        blob = registry.get("storage").bucket(GCS_BUCKET_NAME).get_blob(CATALOG_VERSION_OBJECT, timeout=timeout)
+    return blob.generation if blob is not None else None
+
+def _write_catalog_version():
+    with metrics.observe_upstream("gcs", "upload"):
+        registry.get("storage").bucket(GCS_BUCKET_NAME).blob(CATALOG_VERSION_OBJECT).upload_from_string(
+            str(time.time()), content_type="text/plain"
+        )
+
+file_catalog = FileCatalog(
+    GCS_BUCKET_NAME,
+    # Retried (and guarded by the GCS breaker) as a whole listing
+    lambda: idempotent_read(storage_retry, _list_bucket, breaker=gcs_breaker),
+    refresh_interval=CATALOG_REFRESH_INTERVAL,
+    shared_version=SharedVersion(
+        lambda: idempotent_read(storage_retry, _read_catalog_version, breaker=gcs_breaker),
+        _write_catalog_version
+    ) if GCS_BUCKET_NAME else None,
+    version_check_interval=CATALOG_VERSION_CHECK_INTERVAL
+)
+
+# --- Upload Deduplication ---
+# sha256 -> name of the object holding that content
+if DEDUP_INDEX_BACKEND == "gcs" and GCS_BUCKET_NAME:
+    dedup_index = GCSStore(lambda: registry.get("storage").bucket(GCS_BUCKET_NAME), prefix=".hash-index/")
+elif DEDUP_INDEX_BACKEND == "memory":
+    dedup_index = MemoryStore(max_entries=100000)
+else:
+    dedup_index = None
+
+def sha256_of_stream(stream, chunk_size=1024 * 1024):
+    """Hashes a seekable stream chunk by chunk and rewinds it."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def sha256_of_object(blob, chunk_size=8 * 1024 * 1024):
+    """Hashes a stored object chunk by chunk, exactly the generation `blob` was read at."""
+    digest = hashlib.sha256()
+    with metrics.observe_upstream("gcs", "download"):
+        with blob.open("rb", chunk_size=chunk_size, if_generation_match=blob.generation) as reader:
+            for chunk in iter(lambda: reader.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def find_duplicate(sha256):
+    """Returns the existing object (blob) with this content, or None."""
+    raw = dedup_index.get(sha256)
+    if raw is None:
+        return None
+    object_name = raw.decode("utf-8")
+    # The index is only a hint; the object may have been deleted or overwritten since
+    blob = registry.get("storage").bucket(GCS_BUCKET_NAME).get_blob(object_name)
+    if blob is None or (blob.metadata or {}).get("sha256") != sha256 or (blob.metadata or {}).get("alias_of"):
+        dedup_index.delete(sha256)
+        return None
+    return blob
+
+# --- Uploads ---
+class UploadRejected(Exception):
+    """Raised when an upload violates the upload constraints."""
+
+    def __init__(self, error, status_code=400):
+        super().__init__(error)
+        self.error = error
+        self.status_code = status_code
+
+def check_upload(filename, size=None, content_type="application/pdf"):
+    """Raises UploadRejected unless the upload is a PDF within the size limit."""
+    if not filename or not filename.lower().endswith(".pdf") or content_type != "application/pdf":
+        raise UploadRejected("Invalid file type. Only PDFs are allowed.")
+    if size is not None:
+        if not isinstance(size, int) or size <= 0:
+            raise UploadRejected("Missing or invalid 'size'.")
+        if size > MAX_UPLOAD_BYTES:
+            raise UploadRejected(f"File too large. Maximum is {MAX_UPLOAD_BYTES} bytes.", 413)
+
+def store_upload(file):
+    """Writes an uploaded file to GCS (or links it to an identical one) and returns the response payload."""
+    storage_client = registry.get("storage")
+    bucket = storage_client.bucket(GCS_BUCKET_NAME)
+    blob = bucket.blob(file.filename)
+
+    # Multipart uploads are spooled by werkzeug, so the stream can be hashed and rewound
+    sha256 = None
+    if dedup_index is not None:
+        with tracing.span("hash"):
+            sha256 = sha256_of_stream(file.stream)
+    if sha256:
+        with tracing.span("dedup_lookup") as span:
+            duplicate = find_duplicate(sha256)
+            span.set(duplicate=duplicate is not None)
+        if duplicate is not None:
+            return link_duplicate(blob, duplicate, sha256)
+
+    # Direktes Hochladen der File
+    if sha256:
+        blob.metadata = {"sha256": sha256}
+    with metrics.observe_upstream("gcs", "upload"):
+        blob.upload_from_file(file, content_type="application/pdf")
+    metrics.UPLOADED_BYTES.labels("app").inc(blob.size or 0)
+    with tracing.span("catalog_update"):
+        file_catalog.add(blob.name, blob.size, blob.updated, metadata=blob.metadata, generation=blob.generation)
+        if sha256:
+            dedup_index.set(sha256, file.filename.encode("utf-8"))
+    queue_local_indexing(blob.name)
+
+    # WICHTIG: Wir geben die URI zurück, die check_file_status erwartet
+    gcs_uri = f"gs://{GCS_BUCKET_NAME}/{file.filename}"
+
+    return {
+        "success": True,
+        "message": f"File '{file.filename}' uploaded successfully.",
+        "gcs_uri": gcs_uri, # Eindeutige ID für das spätere Polling
+        "filename": file.filename
+    }
+
+def link_duplicate(blob, duplicate, sha256, metadata=None, if_generation_match=None):
+    """Links an upload to the existing object with the same content; returns the response payload.
+
+    The upload becomes an empty alias object: listed under its own name, skipped by
+    the indexer. The target's generation lets the catalog notice when the target is
+    overwritten or deleted later. `if_generation_match` guards replacing an object
+    that was already written (direct uploads).
+    """
+    if duplicate.name != blob.name and (blob.metadata or {}).get("alias_of") != duplicate.name:
+        blob.metadata = {**(metadata or {}), "alias_of": duplicate.name, "alias_generation": str(duplicate.generation), "sha256": sha256}
+        with metrics.observe_upstream("gcs", "upload"):
+            blob.upload_from_string(b"", content_type="application/pdf", if_generation_match=if_generation_match)
+        file_catalog.add(blob.name, blob.size, blob.updated, metadata=blob.metadata, generation=blob.generation)
+    if duplicate.name != blob.name:
+        message = f"File '{blob.name}' is identical to '{duplicate.name}' and was linked to it."
+    else:
+        message = f"File '{blob.name}' was already uploaded."
+    app.logger.info(f"Upload '{blob.name}' is a duplicate of '{duplicate.name}'.")
+    return {
+        "success": True,
+        "message": message,
+        "gcs_uri": f"gs://{GCS_BUCKET_NAME}/{duplicate.name}",
+        "filename": blob.name,
+        "deduplicated": True,
+        "alias_of": duplicate.name
+    }
+
+def _signing_kwargs():
+    """Extra arguments for generate_signed_url when credentials can't sign locally.
+
+    On Cloud Run the metadata-server credentials have no private key, so the
+    URL is signed through IAM (the service account needs roles/iam.serviceAccountTokenCreator on itself).
+    """
+    credentials = registry.get("storage")._credentials
+    if getattr(credentials, "signer", None) is not None:
+        return {}
+    if not credentials.valid:
+        credentials.refresh(google.auth.transport.requests.Request())
+    return {"service_account_email": credentials.service_account_email, "access_token": credentials.token}
+
+# Object metadata key of the completion token of a direct upload (header x-goog-meta-upload-token)
+UPLOAD_TOKEN_METADATA = "upload-token"
+
+def signed_upload_target(filename, size, content_type="application/pdf"):
+    """Creates the URL (and headers) a client uploads one file to directly.
+
+    The upload stores a random completion token in the object's metadata; only the
+    client that got it can complete the upload (and have a rejected object removed).
+    """
+    blob = registry.get("storage").bucket(GCS_BUCKET_NAME).blob(filename)
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=SIGNED_URL_EXPIRATION)
+    completion_token = secrets.token_urlsafe(24)
+
+    if os.getenv("STORAGE_EMULATOR_HOST"):
+        blob.metadata = {UPLOAD_TOKEN_METADATA: completion_token}
+        upload_url = blob.create_resumable_upload_session(content_type=content_type, size=size, origin=request.host_url.rstrip("/"))
+        method, headers = "PUT", {"Content-Type": content_type}
+    else:
+        # Signed headers must be sent verbatim; GCS rejects bodies outside the length range
+        headers = {
+            "Content-Type": content_type,
+            "x-goog-resumable": "start",
+            "x-goog-content-length-range": f"0,{size}",
+            f"x-goog-meta-{UPLOAD_TOKEN_METADATA}": completion_token,
+        }
+        upload_url = blob.generate_signed_url(
+            version="v4",
+            expiration=expires_at,
+            method="POST",
+            headers=headers,
+            **_signing_kwargs()
+        )
+        method = "POST"
+
+    return {
+        "upload_url": upload_url,
+        "method": method,
+        "headers": headers,
+        "object_name": filename,
+        "gcs_uri": f"gs://{GCS_BUCKET_NAME}/{filename}",
+        "completion_token": completion_token,
+        "expires_at": expires_at.isoformat()
+    }
+
+# Shared by all batch requests of a worker, so parallel transfers stay bounded
+upload_executor = ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS, thread_name_prefix="batch-upload")
+
+if GCS_BUCKET_NAME:
+    batch_store = ResultCache(GCSStore(lambda: registry.get("storage").bucket(GCS_BUCKET_NAME), prefix=".batches/"), ttl_seconds=BATCH_TTL)
+else:
+    batch_store = ResultCache(MemoryStore(max_entries=10000), ttl_seconds=BATCH_TTL)
+
+# --- Precomputation ---
+interactive_analyses = InFlightCounter()
+
+precompute_queue = BackgroundQueue(
+    "precompute",
+    workers=PRECOMPUTE_WORKERS,
+    max_pending=PRECOMPUTE_MAX_PENDING,
+    should_pause=lambda: interactive_analyses.value >= PRECOMPUTE_PAUSE_AT
+)
+
+def precompute_analysis(file_path):
+    """Generates and caches the analysis of a freshly indexed document."""
+    file_name = file_path.split("/")[-1]
+    cache_key = analysis_cache_key(file_path)
+    if not cache_key:
+        return
+    if analysis_cache.get(cache_key) is not None:
+        return
+    try:
+        # Goes through single-flight, so a student clicking meanwhile joins this call
+        run_analysis(file_path, file_name, cache_key)
+        app.logger.info(f"Precomputed analysis for '{file_name}'.")
+    except AnalysisUnavailable as e:
+        app.logger.warning(f"Precomputation for '{file_name}' produced no content: {e.details}")
+    except (Overloaded, CircuitOpen) as e:
+        app.logger.warning(f"Skipped precomputation for '{file_name}': {e}")
+
+# --- Local Retrieval ---
+local_index_queue = BackgroundQueue(
+    "local-index",
+    workers=1,
+    max_pending=PRECOMPUTE_MAX_PENDING,
+    should_pause=lambda: interactive_analyses.value >= PRECOMPUTE_PAUSE_AT
+)
+
+def index_local_document(gcs_uri):
+    """Adds a PDF to the local index unless this version is already in it; returns False if there is nothing to index."""
+    bucket_name, _, blob_name = gcs_uri[len("gs://"):].partition("/")
+    bucket = registry.get("storage").bucket(bucket_name)
+
+    def get_blob(timeout):
+        with metrics.observe_upstream("gcs", "get_blob"):
+            return bucket.get_blob(blob_name, timeout=timeout)
+
+    blob = idempotent_read(storage_retry, get_blob, breaker=gcs_breaker)
+    # Aliases are empty; their content is indexed under the object they point to
+    if blob is None or (blob.metadata or {}).get("alias_of"):
+        return False
+    version = blob.md5_hash or blob.crc32c or str(blob.generation)
+    if local_retriever.document_version(gcs_uri) == version:
+        return True
+    with tracing.span("local_index") as span:
+        with metrics.observe_upstream("gcs", "download"):
+            data = blob.download_as_bytes()
+        chunks = local_retriever.add_document(gcs_uri, data, version=version)
+        span.set(chunks=chunks)
+    app.logger.info(f"Indexed '{gcs_uri}' locally ({chunks} chunks).")
+    return True
+
+def queue_local_indexing(object_name):
+    """Indexes a newly written PDF in the background when local retrieval is enabled."""
+    if local_retriever is not None and object_name.lower().endswith(".pdf"):
+        local_index_queue.submit(index_local_document, f"gs://{GCS_BUCKET_NAME}/{object_name}")
+
+def analysis_prompt(file_path, file_name):
+    """Returns the prompt for an analysis and the sources it was built from (only for local retrieval)."""
+    if local_retriever is None:
+        return USER_PROMPT_TEMPLATE.format(file_name=file_name), []
+    with tracing.span("retrieve") as span:
+        # Files uploaded before local retrieval was enabled are indexed on first use
+        if not local_retriever.has_document(file_path) and file_path.startswith("gs://"):
+            index_local_document(file_path)
+        passages = local_retriever.document_passages(file_path, LOCAL_PASSAGES)
+        span.set(passages=len(passages))
+    if not passages:
+        raise AnalysisUnavailable(
+            "Keine Inhalte gefunden.",
+            "In der Datei wurde kein lesbarer Text gefunden (z.B. bei eingescannten Seiten)."
+        )
+    context = "\n\n".join(f"[Seite {passage['page']}]\n{passage['text']}" for passage in passages)
+    return LOCAL_PROMPT_TEMPLATE.format(file_name=file_name, passages=context), [file_path]
+
+# --- Analysis Jobs ---
+def _build_job_store():
+    if JOB_BACKEND == "memory":
+        return MemoryJobStore()
+    if JOB_BACKEND == "gcs" and GCS_BUCKET_NAME:
+        return GCSJobStore(lambda: registry.get("storage").bucket(GCS_BUCKET_NAME))
+    return SQLiteJobStore(JOB_DB_PATH)
+
+analysis_jobs = JobQueue(
+    _build_job_store(),
+    workers=JOB_WORKERS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    retry_delay=JOB_RETRY_DELAY,
+    retention=JOB_RETENTION,
+    poll_interval=JOB_POLL_INTERVAL
+)
+
+def run_analysis_job(payload):
+    """Job handler: the same cached, coalesced analysis as the synchronous /analyze."""
+    file_path = payload["file_path"]
+    with interactive_analyses:
+        result, _ = run_analysis(file_path, file_path.split("/")[-1], analysis_cache_key(file_path))
+    return result
+
+analysis_jobs.register("analysis", run_analysis_job)
+
+def job_view(job):
+    """Public representation of a job record."""
+    view = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "file_path": job["payload"].get("file_path"),
+        "attempts": job["attempts"],
+        "created": job["created"],
+        "updated": job["updated"],
+    }
+    if job["result"] is not None:
+        view["result"] = job["result"]
+    if job["error"]:
+        view["error"] = job["error"]
+        view["details"] = job["details"]
+    return view
+
+# --- Index Status ---
+def documents_parent():
+    """Resource name of the data store branch that holds the imported documents."""
+    # Get the actual data store ID if the full resource name was provided
+    final_datastore_id = DATA_STORE_ID.split('/')[-1]
+    return (
+        f"projects/{PROJECT_ID}/locations/{DATA_STORE_LOCATION}/collections/default_collection/"
+        f"dataStores/{final_datastore_id}/branches/0"
+    )
+
+def document_id_for_uri(gcs_uri):
+    """Derives the document ID Vertex AI Search assigns to an unstructured GCS import.
+
+    Without an id_field the ID is the first 128 bits of SHA-256(GCS URI), hex-encoded.
+    """
+    return hashlib.sha256(gcs_uri.encode("utf-8")).hexdigest()[:32]
+
+TERMINAL_STATUSES = ("INDEXED", "FAILED")
+
+# Outcomes recorded by the indexer's operation tracker
+index_status_store = None
+if INDEX_STATUS_BUCKET:
+    index_status_store = GCSStore(lambda: registry.get("storage").bucket(INDEX_STATUS_BUCKET), prefix=".index-status/")
+
+def recorded_index_status(gcs_uri):
+    """Returns the indexer's recorded outcome of a URI, or None if there is none."""
+    if index_status_store is None:
+        return None
+    try:
+        with tracing.span("status_record"):
+            raw = index_status_store.get(f"{document_id_for_uri(gcs_uri)}.json")
+    except Exception as e:
+        app.logger.warning(f"Could not read index status record for '{gcs_uri}': {e}")
+        return None
+    if raw is None:
+        return None
+    record = json.loads(raw)
+    status = {"status": record["status"]}
+    if record.get("details"):
+        status["details"] = record["details"]
+    return status
+
+def lookup_index_status(gcs_uri):
+    """Answers from the indexer's status record, else asks the data store (one get-document call)."""
+    if local_retriever is not None:
+        if local_retriever.has_document(gcs_uri):
+            return {"status": "INDEXED"}
+        # Covers files written before local retrieval was enabled; indexing an indexed version is a no-op
+        local_index_queue.submit(index_local_document, gcs_uri)
+        return {"status": "PROCESSING"}
+
+    recorded = recorded_index_status(gcs_uri)
+    if recorded is not None and recorded["status"] in TERMINAL_STATUSES:
+        return recorded
+
+    name = f"{documents_parent()}/documents/{document_id_for_uri(gcs_uri)}"
+
+    def get_document(timeout):
+        with metrics.observe_upstream("datastore", "get_document"):
+            return registry.get("documents").get_document(name=name, timeout=timeout)
+
+    try:
+        idempotent_read(documents_retry, get_document, document_lookup_hedger, datastore_breaker)
+        return {"status": "INDEXED"}
+    except exceptions.NotFound:
+        return {"status": "PROCESSING"}
+
+status_cache = ResultCache(
+    MemoryStore(max_entries=10000), ttl_seconds=STATUS_CACHE_TTL, on_lookup=_cache_lookup_counter("index_status")
+)
+status_flight = SingleFlight()
+# Index status changes per GCS URI, fed by the indexer's reports
+status_bus = EventBus()
+
+def index_status(gcs_uri):
+    """Returns the status record of a URI; concurrent pollers share one upstream lookup."""
+    with tracing.span("status_cache") as span:
+        cached = status_cache.get(gcs_uri)
+        span.set(hit=cached is not None)
+    if cached is not None:
+        return cached
+
+    def lookup():
+        status = lookup_index_status(gcs_uri)
+        status_cache.set(gcs_uri, status)
+        return status
+
+    status, _ = status_flight.do(gcs_uri, lookup)
+    return status
+
+def set_index_status(gcs_uri, status, details=None):
+    """Records a reported status and pushes it to subscribers of the URI."""
+    record = {"status": status}
+    if details:
+        record["details"] = details
+    status_cache.set(gcs_uri, record)
+    status_bus.publish(gcs_uri, record)
 
 # --- Routes ---
 @app.route("/")
@@ -94,36 +1062,62 @@ def home():
 
 @app.route("/files", methods=["GET"])
 def list_files():
-    """Lists all PDF files in the GCS bucket."""
+    """Lists the PDF files in the GCS bucket from the cached catalog.
+
+    Query parameters: `prefix`, `limit` and `cursor` (from a previous `next_cursor`)
+    for pagination, and `fields` (comma-separated subset of name, path, size, updated).
+    Without `limit` all matching files are returned.
+    """
     if not GCS_BUCKET_NAME:
         return jsonify({"error": "Server misconfiguration: GCS_BUCKET_NAME not set"}), 500
-    
+
+    prefix = request.args.get("prefix", "")
+    cursor = request.args.get("cursor")
+    limit = request.args.get("limit", type=int)
+    fields = None
+    if request.args.get("fields"):
+        fields = tuple(f.strip() for f in request.args["fields"].split(","))
+        unknown = [f for f in fields if f not in FileCatalog.FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown field(s): {', '.join(unknown)}"}), 400
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "'limit' must be positive."}), 400
+
     try:
-        storage_client = storage.Client(project=PROJECT_ID)
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        
-        blobs = bucket.list_blobs()
-        files = [
-            {"name": blob.name, "path": f"gs://{GCS_BUCKET_NAME}/{blob.name}"}
-            for blob in blobs
-            if blob.name.lower().endswith(".pdf")
-        ]
-        
-        files.sort(key=lambda x: x['name'])
-        
-        return jsonify({"files": files}), 200
+        with tracing.span("catalog_refresh"):
+            file_catalog.ensure_fresh()
+        with tracing.span("page") as span:
+            files, next_cursor, etag = file_catalog.page(prefix=prefix, cursor=cursor, limit=limit, fields=fields)
+            span.set(files=len(files))
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({"error": "Invalid 'cursor'."}), 400
+    except CircuitOpen as e:
+        return jsonify(unavailable_body(e)), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         app.logger.error(f"Error listing files: {e}")
         return jsonify({"error": "Could not list files from bucket.", "details": str(e)}), 500
 
+    if request.if_none_match.contains(etag):
+        return "", 304, {"ETag": f'"{etag}"'}
+
+    body = {"files": files}
+    if next_cursor:
+        body["next_cursor"] = next_cursor
+    with tracing.span("serialize"):
+        response = jsonify(body)
+    response.set_etag(etag)
+    return response, 200
+
 @app.route("/upload", methods=["POST"])
 def upload_file():
     """Handles PDF file uploads and saves them to GCS."""
     if not GCS_BUCKET_NAME:
         return jsonify({"error": "Server misconfiguration: GCS_BUCKET_NAME not set"}), 500
 
-    if "file" not in request.files:
-        return jsonify({"error": "No file part in the request."}), 400
+    # Accessing request.files parses (and spools) the multipart body
+    with tracing.span("parse_form"):
+        if "file" not in request.files:
+            return jsonify({"error": "No file part in the request."}), 400
     
     file = request.files["file"]
     if file.filename == "":
@@ -131,32 +1125,306 @@ def upload_file():
         
     if file and file.filename.lower().endswith(".pdf"):
         try:
-            storage_client = storage.Client(project=PROJECT_ID)
-            bucket = storage_client.bucket(GCS_BUCKET_NAME)
-            blob = bucket.blob(file.filename)
-            
-            # Direktes Hochladen der File
-            blob.upload_from_file(file)
-
-            # WICHTIG: Wir geben die URI zurück, die check_file_status erwartet
-            gcs_uri = f"gs://{GCS_BUCKET_NAME}/{file.filename}"
-            
-            return jsonify({
-                "success": True, 
-                "message": f"File '{file.filename}' uploaded successfully.",
-                "gcs_uri": gcs_uri, # Eindeutige ID für das spätere Polling
-                "filename": file.filename
-            }), 201
+            return jsonify(store_upload(file)), 201
         except Exception as e:
             app.logger.error(f"Error uploading file: {e}")
             return jsonify({"error": "File upload failed.", "details": str(e)}), 500
     else:
         return jsonify({"error": "Invalid file type. Only PDFs are allowed."}), 400
 
+@app.route("/upload/signed_url", methods=["POST"])
+def create_signed_upload():
+    """Issues a URL the browser uploads a PDF to directly, bypassing this service.
+
+    Body: {"filename", "size", "content_type"}. Returns a V4 signed URL that starts a
+    resumable upload (POST with the returned headers; the session URI comes back in the
+    Location header). Against a storage emulator (STORAGE_EMULATOR_HOST), which can't
+    verify signatures, the resumable session URI is returned instead (method PUT).
+    The client calls /upload/complete with the returned completion_token when the transfer is done.
+    """
+    if not GCS_BUCKET_NAME:
+        return jsonify({"error": "Server misconfiguration: GCS_BUCKET_NAME not set"}), 500
+    if not DIRECT_UPLOADS:
+        return jsonify({"error": "Direct uploads are disabled."}), 404
+
+    data = request.get_json(silent=True) or {}
+    filename = data.get("filename") or ""
+    size = data.get("size")
+    content_type = data.get("content_type") or "application/pdf"
+
+    try:
+        check_upload(filename, size, content_type)
+        return jsonify(signed_upload_target(filename, size, content_type)), 200
+    except UploadRejected as e:
+        return jsonify({"error": e.error}), e.status_code
+    except Exception as e:
+        app.logger.error(f"Error creating signed upload URL: {e}")
+        return jsonify({"error": "Could not create upload URL.", "details": str(e)}), 500
+
+@app.route("/upload/complete", methods=["POST"])
+def complete_signed_upload():
+    """Verifies a direct upload and registers the file in the catalog.
+
+    Body: {"object_name", "completion_token"} as returned with the signed URL.
+    """
+    if not GCS_BUCKET_NAME:
+        return jsonify({"error": "Server misconfiguration: GCS_BUCKET_NAME not set"}), 500
+
+    data = request.get_json(silent=True) or {}
+    object_name = data.get("object_name")
+    completion_token = data.get("completion_token")
+    if not object_name or not object_name.lower().endswith(".pdf"):
+        return jsonify({"error": "Missing or invalid 'object_name'."}), 400
+    if not isinstance(completion_token, str) or not completion_token:
+        return jsonify({"error": "Missing 'completion_token'."}), 400
+
+    try:
+        blob = registry.get("storage").bucket(GCS_BUCKET_NAME).get_blob(object_name)
+        if blob is None:
+            return jsonify({"error": "Upload not found. Did the transfer finish?"}), 404
+        # Only the object written through this signed upload may be completed (or removed) by the caller
+        stored_token = (blob.metadata or {}).get(UPLOAD_TOKEN_METADATA) or ""
+        if not hmac.compare_digest(stored_token, completion_token):
+            return jsonify({"error": "Forbidden"}), 403
+        if (blob.metadata or {}).get("alias_of"):
+            # Completed (and linked to its duplicate) before; the client is retrying
+            duplicate = registry.get("storage").bucket(GCS_BUCKET_NAME).get_blob(blob.metadata["alias_of"])
+            if duplicate is not None:
+                return jsonify(link_duplicate(blob, duplicate, blob.metadata.get("sha256"))), 201
+        if blob.size > MAX_UPLOAD_BYTES or blob.content_type != "application/pdf":
+            blob.delete()
+            return jsonify({"error": "Uploaded object violates the upload constraints and was removed."}), 400
+
+        # Direct uploads never pass through the app, so the stored object is hashed here
+        if dedup_index is not None:
+            with tracing.span("hash"):
+                sha256 = sha256_of_object(blob)
+            with tracing.span("dedup_lookup") as span:
+                duplicate = find_duplicate(sha256)
+                span.set(duplicate=duplicate is not None)
+            if duplicate is not None and duplicate.name != blob.name:
+                metrics.UPLOADED_BYTES.labels("direct").inc(blob.size)
+                # Keeps the completion token, so a retried completion still gets this response
+                return jsonify(link_duplicate(
+                    blob, duplicate, sha256, metadata={UPLOAD_TOKEN_METADATA: stored_token},
+                    if_generation_match=blob.generation
+                )), 201
+            blob.metadata = {**(blob.metadata or {}), "sha256": sha256}
+            blob.patch()
+            dedup_index.set(sha256, blob.name.encode("utf-8"))
+
+        file_catalog.add(blob.name, blob.size, blob.updated, metadata=blob.metadata, generation=blob.generation)
+        queue_local_indexing(blob.name)
+        metrics.UPLOADED_BYTES.labels("direct").inc(blob.size)
+        gcs_uri = f"gs://{GCS_BUCKET_NAME}/{object_name}"
+        return jsonify({
+            "success": True,
+            "message": f"File '{object_name}' uploaded successfully.",
+            "gcs_uri": gcs_uri,
+            "filename": object_name
+        }), 201
+    except Exception as e:
+        app.logger.error(f"Error completing upload of '{object_name}': {e}")
+        return jsonify({"error": "Could not complete upload.", "details": str(e)}), 500
+
+def _upload_session_url(upload_id):
+    api_base = os.getenv("STORAGE_EMULATOR_HOST") or "https://storage.googleapis.com"
+    return session_url(api_base, GCS_BUCKET_NAME, upload_id)
+
+def _upload_completed(object_name, size=None, updated=None, generation=None):
+    file_catalog.add(object_name, size, updated, generation=generation)
+    queue_local_indexing(object_name)
+    return {
+        "success": True,
+        "complete": True,
+        "message": f"File '{object_name}' uploaded successfully.",
+        "gcs_uri": f"gs://{GCS_BUCKET_NAME}/{object_name}",
+        "filename": object_name
+    }
+
+CHUNKED_UPLOADS_DISABLED = "Chunked uploads are disabled: UPLOAD_SESSION_SECRET is not configured."
+
+@app.route("/upload/sessions", methods=["POST"])
+def create_upload_session():
+    """Starts a chunked, resumable upload through the app (for when signed URLs aren't allowed).
+
+    Body: {"filename", "size"}. The client then PUTs chunks to /upload/sessions/<upload_id>
+    with a Content-Range header; every chunk but the last must be a multiple of 256 KiB.
+    """
+    if not GCS_BUCKET_NAME:
+        return jsonify({"error": "Server misconfiguration: GCS_BUCKET_NAME not set"}), 500
+    if not UPLOAD_SESSION_SECRET:
+        return jsonify({"error": CHUNKED_UPLOADS_DISABLED}), 503
+
+    data = request.get_json(silent=True) or {}
+    filename = data.get("filename") or ""
+    size = data.get("size")
+    try:
+        check_upload(filename, size)
+    except UploadRejected as e:
+        return jsonify({"error": e.error}), e.status_code
+
+    try:
+        blob = registry.get("storage").bucket(GCS_BUCKET_NAME).blob(filename)
+        url = blob.create_resumable_upload_session(content_type="application/pdf", size=size)
+        return jsonify({
+            "upload_id": encode_session_token(filename, url, UPLOAD_SESSION_SECRET),
+            "object_name": filename,
+            "gcs_uri": f"gs://{GCS_BUCKET_NAME}/{filename}",
+            "chunk_size": UPLOAD_CHUNK_SIZE - UPLOAD_CHUNK_SIZE % CHUNK_GRANULARITY
+        }), 201
+    except Exception as e:
+        app.logger.error(f"Error creating upload session for '{filename}': {e}")
+        return jsonify({"error": "Could not start upload.", "details": str(e)}), 500
+
+@app.route("/upload/sessions/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    """Streams one chunk of a resumable upload into GCS without buffering it."""
+    if not UPLOAD_SESSION_SECRET:
+        return jsonify({"error": CHUNKED_UPLOADS_DISABLED}), 503
+    try:
+        object_name, session_id = decode_session_token(upload_id, UPLOAD_SESSION_SECRET)
+        start, end, total = parse_content_range(request.headers.get("Content-Range"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if total > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"File too large. Maximum is {MAX_UPLOAD_BYTES} bytes."}), 413
+    if end + 1 < total and (end - start + 1) % CHUNK_GRANULARITY:
+        return jsonify({"error": f"Chunks except the last must be a multiple of {CHUNK_GRANULARITY} bytes."}), 400
+    if request.content_length is not None and request.content_length != end - start + 1:
+        return jsonify({"error": "Content-Length does not match Content-Range."}), 400
+
+    try:
+        with metrics.observe_upstream("gcs", "upload_chunk"):
+            complete, next_offset, resource = forward_chunk(
+                registry.get("storage")._http, _upload_session_url(session_id),
+                request.stream, start, end, total
+            )
+        metrics.UPLOADED_BYTES.labels("chunked").inc(end - start + 1)
+    except UploadSessionError as e:
+        app.logger.error(f"GCS rejected chunk {start}-{end} of '{object_name}': {e.details}")
+        status = 410 if e.status_code in (404, 410) else 502
+        return jsonify({"error": "Chunk upload failed.", "details": e.details}), status
+    except Exception as e:
+        # Typically a client disconnect mid-chunk; the client resumes from GET's next_offset
+        app.logger.error(f"Error uploading chunk {start}-{end} of '{object_name}': {e}")
+        return jsonify({"error": "Chunk upload failed.", "details": str(e)}), 500
+
+    if complete:
+        return jsonify(_upload_completed(
+            object_name, int(resource.get("size", total)), resource.get("updated"), resource.get("generation")
+        )), 201
+    return jsonify({"complete": False, "next_offset": next_offset}), 200
+
+@app.route("/upload/sessions/<upload_id>", methods=["GET"])
+def upload_session_status(upload_id):
+    """Reports how many bytes GCS has persisted, so a client can resume after a disconnect."""
+    if not UPLOAD_SESSION_SECRET:
+        return jsonify({"error": CHUNKED_UPLOADS_DISABLED}), 503
+    try:
+        object_name, session_id = decode_session_token(upload_id, UPLOAD_SESSION_SECRET)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        complete, next_offset = query_offset(registry.get("storage")._http, _upload_session_url(session_id))
+    except UploadSessionError as e:
+        status = 410 if e.status_code in (404, 410) else 502
+        return jsonify({"error": "Upload session is no longer available.", "details": e.details}), status
+
+    if complete:
+        return jsonify(_upload_completed(object_name)), 200
+    return jsonify({"complete": False, "next_offset": next_offset}), 200
+
+@app.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    """Uploads many PDFs in one request and groups them under a batch ID.
+
+    Either multipart with several `files` parts (written to GCS in parallel), or, with
+    direct uploads enabled, a JSON manifest {"files": [{"filename", "size"}]} that returns
+    one signed upload target per file. Indexing progress is tracked at /batches/<batch_id>.
+    """
+    if not GCS_BUCKET_NAME:
+        return jsonify({"error": "Server misconfiguration: GCS_BUCKET_NAME not set"}), 500
+
+    if request.is_json:
+        if not DIRECT_UPLOADS:
+            return jsonify({"error": "Direct uploads are disabled."}), 404
+        entries = (request.get_json(silent=True) or {}).get("files") or []
+        names = [entry.get("filename") or "" for entry in entries]
+    else:
+        entries = [f for f in request.files.getlist("files") if f.filename]
+        names = [f.filename for f in entries]
+
+    if not entries:
+        return jsonify({"error": "No files in the request."}), 400
+    if len(entries) > BATCH_MAX_FILES:
+        return jsonify({"error": f"Too many files. Maximum is {BATCH_MAX_FILES} per batch."}), 413
+
+    request_is_json = request.is_json
+
+    def process(entry, name):
+        try:
+            if request_is_json:
+                check_upload(name, entry.get("size"))
+                return signed_upload_target(name, entry["size"])
+            check_upload(name)
+            return store_upload(entry)
+        except UploadRejected as e:
+            return {"success": False, "filename": name, "error": e.error}
+        except Exception as e:
+            app.logger.error(f"Error uploading '{name}' in batch: {e}")
+            return {"success": False, "filename": name, "error": "File upload failed.", "details": str(e)}
+
+    if request_is_json:
+        # Signing is cheap; only real transfers go through the pool
+        results = [process(entry, name) for entry, name in zip(entries, names)]
+    else:
+        results = list(upload_executor.map(process, entries, names))
+
+    accepted = [r for r in results if "gcs_uri" in r]
+    if not accepted:
+        return jsonify({"error": "No file in the batch was accepted.", "results": results}), 400
+
+    batch_id = uuid.uuid4().hex
+    batch_store.set(batch_id, {
+        "batch_id": batch_id,
+        "created": time.time(),
+        "files": [{"filename": r.get("filename") or r.get("object_name"), "gcs_uri": r["gcs_uri"]} for r in accepted]
+    })
+    app.logger.info(f"Batch {batch_id}: {len(accepted)}/{len(results)} file(s) accepted.")
+    return jsonify({"batch_id": batch_id, "results": results}), 201
+
+@app.route("/batches/<batch_id>", methods=["GET"])
+def batch_status(batch_id):
+    """Aggregated indexing progress of the files of an upload batch."""
+    batch = batch_store.get(batch_id)
+    if batch is None:
+        return jsonify({"error": "Batch not found."}), 404
+
+    files = []
+    counts = {}
+    for entry in batch["files"]:
+        try:
+            status = index_status(entry["gcs_uri"])
+        except Exception as e:
+            status = {"status": "UNKNOWN", "details": str(e)}
+        files.append({**entry, **status})
+        counts[status["status"]] = counts.get(status["status"], 0) + 1
+
+    return jsonify({
+        "batch_id": batch_id,
+        "total": len(files),
+        "counts": counts,
+        "complete": all(f["status"] in TERMINAL_STATUSES for f in files),
+        "files": files
+    }), 200
+
 @app.route("/analyze", methods=["POST"])
 def analyze_script():
     """Analyzes a specific document from the data store."""
-    if not tools:
+    if not retrieval_configured():
         return jsonify({"error": "Server misconfiguration: Analysis tool not available."}), 500
 
     data = request.get_json()
@@ -169,99 +1437,341 @@ def analyze_script():
     file_name = file_path.split("/")[-1]
 
     try:
-        user_prompt = f"Analysiere den Inhalt der Datei '{file_name}'. Nutze dafür das Data Store Tool. Erstelle die drei geforderten Abschnitte (Zusammenfassung, Thematische Übersicht, Lernziele) basierend auf den abgerufenen Fakten."
-        
-        # KORREKTUR: Kurzname verwenden (verhindert 404) und Upgrade auf 2.5 Flash
-        model = GenerativeModel(
-            model_name='gemini-2.5-flash',
-            system_instruction=SYSTEM_PROMPT,
-            tools=tools
-        )
+        cache_key = analysis_cache_key(file_path)
+        if cache_key:
+            with tracing.span("cache_lookup") as span:
+                cached = analysis_cache.get(cache_key)
+                span.set(hit=cached is not None)
+            if cached is not None:
+                app.logger.info(f"Cache hit for '{file_name}'.")
+                response = jsonify({**cached, "cache": "HIT"})
+                response.headers["X-Cache"] = "HIT"
+                return response, 200
 
-        response = model.generate_content(user_prompt)
-        # NEU: Sicherheitscheck (verhindert Abstürze bei leeren Antworten)
-        if not response.candidates or not response.candidates[0].content.parts:
-            return jsonify({
-                "error": "Keine Inhalte generiert.",
-                "details": "Das Modell konnte keine Informationen extrahieren. Eventuell ist die Indizierung noch nicht fertig."
-            }), 404
-        # Prüfung auf "Finish Reason" (oft SAFETY oder OTHER, wenn Grounding fehlschlägt)
-        if response.candidates[0].finish_reason != 1: # 1 = STOP (Erfolg)
-            app.logger.warning(f"Modell beendete mit Grund: {response.candidates[0].finish_reason}")
-
-        full_text = ""
-        if response and response.candidates:
-            full_text = "".join(part.text for part in response.candidates[0].content.parts if hasattr(part, "text"))
-
-        # Falls Text leer ist, ist das Dokument meist noch nicht im Vektor-Index verfügbar
-        if not full_text.strip():
-            return jsonify({
-                "error": "Inhalt noch nicht verfügbar.",
-                "details": "Die Datei wurde gefunden, aber die KI kann die Inhalte noch nicht lesen. Bitte warte ca. 2-3 Minuten, bis die automatische Indizierung abgeschlossen ist."
-            }), 404
-
-        # Safely extract grounding metadata
-        used_sources = []
-        if response.candidates and hasattr(response.candidates[0], 'grounding_metadata') and response.candidates[0].grounding_metadata:
-            for chunk in response.candidates[0].grounding_metadata.grounding_chunks:
-                if hasattr(chunk, "retrieved_context") and chunk.retrieved_context:
-                    used_sources.append(chunk.retrieved_context.uri)
-
-        app.logger.info(f"Successfully analyzed '{file_name}'.")
-        return jsonify({
-            "analysis_result": full_text,
-            "used_sources": list(set(used_sources))
-        }), 200
+        if data.get("async"):
+            priority = PRIORITIES.get(data.get("priority", "normal"))
+            if priority is None:
+                return jsonify({"error": f"'priority' must be one of {', '.join(PRIORITIES)}."}), 400
+            job, created = analysis_jobs.submit(
+                "analysis", {"file_path": file_path}, priority=priority, key=cache_key or file_path
+            )
+            app.logger.info(f"{'Queued' if created else 'Joined'} analysis job {job['id']} for '{file_name}'.")
+            response = jsonify({**job_view(job), "status_url": f"/jobs/{job['id']}"})
+            response.headers["Location"] = f"/jobs/{job['id']}"
+            return response, 202
+
+        try:
+            with interactive_analyses:
+                result, coalesced = run_analysis(file_path, file_name, cache_key)
+        except AnalysisUnavailable as e:
+            return jsonify({"error": e.error, "details": e.details}), 404
+        except (Overloaded, CircuitOpen) as e:
+            # Shed fast instead of letting requests pile up behind a saturated or failing model
+            app.logger.warning(f"Shedding analysis of '{file_name}': {e}")
+            return jsonify(unavailable_body(e)), 503, {"Retry-After": str(e.retry_after)}
+
+        app.logger.info(f"Successfully analyzed '{file_name}' (coalesced: {coalesced}).")
+        with tracing.span("serialize"):
+            response = jsonify({**result, "cache": "MISS" if cache_key else "BYPASS", "coalesced": coalesced})
+        response.headers["X-Cache"] = "MISS" if cache_key else "BYPASS"
+        return response, 200
 
     except Exception as e:
         app.logger.error(f"Error during analysis for {file_name}: {e}")
         return jsonify({"error": "Internal server error during analysis.", "details": str(e)}), 500
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Reports the status of an analysis job, including its result once it succeeded."""
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job ID."}), 404
+    return jsonify(job_view(job)), 200 if job["status"] in FINISHED else 202
+
+
+@app.route("/analyze/stream", methods=["GET"])
+def analyze_script_stream():
+    """Streams the analysis of a document as Server-Sent Events.
+
+    Events: `chunk` ({"text"}), then `sources` ({"used_sources", "cache", "coalesced"}) and
+    `done`, or a single `error` ({"error", "details"}).
+    """
+    if not retrieval_configured():
+        return jsonify({"error": "Server misconfiguration: Analysis tool not available."}), 500
+
+    file_path = request.args.get("file_path")
+    if not file_path:
+        return jsonify({"error": "Missing 'file_path' query parameter."}), 400
+
+    app.logger.info(f"Received streaming analysis request for: {file_path}")
+    file_name = file_path.split("/")[-1]
+
+    def events():
+        try:
+            cache_key = analysis_cache_key(file_path)
+            cached = analysis_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                app.logger.info(f"Cache hit for '{file_name}'.")
+                yield sse_event("chunk", {"text": cached["analysis_result"]})
+                yield sse_event("sources", {"used_sources": cached["used_sources"], "cache": "HIT"})
+                yield sse_event("done", {})
+                return
+
+            def produce():
+                parts = []
+                for kind, payload in stream_analysis(file_path, file_name):
+                    if kind == "chunk":
+                        parts.append(payload)
+                        yield "chunk", payload
+                    else:
+                        used_sources = payload
+                if cache_key:
+                    analysis_cache.set(cache_key, {"analysis_result": "".join(parts), "used_sources": used_sources})
+                yield "sources", {"used_sources": used_sources, "cache": "MISS" if cache_key else "BYPASS"}
+
+            def lookup():
+                # Another worker streamed the analysis while this one waited for its lock
+                cached = analysis_cache.get(cache_key)
+                if cached is None:
+                    return None
+                return [("chunk", cached["analysis_result"]), ("sources", {"used_sources": cached["used_sources"], "cache": "HIT"})]
+
+            # Identical streams share one model call; followers get the chunks the leader already sent, then the rest
+            with interactive_analyses:
+                items, coalesced = analysis_flight.stream(cache_key or file_path, produce, lookup=lookup if cache_key else None)
+                for kind, payload in items:
+                    if kind == "chunk":
+                        yield sse_event("chunk", {"text": payload})
+                    else:
+                        yield sse_event("sources", {**payload, "coalesced": coalesced})
+
+            app.logger.info(f"Successfully streamed analysis for '{file_name}' (coalesced: {coalesced}).")
+            yield sse_event("done", {})
+        except AnalysisUnavailable as e:
+            yield sse_event("error", {"error": e.error, "details": e.details})
+        except (Overloaded, CircuitOpen) as e:
+            app.logger.warning(f"Shedding streaming analysis of '{file_name}': {e}")
+            yield sse_event("error", unavailable_body(e))
+        except Exception as e:
+            app.logger.error(f"Error during streaming analysis for {file_name}: {e}")
+            yield sse_event("error", {"error": "Internal server error during analysis.", "details": str(e)})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        # Keep proxies (and Cloud Run's frontend) from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """Reports hit/miss counters of the analysis cache for this worker."""
+    if analysis_cache is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **analysis_cache.stats()}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Exposes request, upstream, cache, upload and token metrics in the Prometheus text format."""
+    body, content_type = metrics.exposition()
+    return Response(body, headers={"Content-Type": content_type})
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Reports the upstream circuit breakers and the model limiter of this worker.
+
+    Always 200 while the worker serves requests, so an upstream outage doesn't get
+    instances restarted; `status` is "degraded" while any circuit isn't closed.
+    """
+    circuits = {breaker.name: breaker.stats() for breaker in circuit_breakers}
+    degraded = any(circuit["state"] != CircuitBreaker.CLOSED for circuit in circuits.values())
+    return jsonify({
+        "status": "degraded" if degraded else "ok",
+        "circuits": circuits,
+        "model_limiter": model_limiter.stats()
+    }), 200
+
+
 @app.route("/check_file_status", methods=['POST'])
 def check_file_status():
     """Checks if a document has been indexed in the data store."""
     data = request.get_json()
     gcs_uri = data.get("gcs_uri")
 
-    if not all([gcs_uri, PROJECT_ID, DATA_STORE_LOCATION, DATA_STORE_ID]):
+    if not gcs_uri or not index_status_configured():
         return jsonify({"error": "Server misconfiguration, missing environment variables."}), 500
 
     try:
-        # Get the actual data store ID if the full resource name was provided
-        final_datastore_id = DATA_STORE_ID.split('/')[-1]
-        
-        # Construct the parent branch resource name
-        parent = (
-            f"projects/{PROJECT_ID}/locations/{DATA_STORE_LOCATION}/collections/default_collection/"
-            f"dataStores/{final_datastore_id}/branches/0"
-        )
-
-        # KORREKTUR: Expliziter EU-Endpoint für Discovery Engine
-        client_options = None
-        if DATA_STORE_LOCATION:
-            # Für Europa ist 'eu' der korrekte Präfix für die Discovery Engine API
-            endpoint = "eu-discoveryengine.googleapis.com" if DATA_STORE_LOCATION.lower() in ["eu", "europe-west1"] else f"{DATA_STORE_LOCATION}-discoveryengine.googleapis.com"
-            client_options = {"api_endpoint": endpoint}
-
-        client = discoveryengine.DocumentServiceClient(client_options=client_options)
-        
-        # FIX: Wir laden die Liste und prüfen die URI manuell, um den 'filter' Fehler zu umgehen
-        request_list = discoveryengine.ListDocumentsRequest(parent=parent)
-        page_result = client.list_documents(request=request_list)
-        
-        for doc in page_result:
-            if (hasattr(doc, 'content') and doc.content.uri == gcs_uri) or (hasattr(doc, 'uri') and doc.uri == gcs_uri):
-                app.logger.info(f"Document '{gcs_uri}' found in index.")
-                return jsonify({"status": "INDEXED"}), 200
-        
-        return jsonify({"status": "PROCESSING"}), 202
+        status = index_status(gcs_uri)
+        if status["status"] == "INDEXED":
+            app.logger.info(f"Document '{gcs_uri}' found in index.")
+            return jsonify(status), 200
+        if status["status"] == "FAILED":
+            return jsonify(status), 200
+        return jsonify(status), 202
 
+    except CircuitOpen as e:
+        return jsonify({"status": "UNKNOWN", **unavailable_body(e)}), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         app.logger.error(f"Error checking document status for '{gcs_uri}': {e}")
         return jsonify({"status": "FAILED", "details": str(e)}), 500
 
 
+@app.route("/events/file_status", methods=["GET"])
+def file_status_events():
+    """Streams index status changes of a document as Server-Sent Events.
+
+    Sends a `status` event right away and on every change, and ends after a
+    terminal status (INDEXED, FAILED) or with a `timeout` event, after which
+    EventSource reconnects by itself.
+    """
+    gcs_uri = request.args.get("gcs_uri")
+    if not gcs_uri:
+        return jsonify({"error": "Missing 'gcs_uri' query parameter."}), 400
+    if not index_status_configured():
+        return jsonify({"error": "Server misconfiguration, missing environment variables."}), 500
+
+    def events():
+        subscription = status_bus.subscribe(gcs_uri)
+
+        def current_status():
+            try:
+                return index_status(gcs_uri)
+            except CircuitOpen:
+                # Data store unreachable: keep waiting for the indexer's reports instead of failing
+                return last_status or {"status": "PROCESSING"}
+
+        try:
+            deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+            last_status = None
+            status = current_status()
+            while True:
+                if status != last_status:
+                    yield sse_event("status", status)
+                    last_status = status
+                if status["status"] in TERMINAL_STATUSES:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    yield sse_event("timeout", {})
+                    return
+                try:
+                    status = subscription.get(timeout=min(STATUS_STREAM_RECHECK, remaining))
+                except queue.Empty:
+                    # Reports may have reached another worker; fall back to the (cached) lookup
+                    status = current_status()
+                    yield ": keep-alive\n\n"
+        except Exception as e:
+            app.logger.error(f"Error streaming document status for '{gcs_uri}': {e}")
+            yield sse_event("error", {"status": "FAILED", "details": str(e)})
+        finally:
+            status_bus.unsubscribe(gcs_uri, subscription)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/internal/index_status", methods=["POST"])
+def report_index_status():
+    """Receives import outcomes from the indexer service and notifies subscribers.
+
+    Body: {"results": [{"gcs_uri": ..., "status": "INDEXED" | "FAILED" | "PROCESSING", "details": ...}]}
+    """
+    if not STATUS_CALLBACK_TOKEN:
+        return jsonify({"error": "Status reports are disabled: STATUS_CALLBACK_TOKEN is not configured."}), 503
+    if not hmac.compare_digest(request.headers.get("X-Status-Token", ""), STATUS_CALLBACK_TOKEN):
+        return jsonify({"error": "Forbidden"}), 403
+
+    data = request.get_json(silent=True) or {}
+    results = data.get("results")
+    if not isinstance(results, list):
+        return jsonify({"error": "Missing 'results' list in the request body."}), 400
+
+    delivered = 0
+    for result in results:
+        gcs_uri = result.get("gcs_uri")
+        status = result.get("status")
+        if not gcs_uri or status not in ("INDEXED", "FAILED", "PROCESSING"):
+            continue
+        set_index_status(gcs_uri, status, result.get("details"))
+        delivered += 1
+        if status == "INDEXED" and PRECOMPUTE_ANALYSES and retrieval_configured() and analysis_cache is not None:
+            precompute_queue.submit(precompute_analysis, gcs_uri)
+
+    app.logger.info(f"Received {delivered} index status report(s).")
+    return jsonify({"accepted": delivered}), 200
+
+
+def verify_push_request():
+    """Returns None if the request carries a valid Pub/Sub push credential, else an error response."""
+    if GCS_EVENTS_AUDIENCE:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return jsonify({"error": "Forbidden"}), 403
+        try:
+            claims = google.oauth2.id_token.verify_oauth2_token(
+                token, google.auth.transport.requests.Request(), audience=GCS_EVENTS_AUDIENCE
+            )
+        except ValueError as e:
+            app.logger.warning(f"Rejected push request with an invalid OIDC token: {e}")
+            return jsonify({"error": "Forbidden"}), 403
+        except google.auth.exceptions.TransportError as e:
+            # Google's signing keys couldn't be fetched; Pub/Sub redelivers the message
+            app.logger.error(f"Could not verify push request: {e}")
+            return jsonify({"error": "Could not verify the request.", "details": str(e)}), 503
+        if GCS_EVENTS_SERVICE_ACCOUNT and (
+            claims.get("email") != GCS_EVENTS_SERVICE_ACCOUNT or not claims.get("email_verified")
+        ):
+            return jsonify({"error": "Forbidden"}), 403
+        return None
+    if GCS_EVENTS_TOKEN:
+        if not hmac.compare_digest(request.args.get("token", ""), GCS_EVENTS_TOKEN):
+            return jsonify({"error": "Forbidden"}), 403
+        return None
+    return jsonify({"error": "GCS events are disabled: no push authentication is configured."}), 503
+
+@app.route("/internal/gcs_events", methods=["POST"])
+def gcs_events():
+    """Pub/Sub push endpoint for the bucket's object notifications; keeps the file catalog current."""
+    rejected = verify_push_request()
+    if rejected is not None:
+        return rejected
+
+    envelope = request.get_json(silent=True) or {}
+    message = envelope.get("message")
+    if not message or "data" not in message:
+        return jsonify({"error": "Invalid Pub/Sub message format."}), 400
+
+    try:
+        data = json.loads(base64.b64decode(message["data"]).decode("utf-8"))
+    except Exception as e:
+        return jsonify({"error": "Invalid message data.", "details": str(e)}), 400
+
+    attributes = message.get("attributes", {})
+    event_type = attributes.get("eventType")
+    name = data.get("name")
+    if not name or data.get("bucket", GCS_BUCKET_NAME) != GCS_BUCKET_NAME:
+        return "", 204
+
+    if event_type == "OBJECT_FINALIZE":
+        size = int(data["size"]) if data.get("size") else None
+        file_catalog.add(name, size, data.get("updated"), metadata=data.get("metadata"), generation=data.get("generation"))
+        queue_local_indexing(name)
+    elif event_type in ("OBJECT_DELETE", "OBJECT_ARCHIVE") and "overwrittenByGeneration" not in attributes:
+        # Overwrites also emit a delete for the old generation; those keep the file listed
+        file_catalog.remove(name)
+        if local_retriever is not None:
+            local_retriever.remove_document(f"gs://{GCS_BUCKET_NAME}/{name}")
+    return "", 204
+
+
 if __name__ == "__main__":
     app.logger.info("Starting AI Study Companion...")
     app.logger.info(f"Project ID: {PROJECT_ID}")
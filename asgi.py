@@ -0,0 +1,372 @@
+import asyncio
+import json
+import logging
+import time
+
+from a2wsgi import WSGIMiddleware
+from google.api_core import exceptions
+from google.cloud import discoveryengine_v1 as discoveryengine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as wsgi
+import metrics
+import tracing
+from clients import registry
+from singleflight import AsyncSingleFlight
+
+# ASGI entry point (SERVER_MODE=asgi): the routes that mostly wait on the model
+# or the data store run natively async, so one worker can hold many of them
+# open without a thread each. Everything else is served by the Flask app.
+
+logger = logging.getLogger(__name__)
+
+# --- Shared Clients ---
+registry.register(
+    "documents_async",
+    lambda: discoveryengine.DocumentServiceAsyncClient(client_options=wsgi.document_client_options())
+)
+
+analysis_flight = AsyncSingleFlight()
+status_flight = AsyncSingleFlight()
+
+
+# --- Helpers ---
+async def cached_analysis(cache_key):
+    # Cache backends do blocking file/GCS I/O
+    if not cache_key:
+        return None
+    return await asyncio.to_thread(wsgi.analysis_cache.get, cache_key)
+
+async def generate_analysis(file_path, file_name):
+    """Async counterpart of app.generate_analysis."""
+    model = registry.get("model")
+    prompt, used_sources = await asyncio.to_thread(wsgi.analysis_prompt, file_path, file_name)
+
+    async def attempt(timeout):
+        # Shares the worker's limiter with the WSGI routes
+        async with wsgi.model_limiter.async_slot(), wsgi.model_breaker.async_guard():
+            with metrics.observe_upstream("model", "generate_content"):
+                return await model.generate_content_async(prompt)
+
+    with tracing.span("generate", model=wsgi.MODEL_NAME) as span:
+        response = await wsgi.model_retry.call_async(attempt)
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            span.set(prompt_tokens=usage.prompt_token_count, candidates_tokens=usage.candidates_token_count)
+    metrics.record_token_usage(response)
+    with tracing.span("parse") as span:
+        result = wsgi.parse_analysis_response(response)
+        if used_sources:
+            result["used_sources"] = used_sources
+        span.set(sources=len(result["used_sources"]))
+    return result
+
+async def run_analysis(file_path, file_name, cache_key):
+    """Generates (and caches) an analysis, coalescing identical requests in this worker."""
+    async def compute():
+        result = await generate_analysis(file_path, file_name)
+        if cache_key:
+            await asyncio.to_thread(wsgi.analysis_cache.set, cache_key, result)
+        return result
+
+    with tracing.span("analysis") as span:
+        result, coalesced = await analysis_flight.do(cache_key or file_path, compute)
+        span.set(coalesced=coalesced)
+    return result, coalesced
+
+async def lookup_index_status(gcs_uri):
+    """Async counterpart of app.lookup_index_status."""
+    if wsgi.local_retriever is not None:
+        return await asyncio.to_thread(wsgi.lookup_index_status, gcs_uri)
+
+    recorded = await asyncio.to_thread(wsgi.recorded_index_status, gcs_uri)
+    if recorded is not None and recorded["status"] in wsgi.TERMINAL_STATUSES:
+        return recorded
+
+    name = f"{wsgi.documents_parent()}/documents/{wsgi.document_id_for_uri(gcs_uri)}"
+    try:
+        async def attempt(timeout):
+            async with wsgi.datastore_breaker.async_guard():
+                with metrics.observe_upstream("datastore", "get_document"):
+                    return await registry.get("documents_async").get_document(name=name, timeout=timeout)
+
+        await wsgi.documents_retry.call_async(attempt)
+        return {"status": "INDEXED"}
+    except exceptions.NotFound:
+        return {"status": "PROCESSING"}
+
+async def index_status(gcs_uri):
+    # The status cache is in memory, so reading it inline doesn't block the loop
+    with tracing.span("status_cache") as span:
+        cached = wsgi.status_cache.get(gcs_uri)
+        span.set(hit=cached is not None)
+    if cached is not None:
+        return cached
+
+    async def lookup():
+        status = await lookup_index_status(gcs_uri)
+        wsgi.status_cache.set(gcs_uri, status)
+        return status
+
+    status, _ = await status_flight.do(gcs_uri, lookup)
+    return status
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except json.JSONDecodeError:
+        return {}
+
+def instrumented(route, handler):
+    """Records the request metrics and trace the Flask hooks record for the mounted routes."""
+    async def endpoint(request):
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        started = time.monotonic()
+        status = 500
+        root, token = wsgi.tracer.start(
+            f"{request.method} {route}", traceparent=request.headers.get("traceparent"),
+            **{"http.target": request.url.path}
+        )
+        try:
+            response = await handler(request)
+            status = response.status_code
+            root.set(**{"http.status_code": status})
+        except BaseException as e:
+            root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            wsgi.tracer.finish(root, token)
+            metrics.REQUESTS_IN_FLIGHT.dec()
+            metrics.REQUESTS.labels(request.method, route, status).inc()
+            metrics.REQUEST_LATENCY.labels(request.method, route).observe(time.monotonic() - started)
+        if wsgi.SERVER_TIMING:
+            response.headers["Server-Timing"] = wsgi.tracer.server_timing(root)
+        return response
+    return endpoint
+
+
+# --- Routes ---
+async def analyze_script(request):
+    """Analyzes a specific document from the data store."""
+    if not wsgi.retrieval_configured():
+        return JSONResponse({"error": "Server misconfiguration: Analysis tool not available."}, status_code=500)
+
+    data = await read_json(request)
+    file_path = data.get("file_path")
+
+    if not file_path:
+        return JSONResponse({"error": "Missing 'file_path' in the request body."}, status_code=400)
+
+    logger.info(f"Received analysis request for: {file_path}")
+    file_name = file_path.split("/")[-1]
+
+    try:
+        cache_key = await asyncio.to_thread(wsgi.analysis_cache_key, file_path)
+        with tracing.span("cache_lookup") as span:
+            cached = await cached_analysis(cache_key)
+            span.set(hit=cached is not None)
+        if cached is not None:
+            logger.info(f"Cache hit for '{file_name}'.")
+            return JSONResponse({**cached, "cache": "HIT"}, headers={"X-Cache": "HIT"})
+
+        if data.get("async"):
+            priority = wsgi.PRIORITIES.get(data.get("priority", "normal"))
+            if priority is None:
+                return JSONResponse({"error": f"'priority' must be one of {', '.join(wsgi.PRIORITIES)}."}, status_code=400)
+            job, _ = await asyncio.to_thread(
+                wsgi.analysis_jobs.submit, "analysis", {"file_path": file_path},
+                priority=priority, key=cache_key or file_path
+            )
+            return JSONResponse(
+                {**wsgi.job_view(job), "status_url": f"/jobs/{job['id']}"},
+                status_code=202, headers={"Location": f"/jobs/{job['id']}"}
+            )
+
+        try:
+            with wsgi.interactive_analyses:
+                result, coalesced = await run_analysis(file_path, file_name, cache_key)
+        except wsgi.AnalysisUnavailable as e:
+            return JSONResponse({"error": e.error, "details": e.details}, status_code=404)
+        except (wsgi.Overloaded, wsgi.CircuitOpen) as e:
+            logger.warning(f"Shedding analysis of '{file_name}': {e}")
+            return JSONResponse(wsgi.unavailable_body(e), status_code=503, headers={"Retry-After": str(e.retry_after)})
+
+        logger.info(f"Successfully analyzed '{file_name}' (coalesced: {coalesced}).")
+        cache_status = "MISS" if cache_key else "BYPASS"
+        return JSONResponse(
+            {**result, "cache": cache_status, "coalesced": coalesced},
+            headers={"X-Cache": cache_status}
+        )
+
+    except Exception as e:
+        logger.error(f"Error during analysis for {file_name}: {e}")
+        return JSONResponse({"error": "Internal server error during analysis.", "details": str(e)}, status_code=500)
+
+
+async def analyze_script_stream(request):
+    """Streams the analysis of a document as Server-Sent Events (same events as the Flask route)."""
+    if not wsgi.retrieval_configured():
+        return JSONResponse({"error": "Server misconfiguration: Analysis tool not available."}, status_code=500)
+
+    file_path = request.query_params.get("file_path")
+    if not file_path:
+        return JSONResponse({"error": "Missing 'file_path' query parameter."}, status_code=400)
+
+    logger.info(f"Received streaming analysis request for: {file_path}")
+    file_name = file_path.split("/")[-1]
+
+    async def events():
+        try:
+            cache_key = await asyncio.to_thread(wsgi.analysis_cache_key, file_path)
+            cached = await cached_analysis(cache_key)
+            if cached is not None:
+                logger.info(f"Cache hit for '{file_name}'.")
+                yield wsgi.sse_event("chunk", {"text": cached["analysis_result"]})
+                yield wsgi.sse_event("sources", {"used_sources": cached["used_sources"], "cache": "HIT"})
+                yield wsgi.sse_event("done", {})
+                return
+
+            async def produce():
+                prompt, prompt_sources = await asyncio.to_thread(wsgi.analysis_prompt, file_path, file_name)
+                parts = []
+                used_sources = list(prompt_sources)
+                response = None
+                with metrics.observe_upstream("model", "generate_content_stream"):
+                    model = registry.get("model")
+                    async with wsgi.model_limiter.async_slot():
+                        async with wsgi.model_breaker.async_guard():
+                            responses = await model.generate_content_async(prompt, stream=True)
+                        async for response in responses:
+                            text, sources = wsgi.parse_stream_chunk(response)
+                            used_sources.extend(sources)
+                            if text:
+                                parts.append(text)
+                                yield "chunk", text
+
+                metrics.record_token_usage(response)
+                if not "".join(parts).strip():
+                    raise wsgi.AnalysisUnavailable(*wsgi.NOT_YET_INDEXED)
+                used_sources = list(set(used_sources))
+                if cache_key:
+                    await asyncio.to_thread(
+                        wsgi.analysis_cache.set, cache_key,
+                        {"analysis_result": "".join(parts), "used_sources": used_sources}
+                    )
+                yield "sources", {"used_sources": used_sources, "cache": "MISS" if cache_key else "BYPASS"}
+
+            # Identical streams share one model call; a late stream first gets the chunks already produced
+            with wsgi.interactive_analyses:
+                items, coalesced = analysis_flight.stream(cache_key or file_path, produce)
+                async for kind, payload in items:
+                    if kind == "chunk":
+                        yield wsgi.sse_event("chunk", {"text": payload})
+                    else:
+                        yield wsgi.sse_event("sources", {**payload, "coalesced": coalesced})
+
+            logger.info(f"Successfully streamed analysis for '{file_name}' (coalesced: {coalesced}).")
+            yield wsgi.sse_event("done", {})
+        except wsgi.AnalysisUnavailable as e:
+            yield wsgi.sse_event("error", {"error": e.error, "details": e.details})
+        except (wsgi.Overloaded, wsgi.CircuitOpen) as e:
+            logger.warning(f"Shedding streaming analysis of '{file_name}': {e}")
+            yield wsgi.sse_event("error", wsgi.unavailable_body(e))
+        except Exception as e:
+            logger.error(f"Error during streaming analysis for {file_name}: {e}")
+            yield wsgi.sse_event("error", {"error": "Internal server error during analysis.", "details": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Keep proxies (and Cloud Run's frontend) from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def check_file_status(request):
+    """Checks if a document has been indexed in the data store."""
+    data = await read_json(request)
+    gcs_uri = data.get("gcs_uri")
+
+    if not gcs_uri or not wsgi.index_status_configured():
+        return JSONResponse({"error": "Server misconfiguration, missing environment variables."}, status_code=500)
+
+    try:
+        status = await index_status(gcs_uri)
+        if status["status"] == "INDEXED":
+            logger.info(f"Document '{gcs_uri}' found in index.")
+        return JSONResponse(status, status_code=202 if status["status"] not in wsgi.TERMINAL_STATUSES else 200)
+
+    except wsgi.CircuitOpen as e:
+        return JSONResponse(
+            {"status": "UNKNOWN", **wsgi.unavailable_body(e)}, status_code=503,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except Exception as e:
+        logger.error(f"Error checking document status for '{gcs_uri}': {e}")
+        return JSONResponse({"status": "FAILED", "details": str(e)}, status_code=500)
+
+
+async def file_status_events(request):
+    """Streams index status changes of a document as Server-Sent Events (same events as the Flask route).
+
+    Native here, so a long-lived stream holds no thread of the WSGI pool.
+    """
+    gcs_uri = request.query_params.get("gcs_uri")
+    if not gcs_uri:
+        return JSONResponse({"error": "Missing 'gcs_uri' query parameter."}, status_code=400)
+    if not wsgi.index_status_configured():
+        return JSONResponse({"error": "Server misconfiguration, missing environment variables."}, status_code=500)
+
+    async def events():
+        subscription = wsgi.status_bus.subscribe_async(gcs_uri)
+        last_status = None
+
+        async def current_status():
+            try:
+                return await index_status(gcs_uri)
+            except wsgi.CircuitOpen:
+                # Data store unreachable: keep waiting for the indexer's reports instead of failing
+                return last_status or {"status": "PROCESSING"}
+
+        try:
+            deadline = time.monotonic() + wsgi.STATUS_STREAM_MAX_SECONDS
+            status = await current_status()
+            while True:
+                if status != last_status:
+                    yield wsgi.sse_event("status", status)
+                    last_status = status
+                if status["status"] in wsgi.TERMINAL_STATUSES:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    yield wsgi.sse_event("timeout", {})
+                    return
+                try:
+                    status = await subscription.get(timeout=min(wsgi.STATUS_STREAM_RECHECK, remaining))
+                except asyncio.TimeoutError:
+                    # Reports may have reached another worker; fall back to the (cached) lookup
+                    status = await current_status()
+                    yield ": keep-alive\n\n"
+        except Exception as e:
+            logger.error(f"Error streaming document status for '{gcs_uri}': {e}")
+            yield wsgi.sse_event("error", {"status": "FAILED", "details": str(e)})
+        finally:
+            wsgi.status_bus.unsubscribe(gcs_uri, subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+app = Starlette(routes=[
+    Route("/analyze", instrumented("/analyze", analyze_script), methods=["POST"]),
+    Route("/analyze/stream", instrumented("/analyze/stream", analyze_script_stream), methods=["GET"]),
+    Route("/check_file_status", instrumented("/check_file_status", check_file_status), methods=["POST"]),
+    Route("/events/file_status", instrumented("/events/file_status", file_status_events), methods=["GET"]),
+    # Uploads, listing and the remaining routes run in a2wsgi's thread pool
+    Mount("/", app=WSGIMiddleware(wsgi.app, workers=32)),
+])
@@ -0,0 +1,81 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightCounter:
+    """Thread-safe gauge of concurrently running operations, used as a context manager."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self._value += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self._value -= 1
+        return False
+
+    @property
+    def value(self):
+        with self._lock:
+            return self._value
+
+
+class BackgroundQueue:
+    """Small, bounded worker pool for best-effort work.
+
+    At most `workers` tasks run at once and at most `max_pending` wait;
+    `submit` drops tasks beyond that. Before starting a task, workers wait
+    while `should_pause()` is true so background work yields to requests.
+    """
+
+    def __init__(self, name, workers=1, max_pending=100, should_pause=None, pause_interval=1.0):
+        self.name = name
+        self.workers = workers
+        self.should_pause = should_pause
+        self.pause_interval = pause_interval
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Queues fn(*args); returns False if the queue is full."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((fn, args))
+            return True
+        except queue.Full:
+            logger.warning(f"{self.name}: queue full, dropping task.")
+            return False
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        # Lazily, so threads live in the gunicorn worker rather than the master
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            while self.should_pause is not None and self.should_pause():
+                time.sleep(self.pause_interval)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"{self.name}: task failed: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,62 @@
+"""End-to-end check of the chunked upload path over real HTTP.
+
+    python -m bench.check_uploads
+
+The app's test client uploads a PDF in chunks to /upload/sessions; the app
+forwards every chunk over a socket to the fakes' resumable upload server
+(bench.fakes.FakeUploadServer), which rejects anything but a plain
+Content-Length body, as GCS effectively does. The scenarios of bench.run never
+reach this path, since they don't leave the process. Exits non-zero on failure.
+"""
+import hashlib
+import os
+import sys
+
+from bench import harness
+from bench.fakes import FakeCloud, lecture_pdf
+
+CHUNK_SIZE = 256 * 1024
+
+
+def check(condition, message):
+    print(f"{'ok  ' if condition else 'FAIL'} {message}")
+    return condition
+
+
+def main():
+    cloud = FakeCloud()
+    os.environ.setdefault("UPLOAD_SESSION_SECRET", "bench-secret")
+    os.environ.setdefault("UPLOAD_CHUNK_SIZE", str(CHUNK_SIZE))
+    os.environ["STORAGE_EMULATOR_HOST"] = cloud.upload_server().url
+    app = harness.load_app(cloud)
+    client = app.app.test_client()
+
+    # A little over three chunks, so there are full chunks, a short last one and a resume
+    data = lecture_pdf("chunked-upload.pdf", pages=40).ljust(3 * CHUNK_SIZE + 1000, b"\n")
+    created = client.post("/upload/sessions", json={"filename": "chunked-upload.pdf", "size": len(data)})
+    if not check(created.status_code == 201, f"session created ({created.status_code} {created.get_json()})"):
+        return 1
+    session = created.get_json()
+    url = f"/upload/sessions/{session['upload_id']}"
+
+    ok = True
+    offset = 0
+    while offset < len(data):
+        end = min(offset + session["chunk_size"], len(data)) - 1
+        response = client.put(url, data=data[offset:end + 1], headers={"Content-Range": f"bytes {offset}-{end}/{len(data)}"})
+        body = response.get_json()
+        if not check(response.status_code in (200, 201), f"chunk {offset}-{end} forwarded ({response.status_code} {body})"):
+            return 1
+        if offset == 0:
+            status = client.get(url).get_json()
+            ok &= check(status.get("next_offset") == end + 1, f"session reports the committed offset ({status})")
+        offset = len(data) if response.status_code == 201 else body["next_offset"]
+
+    stored = cloud.objects(harness.BUCKET).get("chunked-upload.pdf")
+    ok &= check(stored is not None and stored.md5_hash == hashlib.md5(data).hexdigest(), "object stored with the uploaded bytes")
+    ok &= check(stored is not None and stored.content_type == "application/pdf", "object stored as application/pdf")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,552 @@
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from google.api_core import exceptions
+
+# Local stand-ins for storage.Client, GenerativeModel and the Discovery Engine
+# DocumentService(Async)Client. They implement only what the app and the
+# indexer call, share one FakeCloud (so an import by the indexer makes a
+# document "indexed" for the app), and sleep per call to simulate latency.
+
+_Z_99 = 2.3263  # standard normal quantile of 0.99
+
+
+class Latency:
+    """Log-normal call latency given by its median and p99 (seconds)."""
+
+    def __init__(self, median=0.0, p99=None):
+        self.median = median
+        self.p99 = p99 if p99 is not None else median
+        self._sigma = math.log(self.p99 / median) / _Z_99 if median > 0 and self.p99 > median else 0.0
+
+    @classmethod
+    def parse(cls, spec):
+        """"0.05" (fixed) or "0.05:0.4" (median:p99)."""
+        median, _, p99 = spec.partition(":")
+        return cls(float(median), float(p99) if p99 else None)
+
+    def sample(self):
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(self._sigma * random.gauss(0, 1))
+
+    def __repr__(self):
+        return f"{self.median}:{self.p99}"
+
+
+class Upstream:
+    """Latency and error rate of one fake service."""
+
+    def __init__(self, name, latency=None, error_rate=0.0):
+        self.name = name
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        with self._lock:
+            self.calls += 1
+        if self.error_rate and random.random() < self.error_rate:
+            # Transient, so the app's retry policies and breakers get exercised
+            return self.latency.sample(), exceptions.ServiceUnavailable(f"fake {self.name} error")
+        return self.latency.sample(), None
+
+    def wait(self):
+        delay, error = self._delay()
+        time.sleep(delay)
+        if error is not None:
+            raise error
+
+    async def wait_async(self):
+        delay, error = self._delay()
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+
+
+class FakeCloud:
+    """Shared state of the fakes: bucket objects and the data store's indexed documents.
+
+    With `state_dir`, documents indexed after seeding are recorded as files
+    there, so the workers of a gunicorn server agree on them. `auto_index`
+    stands in for the indexer: an uploaded PDF becomes indexed
+    `index_latency` after it was written.
+    """
+
+    def __init__(self, storage=None, model=None, datastore=None, index_latency=None, state_dir=None, auto_index=False):
+        self.storage = storage or Upstream("storage")
+        self.model = model or Upstream("model")
+        self.datastore = datastore or Upstream("datastore")
+        # How long an import operation takes until its documents are indexed
+        self.index_latency = index_latency or Latency()
+        self.state_dir = state_dir
+        self.auto_index = auto_index
+        self.buckets = {}
+        self.indexed = set()
+        self._lock = threading.Lock()
+        self._upload_server = None
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def objects(self, bucket_name):
+        with self._lock:
+            return self.buckets.setdefault(bucket_name, {})
+
+    def seed(self, bucket_name, documents, indexed_fraction=1.0, size=2 * 1024 * 1024, prefix="lecture-"):
+        """Adds `documents` PDFs to a bucket and marks `indexed_fraction` of them as indexed."""
+        names = [f"{prefix}{i:05d}.pdf" for i in range(documents)]
+        objects = self.objects(bucket_name)
+        for i, name in enumerate(names):
+            objects[name] = _Object(name, size, content_hash=hashlib.md5(name.encode("utf-8")).hexdigest())
+            if i < documents * indexed_fraction:
+                self.indexed.add(document_id(f"gs://{bucket_name}/{name}"))
+        return names
+
+    def upload_server(self):
+        """The local HTTP endpoint for resumable upload sessions, started on first use."""
+        with self._lock:
+            if self._upload_server is None:
+                self._upload_server = FakeUploadServer(self)
+            return self._upload_server
+
+    def mark_indexed(self, doc_ids, ready_at=None):
+        """Marks documents as indexed, from `ready_at` (epoch seconds) on if given."""
+        if not self.state_dir:
+            if ready_at is None:
+                self.indexed.update(doc_ids)
+            else:
+                timer = threading.Timer(max(0.0, ready_at - time.time()), self.indexed.update, [list(doc_ids)])
+                timer.daemon = True
+                timer.start()
+            return
+        for doc_id in doc_ids:
+            with open(os.path.join(self.state_dir, doc_id), "w") as f:
+                f.write(str(ready_at or time.time()))
+
+    def is_indexed_id(self, doc_id):
+        if doc_id in self.indexed:
+            return True
+        if not self.state_dir:
+            return False
+        try:
+            with open(os.path.join(self.state_dir, doc_id)) as f:
+                return float(f.read() or 0) <= time.time()
+        except (OSError, ValueError):
+            return False
+
+    def is_indexed(self, gcs_uri):
+        return self.is_indexed_id(document_id(gcs_uri))
+
+    def indexed_name(self, file_name):
+        """True if some indexed document has this file name (what grounding would find)."""
+        return any(self.is_indexed(f"gs://{bucket}/{file_name}") for bucket in list(self.buckets))
+
+
+def document_id(gcs_uri):
+    # Same derivation as app.document_id_for_uri
+    return hashlib.sha256(gcs_uri.encode("utf-8")).hexdigest()[:32]
+
+
+# --- Cloud Storage ---
+_TOPICS = (
+    "Lineare Algebra", "Wahrscheinlichkeit", "Algorithmen", "Datenbanken", "Netzwerke", "Compilerbau",
+    "Betriebssysteme", "Statistik", "Optimierung", "Kryptographie", "Signalverarbeitung", "Logik",
+)
+
+
+def lecture_pdf(name, pages=8, lines=30):
+    """A small, valid PDF with a text layer, standing in for the lecture `name` (same name, same text)."""
+    rng = random.Random(name)
+    topics = rng.sample(_TOPICS, 3)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        text = [f"{rng.choice(topics)} Teil {page + 1}: " + " ".join(rng.choice(topics).lower() + f"-{rng.randint(1, 40)}"
+                                                                    for _ in range(8)) for _ in range(lines)]
+        stream = "BT /F1 10 Tf 12 TL 50 780 Td " + " ".join(f"({line}) '" for line in text) + " ET"
+        stream = stream.encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents %d 0 R >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), pages)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+class _Object:
+    def __init__(self, name, size, content_hash, metadata=None, content_type="application/pdf", data=None):
+        self.name = name
+        self.size = size
+        self.md5_hash = content_hash
+        self.metadata = metadata
+        self.content_type = content_type
+        self.data = data
+        self.updated = datetime.datetime.now(datetime.timezone.utc)
+        self.generation = time.time_ns()
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, stored=None):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.size = None
+        self.updated = None
+        self.md5_hash = None
+        self.crc32c = None
+        self.generation = None
+        self.content_type = None
+        if stored is not None:
+            self._load(stored)
+
+    def _load(self, stored):
+        self.metadata = dict(stored.metadata) if stored.metadata else None
+        self.size = stored.size
+        self.updated = stored.updated
+        self.md5_hash = stored.md5_hash
+        self.generation = stored.generation
+        self.content_type = stored.content_type
+
+    def _check_generation(self, if_generation_match):
+        # Like GCS preconditions: 0 means "doesn't exist yet"; call with the cloud's lock held
+        if if_generation_match is None:
+            return
+        stored = self.bucket._objects.get(self.name)
+        if (stored.generation if stored is not None else 0) != if_generation_match:
+            raise exceptions.PreconditionFailed(f"Generation of {self.bucket.name}/{self.name} doesn't match.")
+
+    def _store(self, data, content_type, if_generation_match=None):
+        # Only small objects (cache entries, records) keep their bytes; PDFs just their size
+        stored = _Object(
+            self.name, len(data), hashlib.md5(data).hexdigest(), metadata=self.metadata,
+            content_type=content_type, data=data if len(data) <= 64 * 1024 else None
+        )
+        with self.bucket.cloud._lock:
+            self._check_generation(if_generation_match)
+            self.bucket._objects[self.name] = stored
+        self._load(stored)
+        cloud = self.bucket.cloud
+        if cloud.auto_index and self.name.lower().endswith(".pdf") and not (self.metadata or {}).get("alias_of"):
+            cloud.mark_indexed([document_id(f"gs://{self.bucket.name}/{self.name}")],
+                               ready_at=time.time() + cloud.index_latency.sample())
+
+    def upload_from_file(self, file_obj, content_type=None, if_generation_match=None, **kwargs):
+        self.bucket.cloud.storage.wait()
+        # Like the SDK: without an explicit type, objects are stored as octet-stream
+        self._store(file_obj.read(), content_type or self.content_type or "application/octet-stream", if_generation_match)
+
+    def upload_from_string(self, data, content_type="text/plain", if_generation_match=None, **kwargs):
+        self.bucket.cloud.storage.wait()
+        self._store(data.encode("utf-8") if isinstance(data, str) else data, content_type, if_generation_match)
+
+    def create_resumable_upload_session(self, content_type=None, size=None, origin=None, **kwargs):
+        self.bucket.cloud.storage.wait()
+        return self.bucket.cloud.upload_server().start(self.bucket.name, self.name, content_type, self.metadata)
+
+    def download_as_bytes(self, if_generation_match=None, **kwargs):
+        self.bucket.cloud.storage.wait()
+        stored = self.bucket._objects.get(self.name)
+        if stored is None:
+            raise exceptions.NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        if if_generation_match is not None and stored.generation != if_generation_match:
+            raise exceptions.PreconditionFailed(f"Generation of {self.bucket.name}/{self.name} doesn't match.")
+        if stored.data is not None:
+            return stored.data
+        # Seeded and large PDFs keep no bytes; local retrieval gets a readable stand-in
+        return lecture_pdf(self.name) if self.name.lower().endswith(".pdf") else b"\0" * stored.size
+
+    def open(self, mode="rb", chunk_size=None, if_generation_match=None, **kwargs):
+        return io.BytesIO(self.download_as_bytes(if_generation_match=if_generation_match))
+
+    def patch(self, **kwargs):
+        self.bucket.cloud.storage.wait()
+        with self.bucket.cloud._lock:
+            stored = self.bucket._objects.get(self.name)
+            if stored is None:
+                raise exceptions.NotFound(f"No such object: {self.bucket.name}/{self.name}")
+            # Metadata-only update: the generation (and the bytes) stay
+            stored.metadata = dict(self.metadata) if self.metadata else None
+
+    def exists(self, **kwargs):
+        self.bucket.cloud.storage.wait()
+        return self.name in self.bucket._objects
+
+    def delete(self, if_generation_match=None, **kwargs):
+        self.bucket.cloud.storage.wait()
+        with self.bucket.cloud._lock:
+            if self.name not in self.bucket._objects:
+                raise exceptions.NotFound(f"No such object: {self.bucket.name}/{self.name}")
+            self._check_generation(if_generation_match)
+            del self.bucket._objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self, cloud, name):
+        self.cloud = cloud
+        self.name = name
+        self._objects = cloud.objects(name)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name, timeout=None, **kwargs):
+        self.cloud.storage.wait()
+        stored = self._objects.get(name)
+        return FakeBlob(self, name, stored) if stored is not None else None
+
+    def list_blobs(self, prefix=None, timeout=None, **kwargs):
+        self.cloud.storage.wait()
+        return [FakeBlob(self, name, stored) for name, stored in list(self._objects.items())
+                if prefix is None or name.startswith(prefix)]
+
+
+class FakeStorageClient:
+    def __init__(self, cloud):
+        self.cloud = cloud
+        # The app sends chunks of resumable uploads itself, over real HTTP
+        self._http = requests.Session()
+
+    def bucket(self, name):
+        return FakeBucket(self.cloud, name)
+
+
+class FakeUploadServer:
+    """Local HTTP server speaking GCS's resumable upload protocol (the JSON API's PUT part).
+
+    Chunks arrive over a real socket, so what the HTTP client puts on the wire
+    is checked: like GCS, a Transfer-Encoding header wins over Content-Length,
+    and since the fake only takes plain bodies it rejects those requests.
+    Point STORAGE_EMULATOR_HOST at `url` to have the app send chunks here.
+    """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, name="fake-gcs-uploads", daemon=True).start()
+
+    def start(self, bucket_name, name, content_type, metadata):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[upload_id] = SimpleNamespace(
+                bucket=bucket_name, name=name, content_type=content_type or "application/octet-stream",
+                metadata=metadata, data=bytearray(), resource=None
+            )
+        return f"{self.url}/upload/storage/v1/b/{bucket_name}/o?uploadType=resumable&upload_id={upload_id}"
+
+    def _put(self, upload_id, content_range, body):
+        """(status, headers, json body) for one PUT to a session."""
+        with self._lock:
+            session = self._sessions.get(upload_id)
+        if session is None:
+            return 404, {}, {"error": "No such upload session."}
+        if session.resource is not None:
+            return 200, {}, session.resource
+
+        match = re.match(r"^bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)$", content_range or "")
+        if not match:
+            return 400, {}, {"error": f"Invalid Content-Range: {content_range!r}"}
+        start, end, total = match.groups()
+        if start is not None:
+            start, end = int(start), int(end)
+            if start > len(session.data) or end - start + 1 != len(body):
+                return 400, {}, {"error": "Chunk does not continue the session or doesn't match its range."}
+            del session.data[start:]
+            session.data += body
+
+        if total != "*" and len(session.data) == int(total):
+            blob = FakeBlob(FakeBucket(self.cloud, session.bucket), session.name)
+            blob.metadata = session.metadata
+            blob._store(bytes(session.data), session.content_type)
+            session.resource = {
+                "bucket": session.bucket, "name": session.name, "size": str(blob.size),
+                "generation": str(blob.generation), "updated": blob.updated.isoformat(),
+                "contentType": blob.content_type, "metadata": blob.metadata
+            }
+            return 200, {}, session.resource
+        headers = {"Range": f"bytes=0-{len(session.data) - 1}"} if session.data else {}
+        return 308, headers, None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                server.cloud.storage.wait()
+                if "Transfer-Encoding" in self.headers:
+                    self._reply(400, {}, {"error": f"Unexpected Transfer-Encoding: {self.headers['Transfer-Encoding']}"})
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                upload_id = parse_qs(urlparse(self.path).query).get("upload_id", [""])[0]
+                self._reply(*server._put(upload_id, self.headers.get("Content-Range"), body))
+
+            def _reply(self, status, headers, payload):
+                data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# --- Vertex AI ---
+_FILE_NAME = re.compile(r"'([^']+)'")
+
+
+class FakeModel:
+    """Answers like a grounded GenerativeModel: text for indexed documents, nothing otherwise."""
+
+    def __init__(self, cloud, answer_chars=4000, stream_chunks=8):
+        self.cloud = cloud
+        self.answer_chars = answer_chars
+        self.stream_chunks = stream_chunks
+
+    def _answer(self, prompt):
+        match = _FILE_NAME.search(prompt)
+        file_name = match.group(1) if match else ""
+        if not self.cloud.indexed_name(file_name):
+            return "", []
+        text = (f"## Zusammenfassung von {file_name}\n" + "Lorem ipsum dolor sit amet. " * self.answer_chars)
+        return text[:self.answer_chars], [f"gs://fake/{file_name}"]
+
+    def _responses(self, prompt):
+        text, sources = self._answer(prompt)
+        size = max(1, math.ceil(len(text) / self.stream_chunks)) if text else 1
+        chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        for i, chunk in enumerate(chunks):
+            yield _response(chunk, sources if i == len(chunks) - 1 else [], len(prompt), len(text))
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        if not stream:
+            self.cloud.model.wait()
+            text, sources = self._answer(prompt)
+            return _response(text, sources, len(prompt), len(text))
+
+        def responses():
+            # The latency is spread over the chunks, the error (if any) comes with the first
+            delay, error = self.cloud.model._delay()
+            if error is not None:
+                raise error
+            for response in self._responses(prompt):
+                time.sleep(delay / self.stream_chunks)
+                yield response
+        return responses()
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        if not stream:
+            await self.cloud.model.wait_async()
+            text, sources = self._answer(prompt)
+            return _response(text, sources, len(prompt), len(text))
+
+        delay, error = self.cloud.model._delay()
+        if error is not None:
+            raise error
+
+        async def responses():
+            for response in self._responses(prompt):
+                await asyncio.sleep(delay / self.stream_chunks)
+                yield response
+        return responses()
+
+
+def _response(text, sources, prompt_chars, answer_chars):
+    chunks = [SimpleNamespace(retrieved_context=SimpleNamespace(uri=uri)) for uri in sources]
+    candidate = SimpleNamespace(
+        content=SimpleNamespace(parts=[SimpleNamespace(text=text)] if text else []),
+        finish_reason=1,
+        grounding_metadata=SimpleNamespace(grounding_chunks=chunks) if chunks else None,
+    )
+    # Roughly 4 characters per token
+    usage = SimpleNamespace(
+        prompt_token_count=prompt_chars // 4, candidates_token_count=answer_chars // 4,
+        total_token_count=(prompt_chars + answer_chars) // 4
+    )
+    return SimpleNamespace(candidates=[candidate], usage_metadata=usage)
+
+
+# --- Discovery Engine ---
+class FakeOperation:
+    """Import operation that finishes after the cloud's index latency, marking its documents indexed."""
+
+    _counter = 0
+
+    def __init__(self, cloud, gcs_uris):
+        FakeOperation._counter += 1
+        self.operation = SimpleNamespace(name=f"operations/fake-import-{FakeOperation._counter}")
+        self._cloud = cloud
+        self._uris = list(gcs_uris)
+        self.metadata = SimpleNamespace(success_count=len(self._uris), failure_count=0)
+        self._done_at = time.monotonic() + cloud.index_latency.sample()
+
+    def done(self):
+        if time.monotonic() < self._done_at:
+            return False
+        self._cloud.mark_indexed([document_id(uri) for uri in self._uris])
+        return True
+
+    def exception(self):
+        return None
+
+    def result(self):
+        return SimpleNamespace(error_samples=[])
+
+
+class FakeDocumentService:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_document(self, name, timeout=None, **kwargs):
+        self.cloud.datastore.wait()
+        if not self.cloud.is_indexed_id(name.rsplit("/", 1)[-1]):
+            raise exceptions.NotFound(f"Document {name} not found.")
+        return SimpleNamespace(name=name)
+
+    def import_documents(self, request=None, retry=None, timeout=None, **kwargs):
+        self.cloud.datastore.wait()
+        return FakeOperation(self.cloud, request.gcs_source.input_uris)
+
+
+class FakeDocumentServiceAsync:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    async def get_document(self, name, timeout=None, **kwargs):
+        await self.cloud.datastore.wait_async()
+        if not self.cloud.is_indexed_id(name.rsplit("/", 1)[-1]):
+            raise exceptions.NotFound(f"Document {name} not found.")
+        return SimpleNamespace(name=name)
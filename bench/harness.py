@@ -0,0 +1,342 @@
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from bench.fakes import FakeDocumentService, FakeDocumentServiceAsync, FakeModel, FakeStorageClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEXER_DIR = os.path.join(ROOT, "indexer-service")
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+BUCKET = "bench-bucket"
+
+# Set before the app is imported (it reads its configuration at import time); the
+# process environment wins, so e.g. ANALYSIS_CACHE_BACKEND=disk can be benchmarked too
+APP_ENV = {
+    "PROJECT_ID": "bench-project",
+    "DATA_STORE_LOCATION": "eu",
+    "DATA_STORE_ID": "bench-store",
+    "GCS_BUCKET_NAME": BUCKET,
+    "ANALYSIS_CACHE_BACKEND": "memory",
+    "DEDUP_INDEX_BACKEND": "memory",
+    "JOB_BACKEND": "memory",
+    "SINGLEFLIGHT_LOCK_DIR": "",
+}
+INDEXER_ENV = {
+    "GCP_PROJECT_ID": "bench-project",
+    "DATA_STORE_ID": "bench-store",
+    "IMPORT_BATCH_WINDOW": "0.2",
+}
+# Module names the app and the indexer both use for different files
+_SHARED_MODULE_NAMES = ("metrics", "tracing")
+
+
+def _set_env(defaults):
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+def load_app(cloud, server="wsgi"):
+    """Imports the app with its clients replaced by fakes; returns the app module (or asgi's)."""
+    _set_env(APP_ENV)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    app = importlib.import_module("app")
+    app.registry.override("storage", FakeStorageClient(cloud))
+    app.registry.override("model", FakeModel(cloud))
+    app.registry.override("documents", FakeDocumentService(cloud))
+    if server == "asgi":
+        asgi = importlib.import_module("asgi")
+        app.registry.override("documents_async", FakeDocumentServiceAsync(cloud))
+        return asgi
+    return app
+
+
+def load_indexer(cloud):
+    """Imports the indexer service next to the app, with a fake Discovery Engine client."""
+    _set_env(INDEXER_ENV)
+    # The indexer has its own metrics/tracing modules; import it with those names
+    # free, then put the app's back (the indexer keeps references to its own)
+    saved = {name: sys.modules.pop(name) for name in _SHARED_MODULE_NAMES if name in sys.modules}
+    sys.path.insert(0, INDEXER_DIR)
+    try:
+        indexer = importlib.import_module("indexer")
+    finally:
+        sys.path.remove(INDEXER_DIR)
+        for name in _SHARED_MODULE_NAMES:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+    with indexer._client_lock:
+        indexer._client = FakeDocumentService(cloud)
+    return indexer
+
+
+class Request:
+    """One HTTP request of a scenario; `files` maps a form field to (filename, bytes)."""
+
+    __slots__ = ("method", "path", "json", "files")
+
+    def __init__(self, method, path, json=None, files=None):
+        self.method = method
+        self.path = path
+        self.json = json
+        self.files = files
+
+
+def outcome(status_code, content_type, body):
+    """Status of a response; a Server-Sent Events stream that ended with an error event counts as "sse-error"."""
+    if (content_type or "").startswith("text/event-stream") and b"event: error" in body:
+        return "sse-error"
+    return status_code
+
+
+class WsgiTarget:
+    """Drives a Flask app in-process from a pool of threads (like gunicorn's gthread workers)."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.flask_app.test_client()
+        return client
+
+    def send(self, req):
+        kwargs = {}
+        if req.json is not None:
+            kwargs["json"] = req.json
+        if req.files:
+            kwargs["data"] = {field: (io.BytesIO(data), name) for field, (name, data) in req.files.items()}
+            kwargs["content_type"] = "multipart/form-data"
+        response = self._client().open(req.path, method=req.method, **kwargs)
+        # Reading the body runs a streamed response to its end
+        body = response.get_data()
+        response.close()
+        return outcome(response.status_code, response.content_type, body), response.headers.get("Server-Timing")
+
+    def run(self, requests, concurrency):
+        """Closed loop: `concurrency` threads each send the next request as soon as the last returned."""
+        samples = []
+        lock = threading.Lock()
+        pending = iter(requests)
+
+        def worker():
+            while True:
+                with lock:
+                    req = next(pending, None)
+                if req is None:
+                    return
+                started = time.perf_counter()
+                try:
+                    status, timing = self.send(req)
+                except Exception as e:
+                    status, timing = f"exception: {type(e).__name__}", None
+                sample = (time.perf_counter() - started, status, timing)
+                with lock:
+                    samples.append(sample)
+
+        threads = [threading.Thread(target=worker, name=f"bench-{i}") for i in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return samples, time.perf_counter() - started
+
+
+class AsgiTarget:
+    """Drives the ASGI app in-process with `concurrency` tasks on one event loop (one uvicorn worker)."""
+
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    async def _run(self, requests, concurrency):
+        import httpx
+
+        samples = []
+        pending = iter(requests)
+        transport = httpx.ASGITransport(app=self.asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            async def worker():
+                for req in pending:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.request(
+                            req.method, req.path, json=req.json,
+                            files={field: (name, data) for field, (name, data) in req.files.items()} if req.files else None
+                        )
+                        status = outcome(response.status_code, response.headers.get("content-type"), response.content)
+                        timing = response.headers.get("server-timing")
+                    except Exception as e:
+                        status, timing = f"exception: {type(e).__name__}", None
+                    samples.append((time.perf_counter() - started, status, timing))
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return samples, time.perf_counter() - started
+
+    def run(self, requests, concurrency):
+        return asyncio.run(self._run(requests, concurrency))
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences the per-request logging (retry warnings included) and prints of the app and the indexer."""
+    logging.disable(logging.WARNING)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            yield
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+def rss_mb():
+    """Current resident set size of this process in MiB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def parse_server_timing(header):
+    """{"stage": milliseconds} of a Server-Timing header."""
+    durations = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur" and name:
+                durations[name] = float(value)
+    return durations
+
+
+def summarize(samples, wall_seconds):
+    """Throughput, latency percentiles, status codes and mean stage durations of a run."""
+    latencies = sorted(sample[0] for sample in samples)
+    statuses = {}
+    stages = {}
+    for _, status, timing in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        for name, duration in parse_server_timing(timing).items():
+            stages.setdefault(name, []).append(duration)
+    errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 500)
+    return {
+        "requests": len(samples),
+        "seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(samples) / wall_seconds, 2) if wall_seconds else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+            **{name: round(percentile(latencies, q) * 1000, 2) if latencies else None
+               for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+        },
+        "status_codes": statuses,
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "stages_ms": {name: round(sum(values) / len(values), 2) for name, values in stages.items()},
+    }
+
+
+def run_scenario(target, requests, concurrency, warmup=0):
+    """Runs a scenario (after `warmup` unmeasured requests) and returns its summary with memory use."""
+    requests = list(requests)
+    with quiet():
+        if warmup:
+            target.run(requests[:warmup], concurrency)
+        rss_before = rss_mb()
+        samples, wall = target.run(requests[warmup:], concurrency)
+    summary = summarize(samples, wall)
+    summary["concurrency"] = concurrency
+    summary["memory_mb"] = {
+        "rss_before": round(rss_before, 1),
+        "rss_after": round(rss_mb(), 1),
+        "peak_rss": round(peak_rss_mb(), 1),
+    }
+    return summary
+
+
+def environment():
+    """What the numbers were measured on, for telling comparable results apart."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def save_results(results, path=None):
+    """Writes results as JSON (by default bench/results/<timestamp>.json) and returns the path."""
+    if path is None:
+        path = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return path
+
+
+def compare(current, baseline, tolerance=0.1):
+    """Lines comparing two result sets, and whether any scenario regressed beyond `tolerance`.
+
+    A regression is throughput dropping, or p95/p99 latency or the error
+    rate rising, by more than `tolerance` (relative).
+    """
+    lines = []
+    regressed = False
+    for name, result in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            lines.append(f"{name}: no baseline")
+            continue
+        changes = []
+        for label, now, then, higher_is_better in (
+            ("throughput", result["throughput_rps"], before["throughput_rps"], True),
+            ("p95", result["latency_ms"]["p95"], before["latency_ms"]["p95"], False),
+            ("p99", result["latency_ms"]["p99"], before["latency_ms"]["p99"], False),
+            ("error_rate", result["error_rate"], before["error_rate"], False),
+        ):
+            if not then:
+                changes.append(f"{label} {then} -> {now}")
+                if not higher_is_better and now:
+                    regressed = True
+                continue
+            delta = (now - then) / then
+            worse = -delta if higher_is_better else delta
+            flag = " REGRESSION" if worse > tolerance else ""
+            regressed = regressed or bool(flag)
+            changes.append(f"{label} {then} -> {now} ({delta:+.1%}){flag}")
+        lines.append(f"{name}: " + ", ".join(changes))
+    return lines, regressed
@@ -0,0 +1,164 @@
+"""Offline benchmark of the app and the indexer against local fakes of GCS, Vertex AI and Discovery Engine.
+
+    python -m bench.run                                  # all scenarios, results in bench/results/
+    python -m bench.run --scenarios analyze,files -c 32 --model-latency 1.5:6
+    python -m bench.run --server asgi --compare bench/results/<earlier run>.json
+
+Every upstream call sleeps for a sample of its latency distribution (median:p99,
+log-normal) and fails with a transient error at the given rate, so the numbers
+show the app's own overhead plus how it behaves while waiting on upstreams, not
+the performance of GCP. Compare runs made on the same machine and settings only.
+Needs the packages in bench/requirements.txt.
+"""
+import argparse
+import base64
+import json
+import random
+import sys
+
+from bench import harness
+from bench.fakes import FakeCloud, Latency, Upstream
+
+
+def files_requests(args, names):
+    # Mostly paginated pages, every tenth one the full listing the frontend loads
+    return [
+        harness.Request("GET", "/files" if i % 10 == 0 else f"/files?limit=100&prefix=lecture-{i % 10}")
+        for i in range(args.requests)
+    ]
+
+
+def upload_requests(args, names):
+    size = args.upload_kb * 1024
+    return [
+        # Distinct content per file, so every upload is written rather than deduplicated
+        harness.Request("POST", "/upload", files={"file": (f"upload-{i:06d}.pdf", f"%PDF-{i}".encode().ljust(size, b"\0"))})
+        for i in range(args.requests)
+    ]
+
+
+def analyze_requests(args, names):
+    # Distinct documents, so (until they repeat) every request misses the cache and calls the model
+    indexed = names[:max(1, int(len(names) * args.indexed_fraction))]
+    return [
+        harness.Request("POST", "/analyze", json={"file_path": f"gs://{harness.BUCKET}/{indexed[i % len(indexed)]}"})
+        for i in range(args.requests)
+    ]
+
+
+def analyze_cached_requests(args, names):
+    return [
+        harness.Request("POST", "/analyze", json={"file_path": f"gs://{harness.BUCKET}/{names[0]}"})
+        for _ in range(args.requests)
+    ]
+
+
+def check_file_status_requests(args, names):
+    return [
+        harness.Request("POST", "/check_file_status", json={"gcs_uri": f"gs://{harness.BUCKET}/{random.choice(names)}"})
+        for _ in range(args.requests)
+    ]
+
+
+def indexer_requests(args, names):
+    # Pub/Sub push envelopes of GCS finalize notifications for new PDFs
+    def envelope(i):
+        data = json.dumps({"bucket": harness.BUCKET, "name": f"ingest-{i:06d}.pdf"}).encode("utf-8")
+        return {"message": {"data": base64.b64encode(data).decode("ascii"), "messageId": str(i)}}
+    return [harness.Request("POST", "/", json=envelope(i)) for i in range(args.requests)]
+
+
+# name -> (service, request builder)
+SCENARIOS = {
+    "files": ("app", files_requests),
+    "upload": ("app", upload_requests),
+    "analyze": ("app", analyze_requests),
+    "analyze_cached": ("app", analyze_cached_requests),
+    "check_file_status": ("app", check_file_status_requests),
+    "indexer": ("indexer", indexer_requests),
+}
+
+
+def build_cloud(args):
+    cloud = FakeCloud(
+        storage=Upstream("storage", Latency.parse(args.storage_latency), args.error_rate),
+        model=Upstream("model", Latency.parse(args.model_latency), args.error_rate),
+        datastore=Upstream("datastore", Latency.parse(args.datastore_latency), args.error_rate),
+        index_latency=Latency.parse(args.index_latency),
+    )
+    names = cloud.seed(harness.BUCKET, args.documents, indexed_fraction=args.indexed_fraction)
+    return cloud, names
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--server", choices=("wsgi", "asgi"), default="wsgi",
+                        help="drive the Flask app from threads, or the ASGI app from one event loop")
+    parser.add_argument("-n", "--requests", type=int, default=500, help="measured requests per scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="concurrent clients (closed loop)")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before each scenario")
+    parser.add_argument("--documents", type=int, default=2000, help="PDFs in the bucket / data store")
+    parser.add_argument("--indexed-fraction", type=float, default=0.9, help="share of the PDFs already indexed")
+    parser.add_argument("--upload-kb", type=int, default=512, help="size of each uploaded PDF")
+    parser.add_argument("--model-latency", default="0.3:1.5", help="model call latency, median[:p99] seconds")
+    parser.add_argument("--storage-latency", default="0.02:0.15", help="GCS call latency, median[:p99] seconds")
+    parser.add_argument("--datastore-latency", default="0.03:0.2", help="data store call latency, median[:p99] seconds")
+    parser.add_argument("--index-latency", default="2:10", help="time until an import operation finishes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream calls failing transiently")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for latencies, errors and request mix")
+    parser.add_argument("-o", "--output", help="results file (default: bench/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative change counted as a regression by --compare (exit code 1)")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    return args
+
+
+def print_summary(name, result):
+    latency = result["latency_ms"]
+    print(
+        f"{name:<18} {result['throughput_rps']:>9.1f} req/s  p50 {latency['p50']:>8.1f}  p95 {latency['p95']:>8.1f}  "
+        f"p99 {latency['p99']:>8.1f} ms  errors {result['error_rate']:>6.1%}  rss {result['memory_mb']['rss_after']:.0f} MiB"
+    )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    cloud, names = build_cloud(args)
+
+    targets = {}
+    if any(SCENARIOS[name][0] == "app" for name in args.scenarios):
+        app = harness.load_app(cloud, args.server)
+        targets["app"] = harness.AsgiTarget(app.app) if args.server == "asgi" else harness.WsgiTarget(app.app)
+    if any(SCENARIOS[name][0] == "indexer" for name in args.scenarios):
+        targets["indexer"] = harness.WsgiTarget(harness.load_indexer(cloud).app)
+
+    results = {"environment": harness.environment(), "config": vars(args), "scenarios": {}}
+    for name in args.scenarios:
+        service, build = SCENARIOS[name]
+        requests = build(argparse.Namespace(**{**vars(args), "requests": args.requests + args.warmup}), names)
+        result = harness.run_scenario(targets[service], requests, args.concurrency, warmup=args.warmup)
+        results["scenarios"][name] = result
+        print_summary(name, result)
+
+    results["upstream_calls"] = {upstream.name: upstream.calls for upstream in (cloud.storage, cloud.model, cloud.datastore)}
+    print(f"Results written to {harness.save_results(results, args.output)}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        lines, regressed = harness.compare(results, baseline, args.tolerance)
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""The app served against the local fakes, for load tests over real HTTP with gunicorn:
+
+    BENCH_MODEL_LATENCY=2:8 gunicorn --workers 2 --threads 16 bench.server:app
+    SERVER_MODE=asgi gunicorn --workers 2 -k uvicorn.workers.UvicornWorker bench.server:app
+
+Every worker seeds the same catalog. BENCH_STATE_DIR lets the workers agree on
+documents indexed later (uploads become indexed BENCH_INDEX_LATENCY after they
+were written, standing in for the indexer).
+"""
+import os
+
+from bench import harness
+from bench.fakes import FakeCloud, Latency, Upstream
+
+ERROR_RATE = float(os.getenv("BENCH_ERROR_RATE", 0))
+
+cloud = FakeCloud(
+    storage=Upstream("storage", Latency.parse(os.getenv("BENCH_STORAGE_LATENCY", "0.02:0.15")), ERROR_RATE),
+    model=Upstream("model", Latency.parse(os.getenv("BENCH_MODEL_LATENCY", "2:8")), ERROR_RATE),
+    datastore=Upstream("datastore", Latency.parse(os.getenv("BENCH_DATASTORE_LATENCY", "0.03:0.2")), ERROR_RATE),
+    index_latency=Latency.parse(os.getenv("BENCH_INDEX_LATENCY", "60:180")),
+    state_dir=os.getenv("BENCH_STATE_DIR") or None,
+    auto_index=True,
+)
+cloud.seed(
+    harness.BUCKET, int(os.getenv("BENCH_DOCUMENTS", 300)),
+    indexed_fraction=float(os.getenv("BENCH_INDEXED_FRACTION", 1.0))
+)
+
+app = harness.load_app(cloud, os.getenv("SERVER_MODE", "wsgi")).app
@@ -0,0 +1,312 @@
+"""Load scenario for the lecture spike: a whole course opens the app and clicks "analyze" at once.
+
+    python -m bench.spike --workers 2 --threads 16 --class-sizes 25,50,100,200,400
+    python -m bench.spike --server asgi --workers 2 --model-latency 3:12
+    python -m bench.spike --url http://localhost:8080 --class-sizes 100   # an already running server
+
+For each class size a fresh gunicorn server (bench.server, against the fakes) is
+started and sent, open loop over real HTTP:
+
+- each student loading the file list, then streaming the analysis of one
+  document a few seconds later; arrivals are bursty (most students click in
+  the first quarter of the burst window) and documents are Zipf-distributed,
+  since most of the course opens the same few current lectures;
+- a few lecturers uploading PDFs at the start and then polling
+  /check_file_status every --poll-interval seconds until they are indexed,
+  like the frontend's status loop.
+
+Reports latency and errors per step, the saturation point (first class size
+whose analyses start later than --slo seconds at p95) and the error onset
+(first class size with more than --max-error-rate failed requests).
+Needs the packages in bench/requirements.txt.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import httpx
+
+from bench import harness
+
+
+def zipf_weights(n, exponent):
+    return [1 / rank ** exponent for rank in range(1, n + 1)]
+
+
+def plan_step(args, class_size, rng):
+    """The (offset seconds, kind, request) arrivals of one step."""
+    names = [f"lecture-{i:05d}.pdf" for i in range(args.documents)]
+    weights = zipf_weights(len(names), args.zipf)
+    arrivals = []
+    for _ in range(class_size):
+        # Exponential with a quarter of the window as mean: a burst that tails off
+        opened = min(args.burst, rng.expovariate(4 / args.burst))
+        arrivals.append((opened, "files", harness.Request("GET", "/files?fields=name,path")))
+        path = f"gs://{harness.BUCKET}/{rng.choices(names, weights)[0]}"
+        clicked = opened + rng.uniform(1, 5)
+        arrivals.append((clicked, "analyze", harness.Request("GET", f"/analyze/stream?file_path={urllib.parse.quote(path)}")))
+    for i in range(args.uploaders):
+        data = f"%PDF-spike-{class_size}-{i}".encode().ljust(args.upload_kb * 1024, b"\0")
+        name = f"spike-{class_size}-{i:03d}.pdf"
+        arrivals.append((rng.uniform(0, 5), "upload", harness.Request("POST", "/upload", files={"file": (name, data)})))
+    return sorted(arrivals, key=lambda arrival: arrival[0])
+
+
+class Step:
+    """Sends the arrivals of one step and collects (latency, outcome, time to first chunk) per kind."""
+
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.samples = {}
+        self.first_chunk = []
+        self.started = None
+
+    def record(self, kind, started, status, timing=None):
+        self.samples.setdefault(kind, []).append((time.perf_counter() - started, status, timing))
+
+    async def send(self, kind, req):
+        started = time.perf_counter()
+        try:
+            if kind == "analyze":
+                await self.stream(req, started)
+                return None
+            files = {field: (name, data) for field, (name, data) in req.files.items()} if req.files else None
+            response = await self.client.request(req.method, req.path, json=req.json, files=files)
+            self.record(kind, started, response.status_code, response.headers.get("server-timing"))
+            return response
+        except httpx.TimeoutException:
+            self.record(kind, started, "timeout")
+        except httpx.HTTPError as e:
+            self.record(kind, started, f"exception: {type(e).__name__}")
+        return None
+
+    async def stream(self, req, started):
+        # Like the frontend's EventSource: the first chunk is what the student waits for
+        async with self.client.stream(req.method, req.path) as response:
+            body = b""
+            async for data in response.aiter_bytes():
+                streaming = b"event: chunk" in body
+                body += data
+                if not streaming and b"event: chunk" in body:
+                    self.first_chunk.append(time.perf_counter() - started)
+        self.record("analyze", started, harness.outcome(response.status_code, response.headers.get("content-type"), body))
+
+    async def upload_and_poll(self, req, deadline):
+        response = await self.send("upload", req)
+        if response is None or response.status_code != 201:
+            return
+        gcs_uri = response.json()["gcs_uri"]
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.args.poll_interval)
+            started = time.perf_counter()
+            try:
+                status = await self.client.post("/check_file_status", json={"gcs_uri": gcs_uri})
+            except httpx.HTTPError as e:
+                self.record("check_file_status", started, f"exception: {type(e).__name__}")
+                continue
+            self.record("check_file_status", started, status.status_code, status.headers.get("server-timing"))
+            if status.status_code == 200:
+                return
+
+    async def run(self, arrivals):
+        self.started = time.monotonic()
+        deadline = self.started + self.args.burst + self.args.timeout
+
+        async def arrive(offset, kind, req):
+            await asyncio.sleep(max(0.0, self.started + offset - time.monotonic()))
+            if kind == "upload":
+                await self.upload_and_poll(req, deadline)
+            else:
+                await self.send(kind, req)
+
+        students = [asyncio.ensure_future(arrive(*arrival)) for arrival in arrivals if arrival[1] != "upload"]
+        lecturers = [asyncio.ensure_future(arrive(*arrival)) for arrival in arrivals if arrival[1] == "upload"]
+        await asyncio.gather(*students)
+        # Polling for uploads stops with the students' requests
+        for task in lecturers:
+            task.cancel()
+        await asyncio.gather(*lecturers, return_exceptions=True)
+        return time.monotonic() - self.started
+
+
+async def run_step(url, args, class_size, rng):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limits) as client:
+        step = Step(client, args)
+        arrivals = plan_step(args, class_size, rng)
+        seconds = await step.run(arrivals)
+
+    result = {"class_size": class_size, "seconds": round(seconds, 1), "routes": {}}
+    all_samples = []
+    for kind, samples in step.samples.items():
+        result["routes"][kind] = harness.summarize(samples, seconds)
+        all_samples.extend(samples)
+    first_chunk = sorted(step.first_chunk)
+    result["analyze_first_chunk_ms"] = {
+        name: round(harness.percentile(first_chunk, q) * 1000, 1) if first_chunk else None
+        for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+    }
+    total = harness.summarize(all_samples, seconds)
+    result["requests"] = total["requests"]
+    result["error_rate"] = total["error_rate"]
+    result["status_codes"] = total["status_codes"]
+    return result
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    """A gunicorn server of bench.server with the given worker/thread configuration."""
+
+    def __init__(self, args):
+        self.args = args
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.state_dir = tempfile.mkdtemp(prefix="bench-spike-")
+        self.log_path = os.path.join(self.state_dir, "server.log")
+        self.process = None
+
+    def __enter__(self):
+        args = self.args
+        command = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{self.port}",
+                   "--workers", str(args.workers), "--timeout", "0", "--backlog", "2048"]
+        if args.server == "asgi":
+            command += ["-k", "uvicorn.workers.UvicornWorker"]
+        else:
+            command += ["--threads", str(args.threads)]
+        env = dict(
+            os.environ,
+            SERVER_MODE=args.server,
+            BENCH_STATE_DIR=self.state_dir,
+            BENCH_DOCUMENTS=str(args.documents),
+            BENCH_MODEL_LATENCY=args.model_latency,
+            BENCH_STORAGE_LATENCY=args.storage_latency,
+            BENCH_DATASTORE_LATENCY=args.datastore_latency,
+            BENCH_INDEX_LATENCY=args.index_latency,
+            BENCH_ERROR_RATE=str(args.error_rate),
+        )
+        self._log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            command + ["bench.server:app"], cwd=harness.ROOT, env=env, stdout=self._log, stderr=subprocess.STDOUT
+        )
+        self._wait_ready()
+        return self
+
+    def _wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with {self.process.returncode}, see {self.log_path}")
+            try:
+                if httpx.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError(f"gunicorn did not become ready within {timeout}s, see {self.log_path}")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._log.close()
+        if exc[0] is None:
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+        return False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--class-sizes", default="25,50,100,200,400", help="students per step, comma-separated")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=16, help="gunicorn threads per worker (wsgi)")
+    parser.add_argument("--server", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--url", help="load an already running server instead of starting one per step")
+    parser.add_argument("--burst", type=float, default=60, help="seconds over which the students arrive")
+    parser.add_argument("--documents", type=int, default=300, help="PDFs in the course catalog")
+    parser.add_argument("--zipf", type=float, default=1.2, help="Zipf exponent of document popularity")
+    parser.add_argument("--uploaders", type=int, default=3, help="PDFs uploaded (and polled) at the start")
+    parser.add_argument("--upload-kb", type=int, default=2048, help="size of each uploaded PDF")
+    parser.add_argument("--poll-interval", type=float, default=10, help="status polling interval in seconds")
+    parser.add_argument("--model-latency", default="2:8", help="model call latency, median[:p99] seconds")
+    parser.add_argument("--storage-latency", default="0.02:0.15", help="GCS call latency, median[:p99] seconds")
+    parser.add_argument("--datastore-latency", default="0.03:0.2", help="data store call latency, median[:p99] seconds")
+    parser.add_argument("--index-latency", default="20:60", help="time until an upload is indexed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream calls failing transiently")
+    parser.add_argument("--timeout", type=float, default=120, help="client timeout per request in seconds")
+    parser.add_argument("--slo", type=float, default=10, help="p95 seconds until an analysis starts streaming")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="error rate counted as error onset")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="results file (default: bench/results/<timestamp>.json)")
+    args = parser.parse_args(argv)
+    args.class_sizes = [int(size) for size in args.class_sizes.split(",")]
+    return args
+
+
+def print_step(result):
+    routes = result["routes"]
+    first_chunk = result["analyze_first_chunk_ms"]
+    analyze = routes.get("analyze", {}).get("latency_ms", {})
+    files = routes.get("files", {}).get("latency_ms", {})
+
+    def seconds(ms):
+        return f"{ms / 1000:7.2f}" if ms is not None else "      -"
+    print(
+        f"{result['class_size']:>6} students  analyze start p50 {seconds(first_chunk['p50'])}s  "
+        f"p95 {seconds(first_chunk['p95'])}s  done p95 {seconds(analyze.get('p95'))}s  "
+        f"files p95 {seconds(files.get('p95'))}s  errors {result['error_rate']:>6.1%}  {result['status_codes']}"
+    )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    config = f"{args.workers} worker(s) x {args.threads} thread(s)" if args.server == "wsgi" else f"{args.workers} uvicorn worker(s)"
+    print(f"Lecture spike against {args.url or config}, burst {args.burst:.0f}s, model latency {args.model_latency}s")
+
+    steps = []
+    for class_size in args.class_sizes:
+        if args.url:
+            result = asyncio.run(run_step(args.url, args, class_size, rng))
+        else:
+            with Server(args) as server:
+                result = asyncio.run(run_step(server.url, args, class_size, rng))
+        steps.append(result)
+        print_step(result)
+
+    saturation = next((step["class_size"] for step in steps
+                       if (step["analyze_first_chunk_ms"]["p95"] or float("inf")) > args.slo * 1000), None)
+    error_onset = next((step["class_size"] for step in steps if step["error_rate"] > args.max_error_rate), None)
+    print(f"Saturation (analysis starts after more than {args.slo:.0f}s at p95): "
+          + (f"from {saturation} students" if saturation else "not reached"))
+    print(f"Error onset (more than {args.max_error_rate:.0%} failed requests): "
+          + (f"from {error_onset} students" if error_onset else "not reached"))
+
+    results = {
+        "environment": harness.environment(),
+        "config": {**vars(args), "server_config": config},
+        "steps": steps,
+        "saturation_class_size": saturation,
+        "error_onset_class_size": error_onset,
+    }
+    path = args.output or os.path.join(harness.RESULTS_DIR, time.strftime("spike-%Y%m%d-%H%M%S") + ".json")
+    print(f"Results written to {harness.save_results(results, path)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+# --- Stores ---
+# A store only knows how to persist opaque bytes under a string key and how to
+# keep itself bounded. Expiry and (de)serialization live in ResultCache.
+
+class MemoryStore:
+    """In-process LRU store. Not shared between gunicorn workers."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class DiskStore:
+    """One file per key on local disk, shared by all workers of an instance.
+
+    Recency is tracked through the file mtime, which is bumped on every read.
+    """
+
+    def __init__(self, directory, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        # Atomic replace so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith(".tmp-"):
+                continue
+            try:
+                entries.append((os.path.getmtime(self._path(name)), name))
+            except FileNotFoundError:
+                continue
+        overflow = len(entries) - self.max_entries
+        if overflow > 0:
+            for _, name in sorted(entries)[:overflow]:
+                self.delete(name)
+
+
+class GCSStore:
+    """Objects under a prefix in a GCS bucket, shared by all instances.
+
+    `get_bucket` is called per operation so the store never pins a client
+    created before a fork. Eviction needs a listing of the prefix, so it only
+    runs every `evict_every` writes instead of on each one.
+    """
+
+    def __init__(self, get_bucket, prefix=".analysis-cache/", max_entries=1000, evict_every=50):
+        self.get_bucket = get_bucket
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        blob = self.get_bucket().get_blob(self.prefix + key)
+        if blob is None:
+            return None
+        return blob.download_as_bytes()
+
+    def set(self, key, value):
+        self.get_bucket().blob(self.prefix + key).upload_from_string(value, content_type="application/json")
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        if due:
+            self._evict()
+
+    def delete(self, key):
+        blob = self.get_bucket().blob(self.prefix + key)
+        try:
+            blob.delete()
+        except Exception:
+            pass
+
+    def _evict(self):
+        # GCS has no access time, so this is LRU by last write
+        blobs = sorted(self.get_bucket().list_blobs(prefix=self.prefix), key=lambda b: b.updated)
+        for blob in blobs[:max(0, len(blobs) - self.max_entries)]:
+            try:
+                blob.delete()
+            except Exception:
+                pass
+
+
+# --- Cache ---
+
+def fingerprint(*parts):
+    """Stable SHA-256 over the given key parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """JSON value cache with TTL on top of a pluggable store."""
+
+    def __init__(self, store, ttl_seconds, on_lookup=None):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        # Called with True/False after every lookup, e.g. to export hit rates
+        self.on_lookup = on_lookup
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if self.on_lookup is not None:
+            self.on_lookup(hit)
+
+    def get(self, key):
+        raw = self.store.get(key)
+        if raw is None:
+            self._count(False)
+            return None
+        try:
+            entry = json.loads(raw)
+        except ValueError:
+            self.store.delete(key)
+            self._count(False)
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl_seconds:
+            self.store.delete(key)
+            self._count(False)
+            return None
+        self._count(True)
+        return entry["value"]
+
+    def set(self, key, value):
+        entry = {"created": time.time(), "value": value}
+        self.store.set(key, json.dumps(entry).encode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.store).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
@@ -0,0 +1,325 @@
+import base64
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FileCatalog:
+    """Cached, incrementally maintained listing of the PDFs in a bucket.
+
+    The full listing is loaded once and then reloaded only every
+    `refresh_interval` seconds; uploads and GCS notifications keep it current
+    in between through `add` / `remove`. Names are kept sorted so prefix
+    filtering and cursor pagination are a binary search plus a slice.
+
+    Reloads list the bucket without holding the catalog lock: requests keep
+    being served from the previous listing (only the very first load is
+    waited for), and changes made meanwhile are replayed onto the new one.
+
+    With a `shared_version` (see SharedVersion), every change is announced to
+    the other workers and instances, and a catalog reloads (waiting for it)
+    as soon as the version differs from the one its listing was loaded at; it
+    is read at most every `version_check_interval` seconds.
+    """
+
+    FIELDS = ("name", "path", "size", "updated")
+
+    def __init__(self, bucket_name, list_blobs, refresh_interval=300, shared_version=None, version_check_interval=1.0):
+        self.bucket_name = bucket_name
+        self.list_blobs = list_blobs
+        self.refresh_interval = refresh_interval
+        self.shared_version = shared_version
+        self.version_check_interval = version_check_interval
+        self._entries = {}
+        # name -> (generation, size, updated) of every listed object, for content-based ETags
+        self._stamps = {}
+        self._names = []
+        # name -> (generation, sha256) of listed objects, alias -> (target, target generation, sha256)
+        self._objects = {}
+        self._links = {}
+        self._loaded_at = None
+        self._listed = False
+        # Shared version the listing was loaded at, the last one read, and when
+        self._loaded_version = None
+        self._seen_version = None
+        self._version_checked_at = None
+        # add/remove calls made while a reload is listing the bucket, or None outside of reloads
+        self._changes = None
+        self._lock = threading.RLock()
+        # One reload at a time; never held together with _lock while listing
+        self._refresh_lock = threading.Lock()
+
+    @staticmethod
+    def is_listed(name):
+        return name.lower().endswith(".pdf")
+
+    def _entry(self, name, size=None, updated=None, alias_of=None):
+        # Aliases (deduplicated uploads) point at the object holding the content
+        return {
+            "name": name,
+            "path": f"gs://{self.bucket_name}/{alias_of or name}",
+            "size": size,
+            "updated": updated.isoformat() if hasattr(updated, "isoformat") else updated,
+        }
+
+    def refresh(self):
+        with self._refresh_lock:
+            self._reload()
+
+    def _reload(self):
+        with self._lock:
+            self._changes = []
+            # Read before listing: a change announced while listing triggers another reload
+            version = self._seen_version
+        try:
+            blobs = [blob for blob in self.list_blobs() if self.is_listed(blob.name)]
+        except BaseException:
+            with self._lock:
+                self._changes = None
+            raise
+        entries, stamps, objects, links = {}, {}, {}, {}
+        for blob in blobs:
+            self._put(entries, stamps, objects, links, blob.name, blob.size, blob.updated, blob.metadata, blob.generation)
+        for alias in [alias for alias, link in links.items() if not _link_valid(link, objects.get(link[0]))]:
+            logger.warning(f"Alias '{alias}' no longer matches '{links[alias][0]}', not listing it.")
+            del entries[alias], stamps[alias], links[alias]
+        with self._lock:
+            self._entries, self._stamps, self._objects, self._links = entries, stamps, objects, links
+            self._names = sorted(entries)
+            # The listing may predate uploads and deletions reported while it ran
+            for change in self._changes:
+                if change[0] == "add":
+                    self._add(*change[1:])
+                else:
+                    self._remove(change[1])
+            self._changes = None
+            self._loaded_at = time.monotonic()
+            self._loaded_version = version
+            self._listed = True
+
+    def _put(self, entries, stamps, objects, links, name, size, updated, metadata, generation):
+        link = _alias_link(metadata)
+        entries[name] = self._entry(name, size, updated, link[0] if link else None)
+        stamps[name] = (generation, size, entries[name]["updated"])
+        if link is not None:
+            links[name] = link
+            objects.pop(name, None)
+        else:
+            objects[name] = (generation, (metadata or {}).get("sha256"))
+            links.pop(name, None)
+
+    def _fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_interval
+
+    def _version_changed(self):
+        """True if another worker (or this one) announced a change since the listing was loaded."""
+        if self.shared_version is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            due = self._version_checked_at is None or now - self._version_checked_at >= self.version_check_interval
+            if due:
+                # Claimed before reading, so concurrent requests don't all read it
+                self._version_checked_at = now
+        if due:
+            try:
+                version = self.shared_version.current()
+            except Exception as e:
+                logger.warning(f"Could not read the shared catalog version: {e}")
+            else:
+                with self._lock:
+                    self._seen_version = version
+        with self._lock:
+            return self._seen_version != self._loaded_version
+
+    def ensure_fresh(self):
+        changed = self._version_changed()
+        if self._fresh() and not changed:
+            return
+        if not self._listed or changed:
+            # Nothing to serve yet, or the bucket changed elsewhere: concurrent requests wait for one reload
+            with self._refresh_lock:
+                if not self._fresh() or self._seen_version != self._loaded_version:
+                    self._reload()
+            return
+        # Stale: one request reloads, the others keep using the current listing meanwhile
+        if self._refresh_lock.acquire(blocking=False):
+            try:
+                if not self._fresh():
+                    self._reload()
+            finally:
+                self._refresh_lock.release()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def add(self, name, size=None, updated=None, metadata=None, generation=None):
+        """Lists a written object; `metadata` and `generation` are the object's (aliases carry alias_of)."""
+        if not self.is_listed(name):
+            return
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append(("add", name, size, updated, metadata, generation))
+            self._add(name, size, updated, metadata, generation)
+        self._announce()
+
+    def _add(self, name, size, updated, metadata, generation):
+        link = _alias_link(metadata)
+        if link is not None and name in self._objects or link is None and name in self._links:
+            self._remove(name)
+        if link is not None and link[0] in self._objects and not _link_valid(link, self._objects[link[0]]):
+            return
+        if name not in self._entries:
+            bisect.insort(self._names, name)
+        self._put(self._entries, self._stamps, self._objects, self._links, name, size, updated, metadata, generation)
+        if link is None:
+            # An overwritten object takes the aliases linked to its earlier content with it
+            self._drop_aliases(name)
+
+    def remove(self, name):
+        if not self.is_listed(name):
+            return
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append(("remove", name))
+            self._remove(name)
+        self._announce()
+
+    def _announce(self):
+        if self.shared_version is not None:
+            self.shared_version.bump()
+
+    def _remove(self, name):
+        self._objects.pop(name, None)
+        self._links.pop(name, None)
+        self._stamps.pop(name, None)
+        if self._entries.pop(name, None) is not None:
+            index = bisect.bisect_left(self._names, name)
+            del self._names[index]
+        self._drop_aliases(name)
+
+    def _drop_aliases(self, target):
+        stale = [
+            alias for alias, link in self._links.items()
+            if link[0] == target and not _link_valid(link, self._objects.get(target))
+        ]
+        for alias in stale:
+            self._remove(alias)
+
+    def contains(self, name):
+        with self._lock:
+            return name in self._entries
+
+    def page(self, prefix="", cursor=None, limit=None, fields=None):
+        """Returns (files, next_cursor, etag) for a prefix, starting after the cursor."""
+        after = decode_cursor(cursor) if cursor else None
+        with self._lock:
+            start = bisect.bisect_left(self._names, prefix)
+            if after is not None:
+                start = max(start, bisect.bisect_right(self._names, after))
+            names = []
+            for name in self._names[start:]:
+                if not name.startswith(prefix) or (limit is not None and len(names) >= limit):
+                    break
+                names.append(name)
+            has_more = (
+                limit is not None
+                and start + len(names) < len(self._names)
+                and self._names[start + len(names)].startswith(prefix)
+            )
+            entries = [self._entries[name] for name in names]
+            stamps = [self._stamps[name] for name in names]
+
+        if fields:
+            entries = [{field: entry[field] for field in fields} for entry in entries]
+        next_cursor = encode_cursor(names[-1]) if has_more and names else None
+        # From the page's content, so every worker and instance serving the same listing agrees on it
+        digest = hashlib.sha256(f"{prefix}:{cursor}:{limit}:{fields}:{has_more}".encode("utf-8"))
+        for name, stamp in zip(names, stamps):
+            digest.update(f"\n{name}:{stamp[0]}:{stamp[1]}:{stamp[2]}".encode("utf-8"))
+        return entries, next_cursor, digest.hexdigest()[:32]
+
+
+class SharedVersion:
+    """Version of a listing shared by all workers and instances: the generation of one GCS object.
+
+    Every `bump` rewrites the object, giving it a new generation, and
+    `current` reads that generation back. GCS allows about one write per
+    second to an object, so bumps within `min_interval` of the last write are
+    coalesced into one write at the end of the interval.
+    """
+
+    def __init__(self, read, write, min_interval=1.0):
+        self._read = read
+        self._write = write
+        self.min_interval = min_interval
+        self._last_write = None
+        self._pending = False
+        self._lock = threading.Lock()
+
+    def current(self):
+        return self._read()
+
+    def bump(self):
+        with self._lock:
+            if self._pending:
+                return
+            now = time.monotonic()
+            delay = 0 if self._last_write is None else self._last_write + self.min_interval - now
+            if delay > 0:
+                self._pending = True
+                timer = threading.Timer(delay, self._flush)
+                timer.daemon = True
+                timer.start()
+                return
+            self._last_write = now
+        self._write_marker()
+
+    def _flush(self):
+        with self._lock:
+            self._pending = False
+            self._last_write = time.monotonic()
+        self._write_marker()
+
+    def _write_marker(self):
+        try:
+            self._write()
+        except Exception as e:
+            logger.warning(f"Could not bump the shared catalog version: {e}")
+
+
+def _alias_link(metadata):
+    """(target, target generation, sha256) of an alias object's metadata, or None for regular objects."""
+    metadata = metadata or {}
+    if not metadata.get("alias_of"):
+        return None
+    return metadata["alias_of"], metadata.get("alias_generation"), metadata.get("sha256")
+
+
+def _link_valid(link, target):
+    """True while an alias's target exists as the generation (and content) it was linked to.
+
+    Aliases from before generations were recorded are checked by content hash only.
+    """
+    if target is None:
+        return False
+    _, generation, sha256 = link
+    target_generation, target_sha256 = target
+    if generation and target_generation is not None and str(generation) != str(target_generation):
+        return False
+    if sha256 and target_sha256 and sha256 != target_sha256:
+        return False
+    return True
+
+
+def encode_cursor(name):
+    return base64.urlsafe_b64encode(name.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
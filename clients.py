@@ -0,0 +1,54 @@
+import os
+import threading
+
+
+class ClientRegistry:
+    """Process-wide registry that lazily creates and reuses cloud clients.
+
+    Factories are registered once at import time; `get` creates the client on
+    first use and returns the same instance afterwards. Clients created before
+    a fork (gunicorn --preload) hold sockets and gRPC channels that must not be
+    shared with the child, so every worker starts with an empty registry.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, name, factory):
+        self._factories[name] = factory
+
+    def get(self, name):
+        if self._pid != os.getpid():
+            self._after_fork()
+        client = self._instances.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._instances.get(name)
+            if client is None:
+                client = self._factories[name]()
+                self._instances[name] = client
+        return client
+
+    def override(self, name, client):
+        """Replaces a client, e.g. with a local fake for benchmarks."""
+        with self._lock:
+            self._instances[name] = client
+
+    def reset(self):
+        with self._lock:
+            self._instances.clear()
+
+    def _after_fork(self):
+        # Drop (don't close) the parent's clients; the parent still owns them
+        self._lock = threading.Lock()
+        self._instances = {}
+        self._pid = os.getpid()
+
+
+registry = ClientRegistry()
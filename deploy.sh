@@ -10,10 +10,29 @@ SERVICE_ACCOUNT="study-companion-sa@$PROJECT_ID.iam.gserviceaccount.com"
 DATA_STORE_ID="asc-knowledge-base_1769181814756"
 DATA_STORE_LOCATION="eu"
 GCS_BUCKET_NAME="ai-study-companion"
+# Geheimnisse im Secret Manager: bleiben über Deployments gleich, damit laufende Chunk-Uploads
+# und Status-Meldungen ein Redeployment überstehen
+# Gemeinsames Geheimnis für die Status-Meldungen des Indexers an die App
+STATUS_CALLBACK_SECRET_NAME="study-companion-status-callback-token"
+# Signiert die Upload-IDs der Chunk-Uploads über die App (alle Instanzen brauchen denselben Wert)
+UPLOAD_SESSION_SECRET_NAME="study-companion-upload-session-secret"
 
 # Authentifizierung sicherstellen
 gcloud config set project $PROJECT_ID
 
+# Legt ein Geheimnis nur an, wenn es noch nicht existiert, und gibt dem Service Account Lesezugriff
+ensure_secret() {
+  if ! gcloud secrets describe $1 >/dev/null 2>&1; then
+    openssl rand -hex 32 | tr -d '\n' | gcloud secrets create $1 --replication-policy=automatic --data-file=-
+  fi
+  gcloud secrets add-iam-policy-binding $1 \
+    --member="serviceAccount:$SERVICE_ACCOUNT" \
+    --role="roles/secretmanager.secretAccessor" --quiet >/dev/null
+}
+gcloud services enable secretmanager.googleapis.com
+ensure_secret $STATUS_CALLBACK_SECRET_NAME
+ensure_secret $UPLOAD_SESSION_SECRET_NAME
+
 # --- 1. INDEXER SERVICE DEPLOYMENT ---
 echo "--------------------------------------------"
 echo "📦 Baue & Deploye INDEXER SERVICE..."
@@ -26,7 +45,8 @@ gcloud run deploy file-indexer-service-9404 \
   --platform managed \
   --region $REGION \
   --service-account $SERVICE_ACCOUNT \
-  --set-env-vars "GCP_PROJECT_ID=$PROJECT_ID,DATA_STORE_ID=$DATA_STORE_ID,DATA_STORE_LOCATION=$DATA_STORE_LOCATION" \
+  --set-env-vars "GCP_PROJECT_ID=$PROJECT_ID,DATA_STORE_ID=$DATA_STORE_ID,DATA_STORE_LOCATION=$DATA_STORE_LOCATION,INDEX_STATUS_BUCKET=$GCS_BUCKET_NAME" \
+  --concurrency 100 \
   --no-allow-unauthenticated
 
 # --- IAM FIX: Erlaubt den Zugriff (verhindert 403 Forbidden) ---
@@ -42,18 +62,80 @@ AGENT_IMAGE="gcr.io/$PROJECT_ID/study-companion-agent"
 
 gcloud builds submit . --tag $AGENT_IMAGE
 
+# Hintergrund-Jobs, Vorberechnung und lokale Indizierung laufen nach der Antwort weiter:
+# CPU auch außerhalb von Requests, und eine Instanz bleibt warm, um liegengebliebene Jobs abzuarbeiten.
+# Jobs liegen im Bucket (JOB_BACKEND=gcs), damit jede Instanz /jobs/<id> beantworten kann.
 gcloud run deploy study-companion-agent \
   --image $AGENT_IMAGE \
   --platform managed \
   --region $REGION \
   --service-account $SERVICE_ACCOUNT \
-  --set-env-vars "PROJECT_ID=$PROJECT_ID,GCS_BUCKET_NAME=$GCS_BUCKET_NAME,DATA_STORE_ID=$DATA_STORE_ID,DATA_STORE_LOCATION=$DATA_STORE_LOCATION" \
+  --set-env-vars "PROJECT_ID=$PROJECT_ID,GCS_BUCKET_NAME=$GCS_BUCKET_NAME,DATA_STORE_ID=$DATA_STORE_ID,DATA_STORE_LOCATION=$DATA_STORE_LOCATION,INDEX_STATUS_BUCKET=$GCS_BUCKET_NAME,JOB_BACKEND=gcs" \
+  --set-secrets "STATUS_CALLBACK_TOKEN=$STATUS_CALLBACK_SECRET_NAME:latest,UPLOAD_SESSION_SECRET=$UPLOAD_SESSION_SECRET_NAME:latest" \
   --allow-unauthenticated \
   --memory 1Gi \
   --cpu 1 \
+  --no-cpu-throttling \
+  --min-instances 1 \
   --timeout 300
 
 echo "--------------------------------------------"
 echo "✅ Master Deployment erfolgreich abgeschlossen!"
 URL=$(gcloud run services describe study-companion-agent --platform managed --region $REGION --format 'value(status.url)')
-echo "🌐 Deine App ist jetzt live unter: $URL"
\ No newline at end of file
+echo "🌐 Deine App ist jetzt live unter: $URL"
+
+# --- 3. DIREKT-UPLOADS ---
+# Browser laden per signierter URL direkt in den Bucket; dafür braucht der Bucket CORS für die App-Origin
+cat > /tmp/cors.json <<EOF
+[{"origin": ["$URL"], "method": ["POST", "PUT"], "responseHeader": ["Content-Type", "Location", "x-goog-resumable"], "maxAgeSeconds": 3600}]
+EOF
+gsutil cors set /tmp/cors.json gs://$GCS_BUCKET_NAME
+# Signieren über IAM (kein privater Schlüssel auf Cloud Run)
+gcloud iam service-accounts add-iam-policy-binding $SERVICE_ACCOUNT \
+  --member="serviceAccount:$SERVICE_ACCOUNT" \
+  --role="roles/iam.serviceAccountTokenCreator" --quiet
+gcloud run services update study-companion-agent \
+  --region $REGION \
+  --update-env-vars "DIRECT_UPLOADS=true"
+
+# --- 4. STATUS-CALLBACK VERDRAHTEN ---
+# Der Indexer meldet abgeschlossene Imports an die App (Server-Push statt Polling).
+# CPU muss außerhalb von Requests verfügbar sein, damit die Operation im Hintergrund abgewartet wird.
+gcloud run services update file-indexer-service-9404 \
+  --region $REGION \
+  --no-cpu-throttling \
+  --update-env-vars "STATUS_CALLBACK_URL=$URL/internal/index_status" \
+  --update-secrets "STATUS_CALLBACK_TOKEN=$STATUS_CALLBACK_SECRET_NAME:latest"
+# --- 5. BUCKET-EREIGNISSE AN DIE APP ---
+# Hält den Dateikatalog (/files) und den lokalen Index aktuell. Pub/Sub pusht mit einem OIDC-Token
+# des Service Accounts, das die App prüft.
+EVENTS_TOPIC="study-companion-gcs-events"
+EVENTS_SUBSCRIPTION="study-companion-gcs-events-push"
+EVENTS_ENDPOINT="$URL/internal/gcs_events"
+PROJECT_NUMBER=$(gcloud projects describe $PROJECT_ID --format 'value(projectNumber)')
+
+gcloud pubsub topics describe $EVENTS_TOPIC >/dev/null 2>&1 || gcloud pubsub topics create $EVENTS_TOPIC
+if ! gsutil notification list gs://$GCS_BUCKET_NAME | grep -q "topics/$EVENTS_TOPIC"; then
+  gsutil notification create -t $EVENTS_TOPIC -f json \
+    -e OBJECT_FINALIZE -e OBJECT_DELETE -e OBJECT_ARCHIVE gs://$GCS_BUCKET_NAME
+fi
+# Pub/Sub darf für den Service Account OIDC-Tokens ausstellen
+gcloud iam service-accounts add-iam-policy-binding $SERVICE_ACCOUNT \
+  --member="serviceAccount:service-$PROJECT_NUMBER@gcp-sa-pubsub.iam.gserviceaccount.com" \
+  --role="roles/iam.serviceAccountTokenCreator" --quiet
+if gcloud pubsub subscriptions describe $EVENTS_SUBSCRIPTION >/dev/null 2>&1; then
+  gcloud pubsub subscriptions update $EVENTS_SUBSCRIPTION \
+    --push-endpoint=$EVENTS_ENDPOINT \
+    --push-auth-service-account=$SERVICE_ACCOUNT \
+    --push-auth-token-audience=$EVENTS_ENDPOINT
+else
+  gcloud pubsub subscriptions create $EVENTS_SUBSCRIPTION \
+    --topic=$EVENTS_TOPIC \
+    --push-endpoint=$EVENTS_ENDPOINT \
+    --push-auth-service-account=$SERVICE_ACCOUNT \
+    --push-auth-token-audience=$EVENTS_ENDPOINT \
+    --ack-deadline=30
+fi
+gcloud run services update study-companion-agent \
+  --region $REGION \
+  --update-env-vars "GCS_EVENTS_AUDIENCE=$EVENTS_ENDPOINT,GCS_EVENTS_SERVICE_ACCOUNT=$SERVICE_ACCOUNT"
@@ -0,0 +1,80 @@
+import asyncio
+import queue
+import threading
+from collections import defaultdict
+
+
+class EventBus:
+    """In-memory pub/sub keyed by topic (e.g. a GCS URI).
+
+    Stand-in for a shared broker: subscribers only see messages published in
+    the same process, so listeners should still re-check the source of truth
+    from time to time.
+    """
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic):
+        q = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers[topic].add(q)
+        return q
+
+    def subscribe_async(self, topic):
+        """Like subscribe, for a coroutine on the running event loop."""
+        q = AsyncSubscription(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers[topic].add(q)
+        return q
+
+    def unsubscribe(self, topic, q):
+        with self._lock:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def publish(self, topic, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # A stuck subscriber must not block publishers
+                pass
+        return len(subscribers)
+
+    def subscriber_count(self, topic=None):
+        with self._lock:
+            if topic is not None:
+                return len(self._subscribers.get(topic, ()))
+            return sum(len(s) for s in self._subscribers.values())
+
+
+class AsyncSubscription:
+    """Subscriber queue that an event loop awaits; publishers may be on any thread."""
+
+    def __init__(self, maxsize=100):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=maxsize)
+
+    def put_nowait(self, message):
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, message)
+        except RuntimeError:
+            # The loop is already closed
+            pass
+
+    def _deliver(self, message):
+        # Same as EventBus.publish: a stuck subscriber drops messages instead of blocking
+        if not self._queue.full():
+            self._queue.put_nowait(message)
+
+    async def get(self, timeout):
+        """Next message; raises asyncio.TimeoutError after `timeout` seconds."""
+        return await asyncio.wait_for(self._queue.get(), timeout)
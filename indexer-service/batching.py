@@ -0,0 +1,72 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class ImportBatcher:
+    """Collects GCS URIs from concurrent requests and imports them in batches.
+
+    A batch is submitted once it holds `max_batch_size` URIs or `max_wait`
+    seconds after its first URI arrived, whichever comes first. `add` returns
+    a Future per URI that resolves to the submitted operation (or its error),
+    so each Pub/Sub push request can ack or nack its own message.
+    """
+
+    def __init__(self, submit, max_batch_size=100, max_wait=5.0):
+        self.submit = submit
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = {}
+        self._first_added = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, gcs_uri):
+        with self._cond:
+            self._ensure_started()
+            future = self._pending.get(gcs_uri)
+            if future is None:
+                # Redeliveries of a URI already waiting share its future
+                future = self._pending[gcs_uri] = Future()
+                if self._first_added is None:
+                    self._first_added = time.monotonic()
+                self._cond.notify()
+            return future
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _ensure_started(self):
+        # Started lazily so the thread lives in the gunicorn worker, not the master
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="import-batcher", daemon=True)
+            self._thread.start()
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    due = self._first_added + self.max_wait
+                    now = time.monotonic()
+                    if len(self._pending) >= self.max_batch_size or now >= due:
+                        break
+                    self._cond.wait(timeout=due - now)
+                else:
+                    self._cond.wait()
+            uris = list(self._pending)[:self.max_batch_size]
+            batch = {uri: self._pending.pop(uri) for uri in uris}
+            self._first_added = time.monotonic() if self._pending else None
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                operation = self.submit(list(batch))
+            except Exception as e:
+                for future in batch.values():
+                    future.set_exception(e)
+                continue
+            for future in batch.values():
+                future.set_result(operation)
@@ -2,12 +2,139 @@ import base64
 import json
 import os
 import hashlib
-from flask import Flask, request
+import threading
+import time
+import urllib.error
+import urllib.request
+import requests
+from flask import Flask, Response, g, request
+from google.api_core import exceptions, retry as retries
 from google.cloud import discoveryengine_v1 as discoveryengine
 from google.api_core.client_options import ClientOptions
+import metrics
+import tracing
+from batching import ImportBatcher
+from operations import OperationTracker
+from status_store import MemoryStatusStore, GCSStatusStore, status_key
 
 app = Flask(__name__)
 
+# Spans go to TRACE_EXPORT_FILE (JSON lines) and/or an OTLP/HTTP collector at TRACE_OTLP_ENDPOINT
+tracer = tracing.Tracer(
+    'indexer-service',
+    file_path=os.environ.get('TRACE_EXPORT_FILE'),
+    otlp_endpoint=os.environ.get('TRACE_OTLP_ENDPOINT')
+)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.monotonic()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    g.trace = tracer.start(
+        f'{request.method} {metrics.route_label(request)}', traceparent=request.headers.get('traceparent')
+    )
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = metrics.route_label(request)
+    metrics.REQUESTS.labels(request.method, route, response.status_code).inc()
+    metrics.REQUEST_LATENCY.labels(request.method, route).observe(time.monotonic() - g.request_started)
+    if 'trace' in g:
+        root = g.trace[0]
+        root.set(**{'http.status_code': response.status_code})
+        tracer.finish(*g.pop('trace'))
+        response.headers['Server-Timing'] = tracer.server_timing(root)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if 'request_started' in g:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+    if 'trace' in g:
+        root, token = g.pop('trace')
+        root.error = f'{type(error).__name__}: {error}' if error else None
+        tracer.finish(root, token)
+
+PROJECT_ID = os.environ.get('GCP_PROJECT_ID')
+DATA_STORE_ID = os.environ.get('DATA_STORE_ID')
+LOCATION = os.environ.get('DATA_STORE_LOCATION', 'eu')
+
+# Micro-batching: one import operation per IMPORT_BATCH_SIZE URIs or IMPORT_BATCH_WINDOW seconds.
+# Batches can only grow as large as the number of concurrent push requests (gunicorn threads).
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 100))
+IMPORT_BATCH_WINDOW = float(os.environ.get('IMPORT_BATCH_WINDOW', 5))
+# Stays below the Pub/Sub ack deadline so an unanswered message is redelivered, not lost
+IMPORT_SUBMIT_TIMEOUT = float(os.environ.get('IMPORT_SUBMIT_TIMEOUT', 60))
+
+# Where to report import outcomes (the app's /internal/index_status endpoint) and the shared
+# secret it requires; the app refuses reports without it
+STATUS_CALLBACK_URL = os.environ.get('STATUS_CALLBACK_URL')
+STATUS_CALLBACK_TOKEN = os.environ.get('STATUS_CALLBACK_TOKEN')
+if STATUS_CALLBACK_URL and not STATUS_CALLBACK_TOKEN:
+    print('STATUS_CALLBACK_URL is set without STATUS_CALLBACK_TOKEN; status reports are disabled.')
+IMPORT_TIMEOUT = int(os.environ.get('IMPORT_TIMEOUT', 1800))
+# Bucket for per-URI status records shared with the app; in-memory only if unset
+INDEX_STATUS_BUCKET = os.environ.get('INDEX_STATUS_BUCKET')
+# Starting an import is retried on transient errors for up to IMPORT_RETRY_DEADLINE seconds
+# (exponential backoff with jitter); keep it below IMPORT_SUBMIT_TIMEOUT
+IMPORT_RETRY_DEADLINE = float(os.environ.get('IMPORT_RETRY_DEADLINE', 30))
+IMPORT_ATTEMPT_TIMEOUT = float(os.environ.get('IMPORT_ATTEMPT_TIMEOUT', 20))
+STATUS_REPORT_DEADLINE = float(os.environ.get('STATUS_REPORT_DEADLINE', 60))
+
+# A repeated INCREMENTAL import of the same URIs is harmless, so starting one is safe to retry
+import_retry = retries.Retry(
+    predicate=retries.if_exception_type(
+        exceptions.InternalServerError, exceptions.BadGateway, exceptions.ServiceUnavailable,
+        exceptions.GatewayTimeout, exceptions.DeadlineExceeded, exceptions.TooManyRequests,
+        exceptions.ResourceExhausted, requests.exceptions.ConnectionError, ConnectionError
+    ),
+    initial=0.5,
+    maximum=8.0,
+    multiplier=2.0,
+    timeout=IMPORT_RETRY_DEADLINE,
+    on_error=lambda e: print(f'Transient error starting import, retrying: {e}')
+)
+
+
+def is_retryable_report_error(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError))
+
+
+status_report_retry = retries.Retry(
+    predicate=is_retryable_report_error,
+    initial=1.0,
+    maximum=10.0,
+    timeout=STATUS_REPORT_DEADLINE,
+    on_error=lambda e: print(f'Error reporting status, retrying: {e}')
+)
+
+
+def report_status(results):
+    """POSTs per-URI import outcomes to the app so it can push them to waiting clients."""
+    for result in results:
+        metrics.DOCUMENTS.labels(result['status']).inc()
+    if not STATUS_CALLBACK_URL or not STATUS_CALLBACK_TOKEN:
+        return
+    body = json.dumps({'results': results}).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'X-Status-Token': STATUS_CALLBACK_TOKEN}
+
+    def post():
+        req = urllib.request.Request(STATUS_CALLBACK_URL, data=body, headers=headers, method='POST')
+        with urllib.request.urlopen(req, timeout=10) as response:
+            print(f'Reported status of {len(results)} document(s): HTTP {response.status}')
+
+    try:
+        with metrics.observe_upstream('app', 'status_callback'):
+            status_report_retry(post)()
+    except Exception as e:
+        print(f'Error reporting status to {STATUS_CALLBACK_URL}: {e}')
+
+
 @app.route('/', methods=['POST'])
 def index():
     envelope = request.get_json()
@@ -21,9 +148,10 @@ def index():
         return 'Bad Request: No data in message', 400
 
     try:
-        data = json.loads(base64.b64decode(message['data']).decode('utf-8'))
-        bucket = data.get('bucket')
-        name = data.get('name')
+        with tracing.span('decode'):
+            data = json.loads(base64.b64decode(message['data']).decode('utf-8'))
+            bucket = data.get('bucket')
+            name = data.get('name')
     except Exception as e:
         print(f'Error decoding message data: {e}')
         return 'Bad Request: Invalid message data', 400
@@ -32,53 +160,144 @@ def index():
         print(f'Missing bucket or name in GCS event data: {data}')
         return 'Bad Request: Missing GCS object details', 400
 
+    # Only PDFs are indexed; app-internal objects (e.g. the analysis cache) are acked and skipped
+    if not name.lower().endswith('.pdf'):
+        print(f'Skipping non-PDF object: gs://{bucket}/{name}')
+        return 'OK', 200
+
+    # Deduplicated uploads are empty alias objects; their content is already indexed under the target
+    alias_of = (data.get('metadata') or {}).get('alias_of')
+    if alias_of:
+        print(f'Skipping alias gs://{bucket}/{name} -> {alias_of}')
+        return 'OK', 200
+
     gcs_uri = f'gs://{bucket}/{name}'
     print(f'Processing file: {gcs_uri}')
 
-    project_id = os.environ.get('GCP_PROJECT_ID')
-    data_store_id = os.environ.get('DATA_STORE_ID')
-    location = os.environ.get('DATA_STORE_LOCATION', 'eu')
-
-    if not project_id or not data_store_id:
+    if not PROJECT_ID or not DATA_STORE_ID:
         print('Error: Missing GCP_PROJECT_ID or DATA_STORE_ID environment variables')
         return 'Internal Server Error: Configuration missing', 500
 
+    # The message is only acked (2xx) once its batch was accepted; failures are redelivered
     try:
-        # 1. Client-Optionen für die EU-Region (Zwingend erforderlich)
-        api_endpoint = f"{location}-discoveryengine.googleapis.com"
-        client_options = ClientOptions(api_endpoint=api_endpoint)
-        print(f"Using Regional API Endpoint: {api_endpoint}")
-
-        client = discoveryengine.DocumentServiceClient(
-            client_options=client_options,
-            transport="rest"  # REST ist in Cloud Run oft weniger anfällig für gRPC-Timeouts
-        )
-
-        # 2. Ressourcen-Pfad (Branch 0 ist korrekt für EU)
-        parent = f"projects/{project_id}/locations/{location}/collections/default_collection/dataStores/{data_store_id}/branches/0"
-
-        # 3. Konfiguration der GCS-Quelle (Der stabilste Weg für PDFs)
-        gcs_source = discoveryengine.GcsSource(
-            input_uris=[gcs_uri],
-            data_schema="content" # 'content' signalisiert unstrukturierte Daten (PDF)
-        )
-
-        request_body = discoveryengine.ImportDocumentsRequest(
-            parent=parent,
-            gcs_source=gcs_source,
-            reconciliation_mode=discoveryengine.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL
-        )
-
-        # 4. Operation starten
-        operation = client.import_documents(request=request_body)
-        print(f'Started document import operation: {operation.operation.name}')
-        
+        # The import itself runs on the batcher's thread and is traced as its own 'import_batch'
+        with tracing.span('batch_wait', gcs_uri=gcs_uri) as span:
+            operation = batcher.add(gcs_uri).result(timeout=IMPORT_SUBMIT_TIMEOUT)
+            span.set(operation=operation.operation.name)
     except Exception as e:
-        print(f'Error during Discovery Engine import: {e}')
+        print(f'Error during Discovery Engine import of {gcs_uri}: {e}')
         return f'Internal Server Error: {e}', 500
 
+    print(f'{gcs_uri} submitted with import operation {operation.operation.name}')
     return 'OK', 202
 
+
+@app.route('/status', methods=['GET'])
+def status():
+    """Returns the recorded import outcome of a GCS URI."""
+    gcs_uri = request.args.get('gcs_uri')
+    if not gcs_uri:
+        return {'error': "Missing 'gcs_uri' query parameter."}, 400
+    with metrics.observe_upstream('status_store', 'get'):
+        record = status_store.get(gcs_uri)
+    if record is None:
+        return {'gcs_uri': gcs_uri, 'status': 'UNKNOWN'}, 404
+    return record, 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Exposes request, import and upstream metrics in the Prometheus text format."""
+    body, content_type = metrics.exposition()
+    return Response(body, headers={'Content-Type': content_type})
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the Discovery Engine client, created once per process."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            # 1. Client-Optionen für die EU-Region (Zwingend erforderlich)
+            api_endpoint = f"{LOCATION}-discoveryengine.googleapis.com"
+            client_options = ClientOptions(api_endpoint=api_endpoint)
+            print(f"Using Regional API Endpoint: {api_endpoint}")
+
+            _client = discoveryengine.DocumentServiceClient(
+                client_options=client_options,
+                transport="rest"  # REST ist in Cloud Run oft weniger anfällig für gRPC-Timeouts
+            )
+        return _client
+
+
+def document_exists(gcs_uri):
+    """True if the data store holds the document imported from a GCS URI."""
+    name = (f"projects/{PROJECT_ID}/locations/{LOCATION}/collections/default_collection/dataStores/{DATA_STORE_ID}"
+            f"/branches/0/documents/{status_key(gcs_uri)}")
+    try:
+        with metrics.observe_upstream('datastore', 'get_document'):
+            get_client().get_document(name=name, timeout=30)
+        return True
+    except exceptions.NotFound:
+        return False
+
+
+def submit_import(gcs_uris):
+    """Starts one import operation for a batch of GCS URIs."""
+    client = get_client()
+
+    # 2. Ressourcen-Pfad (Branch 0 ist korrekt für EU)
+    parent = f"projects/{PROJECT_ID}/locations/{LOCATION}/collections/default_collection/dataStores/{DATA_STORE_ID}/branches/0"
+
+    # 3. Konfiguration der GCS-Quelle (Der stabilste Weg für PDFs)
+    gcs_source = discoveryengine.GcsSource(
+        input_uris=gcs_uris,
+        data_schema="content" # 'content' signalisiert unstrukturierte Daten (PDF)
+    )
+
+    request_body = discoveryengine.ImportDocumentsRequest(
+        parent=parent,
+        gcs_source=gcs_source,
+        reconciliation_mode=discoveryengine.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL
+    )
+
+    # 4. Operation starten
+    metrics.IMPORT_BATCH_SIZE.observe(len(gcs_uris))
+    root, token = tracer.start('import_batch', documents=len(gcs_uris))
+    try:
+        # Includes the retries of import_retry
+        with metrics.observe_upstream('datastore', 'import_documents'):
+            operation = client.import_documents(request=request_body, retry=import_retry, timeout=IMPORT_ATTEMPT_TIMEOUT)
+        root.set(operation=operation.operation.name)
+    except Exception as e:
+        root.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        tracer.finish(root, token)
+    print(f'Started document import operation for {len(gcs_uris)} file(s): {operation.operation.name}')
+
+    tracker.track(operation, gcs_uris)
+    return operation
+
+
+def create_status_store():
+    if INDEX_STATUS_BUCKET:
+        from google.cloud import storage
+        return GCSStatusStore(storage.Client(project=PROJECT_ID).bucket(INDEX_STATUS_BUCKET))
+    return MemoryStatusStore()
+
+
+# Outcomes are polled in the background; needs CPU outside of requests on Cloud Run (--no-cpu-throttling)
+status_store = create_status_store()
+tracker = OperationTracker(status_store, on_complete=report_status, timeout=IMPORT_TIMEOUT, verify=document_exists)
+metrics.OPERATIONS_PENDING.set_function(tracker.pending)
+
+
+batcher = ImportBatcher(submit_import, max_batch_size=IMPORT_BATCH_SIZE, max_wait=IMPORT_BATCH_WINDOW)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
-    app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=port)
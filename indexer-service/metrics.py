@@ -0,0 +1,48 @@
+import contextlib
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+import tracing
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+REQUESTS = Counter(
+    'indexer_http_requests_total', 'HTTP requests by route and status code.',
+    ['method', 'route', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'indexer_http_request_duration_seconds', 'Request duration (push requests include the batch wait).',
+    ['method', 'route'], buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge('indexer_http_requests_in_flight', 'Requests currently being handled.')
+UPSTREAM_LATENCY = Histogram(
+    'indexer_upstream_duration_seconds', 'Duration of upstream calls.',
+    ['upstream', 'operation', 'outcome'], buckets=LATENCY_BUCKETS
+)
+IMPORT_BATCH_SIZE = Histogram(
+    'indexer_import_batch_size', 'GCS URIs per import operation.',
+    buckets=(1, 2, 5, 10, 20, 50, 100)
+)
+DOCUMENTS = Counter('indexer_documents_total', 'Import outcomes per document.', ['status'])
+OPERATIONS_PENDING = Gauge('indexer_operations_pending', 'Import operations still being tracked.')
+
+
+def route_label(request):
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@contextlib.contextmanager
+def observe_upstream(upstream, operation):
+    started = time.monotonic()
+    outcome = 'error'
+    try:
+        with tracing.span(f'{upstream}.{operation}'):
+            yield
+        outcome = 'ok'
+    finally:
+        UPSTREAM_LATENCY.labels(upstream, operation, outcome).observe(time.monotonic() - started)
+
+
+def exposition():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,156 @@
+import heapq
+import itertools
+import threading
+import time
+
+from status_store import make_record
+
+
+class OperationTracker:
+    """Polls import operations in the background and records per-URI outcomes.
+
+    Each operation is re-checked with exponential backoff (initial_interval,
+    doubling up to max_interval) until it is done or `timeout` passes. The
+    outcome of every URI goes to `store`; terminal outcomes are also passed to
+    `on_complete` (a list of {"gcs_uri", "status", "details"} dicts).
+
+    Error samples are truncated, so when an operation reports more failures
+    than its samples name, the other URIs are checked with `verify(gcs_uri)`
+    (True if the document is in the data store) or recorded as UNKNOWN.
+    """
+
+    def __init__(self, store, on_complete=None, initial_interval=5.0, max_interval=60.0, timeout=1800.0, verify=None):
+        self.store = store
+        self.on_complete = on_complete
+        self.verify = verify
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def track(self, operation, gcs_uris):
+        now = time.monotonic()
+        entry = {
+            'operation': operation,
+            'gcs_uris': list(gcs_uris),
+            'interval': self.initial_interval,
+            'deadline': now + self.timeout,
+            'recorded': False,
+        }
+        with self._cond:
+            self._ensure_started()
+            # Due immediately: the PROCESSING records are written by the tracker thread,
+            # so the caller (and the Pub/Sub acks waiting on it) isn't held up by the store
+            heapq.heappush(self._queue, (now, next(self._counter), entry))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='operation-tracker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cond.wait(timeout=timeout)
+                _, _, entry = heapq.heappop(self._queue)
+
+            if not entry['recorded']:
+                self._record_processing(entry)
+                continue
+
+            try:
+                done = entry['operation'].done()
+            except Exception as e:
+                print(f"Error polling operation {entry['operation'].operation.name}: {e}")
+                done = False
+
+            if done:
+                try:
+                    self._complete(entry)
+                except Exception as e:
+                    print(f"Error recording outcome of {entry['operation'].operation.name}: {e}")
+            elif time.monotonic() >= entry['deadline']:
+                self._finish(entry, [
+                    make_record(uri, 'FAILED', operation=entry['operation'].operation.name,
+                                details='Import operation did not finish in time.')
+                    for uri in entry['gcs_uris']
+                ])
+            else:
+                entry['interval'] = min(entry['interval'] * 2, self.max_interval)
+                self._schedule(entry, entry['interval'])
+
+    def _schedule(self, entry, delay):
+        with self._cond:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._counter), entry))
+
+    def _record_processing(self, entry):
+        name = entry['operation'].operation.name
+        for uri in entry['gcs_uris']:
+            try:
+                self.store.put(uri, make_record(uri, 'PROCESSING', operation=name))
+            except Exception as e:
+                print(f'Error storing status of {uri}: {e}')
+        entry['recorded'] = True
+        self._schedule(entry, self.initial_interval)
+
+    def _complete(self, entry):
+        operation = entry['operation']
+        name = operation.operation.name
+        error = operation.exception()
+        if error is not None:
+            print(f'Import operation {name} failed: {error}')
+            records = [make_record(uri, 'FAILED', operation=name, details=str(error)) for uri in entry['gcs_uris']]
+        else:
+            samples = [sample.message for sample in operation.result().error_samples]
+            failure_count = getattr(operation.metadata, 'failure_count', 0) or 0
+            records = []
+            unattributed = []
+            for uri in entry['gcs_uris']:
+                # Error samples are per document but only name it in their message
+                uri_errors = [message for message in samples if uri in message]
+                if uri_errors:
+                    records.append(make_record(uri, 'FAILED', operation=name,
+                                               details=uri_errors[0], error_samples=uri_errors[:5]))
+                else:
+                    unattributed.append(uri)
+            if failure_count > len(records):
+                # Some failures aren't in the samples, so none of the other URIs can be assumed indexed
+                records.extend(self._verify(uri, name) for uri in unattributed)
+            else:
+                records.extend(make_record(uri, 'INDEXED', operation=name) for uri in unattributed)
+            print(f'Import operation {name} finished: {sum(r["status"] == "INDEXED" for r in records)}/{len(records)} indexed')
+        self._finish(entry, records)
+
+    def _verify(self, uri, name):
+        if self.verify is not None:
+            try:
+                if self.verify(uri):
+                    return make_record(uri, 'INDEXED', operation=name)
+                return make_record(uri, 'FAILED', operation=name,
+                                   details='Import reported failures and the document is not in the data store.')
+            except Exception as e:
+                print(f'Error checking {uri} in the data store: {e}')
+        return make_record(uri, 'UNKNOWN', operation=name,
+                           details='Import reported failures beyond its error samples; outcome not confirmed.')
+
+    def _finish(self, entry, records):
+        for record in records:
+            try:
+                self.store.put(record['gcs_uri'], record)
+            except Exception as e:
+                print(f"Error storing status of {record['gcs_uri']}: {e}")
+        if self.on_complete:
+            self.on_complete([
+                {'gcs_uri': r['gcs_uri'], 'status': r['status'], 'details': r.get('details')}
+                for r in records
+            ])
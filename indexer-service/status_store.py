@@ -0,0 +1,61 @@
+import hashlib
+import json
+import threading
+import time
+
+
+def status_key(gcs_uri):
+    """Key of a URI's record; same derivation as the data store's document ID."""
+    return hashlib.sha256(gcs_uri.encode('utf-8')).hexdigest()[:32]
+
+
+class MemoryStatusStore:
+    """Per-URI import status records held in this process."""
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, gcs_uri):
+        with self._lock:
+            record = self._records.get(gcs_uri)
+            return dict(record) if record else None
+
+    def put(self, gcs_uri, record):
+        with self._lock:
+            self._records[gcs_uri] = record
+
+
+class GCSStatusStore:
+    """Per-URI import status records as JSON objects in a bucket.
+
+    The app reads the same objects (<prefix><status_key>.json), so
+    /check_file_status can answer without asking the data store.
+    """
+
+    def __init__(self, bucket, prefix='.index-status/'):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _blob(self, gcs_uri):
+        return self.bucket.blob(f'{self.prefix}{status_key(gcs_uri)}.json')
+
+    def get(self, gcs_uri):
+        blob = self._blob(gcs_uri)
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_bytes())
+
+    def put(self, gcs_uri, record):
+        self._blob(gcs_uri).upload_from_string(json.dumps(record), content_type='application/json')
+
+
+def make_record(gcs_uri, status, operation=None, details=None, error_samples=None):
+    record = {'gcs_uri': gcs_uri, 'status': status, 'updated': time.time()}
+    if operation:
+        record['operation'] = operation
+    if details:
+        record['details'] = details
+    if error_samples:
+        record['error_samples'] = error_samples
+    return record
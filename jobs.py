@@ -0,0 +1,452 @@
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from google.api_core import exceptions
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {"high": 0, "normal": 5, "low": 9}
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+FINISHED = (SUCCEEDED, FAILED)
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler for failures that retrying won't fix."""
+
+
+def _new_job(kind, payload, priority, key, now):
+    return {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "payload": payload,
+        "priority": priority,
+        "key": key,
+        "status": QUEUED,
+        "attempts": 0,
+        "result": None,
+        "error": None,
+        "details": None,
+        "created": now,
+        "updated": now,
+        "run_after": now,
+        "lease_until": None,
+    }
+
+
+class MemoryJobStore:
+    """Jobs held in this process; for tests and single-worker deployments."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._ready = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, kind, payload, priority, key=None):
+        now = time.time()
+        with self._lock:
+            if key is not None:
+                for job in self._jobs.values():
+                    if job["key"] == key and job["status"] not in FINISHED:
+                        return dict(job), False
+            job = _new_job(kind, payload, priority, key, now)
+            self._jobs[job["id"]] = job
+            heapq.heappush(self._ready, (priority, next(self._counter), job["id"]))
+            return dict(job), True
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def claim(self, lease_seconds):
+        now = time.time()
+        with self._lock:
+            deferred = []
+            claimed = None
+            while self._ready:
+                entry = heapq.heappop(self._ready)
+                job = self._jobs.get(entry[2])
+                if job is None or job["status"] != QUEUED:
+                    continue
+                if job["run_after"] > now:
+                    deferred.append(entry)
+                    continue
+                job.update(status=RUNNING, attempts=job["attempts"] + 1, updated=now, lease_until=now + lease_seconds)
+                claimed = dict(job)
+                break
+            for entry in deferred:
+                heapq.heappush(self._ready, entry)
+            return claimed
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields, updated=time.time())
+            if job["status"] == QUEUED:
+                heapq.heappush(self._ready, (job["priority"], next(self._counter), job_id))
+
+    def prune(self, older_than):
+        with self._lock:
+            for job_id in [j["id"] for j in self._jobs.values() if j["status"] in FINISHED and j["updated"] < older_than]:
+                del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """Jobs in a SQLite file, shared by all gunicorn workers of an instance.
+
+    Claims run in an IMMEDIATE transaction, so a job is handed to exactly
+    one worker. A RUNNING job whose lease expired (its worker died) becomes
+    claimable again.
+    """
+
+    _COLUMNS = ("id", "kind", "payload", "priority", "key", "status", "attempts", "result",
+                "error", "details", "created", "updated", "run_after", "lease_until")
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT, payload TEXT, priority INTEGER, key TEXT, status TEXT, "
+                "attempts INTEGER, result TEXT, error TEXT, details TEXT, created REAL, updated REAL, "
+                "run_after REAL, lease_until REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, priority, created)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)")
+
+    def _connect(self):
+        # One connection per call: sqlite3 connections can't be shared across threads
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Connection(conn)
+
+    def _row_to_job(self, row):
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def add(self, kind, payload, priority, key=None):
+        job = _new_job(kind, payload, priority, key, time.time())
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if key is not None:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE key = ? AND status IN (?, ?) LIMIT 1", (key, QUEUED, RUNNING)
+                ).fetchone()
+                if row is not None:
+                    conn.execute("COMMIT")
+                    return self._row_to_job(row), False
+            values = dict(job, payload=json.dumps(payload))
+            conn.execute(
+                f"INSERT INTO jobs ({', '.join(self._COLUMNS)}) VALUES ({', '.join('?' * len(self._COLUMNS))})",
+                [values[column] for column in self._COLUMNS]
+            )
+            conn.execute("COMMIT")
+        return job, True
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def claim(self, lease_seconds):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_until < ?) "
+                "ORDER BY priority, created LIMIT 1",
+                (QUEUED, now, RUNNING, now)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ?, lease_until = ? WHERE id = ?",
+                (RUNNING, now, now + lease_seconds, row["id"])
+            )
+            conn.execute("COMMIT")
+        job = self._row_to_job(row)
+        job.update(status=RUNNING, attempts=job["attempts"] + 1, updated=now, lease_until=now + lease_seconds)
+        return job
+
+    def update(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        fields["updated"] = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", [*fields.values(), job_id])
+
+    def prune(self, older_than):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?", (*FINISHED, older_than))
+
+
+class GCSJobStore:
+    """Jobs as JSON objects in a GCS bucket, shared by all workers and instances.
+
+    Every change is a read-modify-write under a generation precondition, so of
+    two workers claiming the same job only one succeeds; the other gets
+    PreconditionFailed and moves on. Unfinished jobs also have an empty marker
+    under `queue/`, named so a listing returns them in claim order, which keeps
+    a claim to one small listing. Deduplication by `key` goes through one
+    object per key that names the job holding it.
+    """
+
+    def __init__(self, get_bucket, prefix=".jobs/", max_conflicts=5):
+        self.get_bucket = get_bucket
+        self.prefix = prefix
+        self.max_conflicts = max_conflicts
+
+    def _job_name(self, job_id):
+        return f"{self.prefix}items/{job_id}.json"
+
+    def _marker_name(self, job):
+        return f"{self.prefix}queue/{job['priority']}-{int(job['created'] * 1000):015d}-{job['id']}"
+
+    def _key_name(self, key):
+        return f"{self.prefix}keys/{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+
+    def _read(self, job_id):
+        """(job, generation), or (None, None) if there is no such job."""
+        bucket = self.get_bucket()
+        for _ in range(self.max_conflicts):
+            blob = bucket.get_blob(self._job_name(job_id))
+            if blob is None:
+                return None, None
+            try:
+                # Exactly the generation a following write is conditioned on
+                return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+            except (exceptions.NotFound, exceptions.PreconditionFailed):
+                continue
+        raise RuntimeError(f"Job {job_id} keeps changing while being read.")
+
+    def _write(self, job, generation):
+        """Writes a job if it is still at `generation` (0: doesn't exist yet); raises PreconditionFailed otherwise."""
+        self.get_bucket().blob(self._job_name(job["id"])).upload_from_string(
+            json.dumps(job), content_type="application/json", if_generation_match=generation
+        )
+
+    def _delete(self, name, generation=None):
+        try:
+            self.get_bucket().blob(name).delete(if_generation_match=generation)
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            pass
+
+    def add(self, kind, payload, priority, key=None):
+        job = _new_job(kind, payload, priority, key, time.time())
+        self._write(job, 0)
+        if key is not None:
+            existing = self._take_key(key, job["id"])
+            if existing is not None:
+                self._delete(self._job_name(job["id"]))
+                return existing, False
+        self.get_bucket().blob(self._marker_name(job)).upload_from_string(b"", content_type="text/plain")
+        return job, True
+
+    def _take_key(self, key, job_id):
+        """Points `key` at the new job; returns the job holding it instead if that is unfinished."""
+        bucket = self.get_bucket()
+        name = self._key_name(key)
+        for _ in range(self.max_conflicts):
+            current = bucket.get_blob(name)
+            if current is not None:
+                holder, _ = self._read(current.download_as_bytes().decode("utf-8"))
+                if holder is not None and holder["status"] not in FINISHED:
+                    return holder
+            try:
+                bucket.blob(name).upload_from_string(
+                    job_id, content_type="text/plain", if_generation_match=current.generation if current else 0
+                )
+                return None
+            except exceptions.PreconditionFailed:
+                # Another submission took the key meanwhile; look at its job
+                continue
+        raise RuntimeError(f"Job key {key!r} keeps changing.")
+
+    def get(self, job_id):
+        job, _ = self._read(job_id)
+        return job
+
+    def claim(self, lease_seconds):
+        now = time.time()
+        for marker in self.get_bucket().list_blobs(prefix=f"{self.prefix}queue/"):
+            job, generation = self._read(marker.name.rsplit("-", 1)[1])
+            if job is None or job["status"] in FINISHED:
+                # Left behind by a finished (or pruned) job whose marker couldn't be removed
+                self._delete(marker.name)
+                continue
+            if not (job["status"] == QUEUED and job["run_after"] <= now
+                    or job["status"] == RUNNING and job["lease_until"] < now):
+                continue
+            job.update(status=RUNNING, attempts=job["attempts"] + 1, updated=now, lease_until=now + lease_seconds)
+            try:
+                self._write(job, generation)
+            except exceptions.PreconditionFailed:
+                continue
+            return job
+        return None
+
+    def update(self, job_id, **fields):
+        for _ in range(self.max_conflicts):
+            job, generation = self._read(job_id)
+            if job is None:
+                return
+            job.update(fields, updated=time.time())
+            try:
+                self._write(job, generation)
+                break
+            except exceptions.PreconditionFailed:
+                continue
+        else:
+            raise RuntimeError(f"Job {job_id} keeps changing while being updated.")
+        if job["status"] in FINISHED:
+            self._delete(self._marker_name(job))
+
+    def prune(self, older_than):
+        bucket = self.get_bucket()
+        # An object's update time is its job's last change, so only older objects need reading
+        for blob in bucket.list_blobs(prefix=f"{self.prefix}items/"):
+            if blob.updated is None or blob.updated.timestamp() >= older_than:
+                continue
+            job, generation = self._read(blob.name[len(f"{self.prefix}items/"):-len(".json")])
+            if job is not None and job["status"] in FINISHED and job["updated"] < older_than:
+                self._delete(blob.name, generation)
+        for blob in bucket.list_blobs(prefix=f"{self.prefix}keys/"):
+            if blob.updated is not None and blob.updated.timestamp() < older_than:
+                self._delete(blob.name, blob.generation)
+
+
+class _Connection:
+    """Closes the sqlite3 connection on exit (sqlite3's own context manager doesn't)."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None and self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+        self.conn.close()
+        return False
+
+
+class JobQueue:
+    """Runs submitted jobs on a bounded pool of worker threads.
+
+    Jobs are claimed lowest `priority` first (then oldest). A handler that
+    raises is retried after `retry_delay * 2**(attempt-1)` seconds until
+    `max_attempts` is reached; PermanentJobError fails the job at once.
+    Submitting with a `key` that is already queued or running returns the
+    existing job instead of adding another.
+    """
+
+    def __init__(self, store, workers=2, max_attempts=3, retry_delay=10.0,
+                 lease_seconds=600, retention=3600, poll_interval=1.0):
+        self.store = store
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._last_prune = 0.0
+
+    def register(self, kind, handler):
+        """handler(payload) -> JSON-serializable result."""
+        self._handlers[kind] = handler
+
+    def submit(self, kind, payload, priority=PRIORITIES["normal"], key=None):
+        """Queues a job; returns (job, created)."""
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'.")
+        self._ensure_started()
+        job, created = self.store.add(kind, payload, priority, key)
+        if created:
+            with self._wakeup:
+                self._wakeup.notify()
+        return job, created
+
+    def get(self, job_id):
+        # Also starts the workers, so jobs left behind by another worker get picked up
+        self._ensure_started()
+        return self.store.get(job_id)
+
+    def _ensure_started(self):
+        # Lazily, so threads live in the gunicorn worker rather than the master
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"jobs-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            try:
+                self._maybe_prune()
+                job = self.store.claim(self.lease_seconds)
+            except Exception as e:
+                logger.error(f"jobs: could not claim a job: {e}")
+                job = None
+            if job is None:
+                # Jobs submitted by other processes only show up by polling
+                with self._wakeup:
+                    self._wakeup.wait(timeout=self.poll_interval)
+                continue
+            self._execute(job)
+
+    def _execute(self, job):
+        handler = self._handlers.get(job["kind"])
+        try:
+            if handler is None:
+                raise PermanentJobError(f"No handler registered for job kind '{job['kind']}'.")
+            result = handler(job["payload"])
+        except Exception as e:
+            # Exceptions may carry a short `error` plus longer `details` (like AnalysisUnavailable)
+            error, details = getattr(e, "error", str(e)), getattr(e, "details", None)
+            if isinstance(e, PermanentJobError) or job["attempts"] >= self.max_attempts:
+                logger.error(f"jobs: {job['kind']} job {job['id']} failed after {job['attempts']} attempt(s): {e}")
+                self.store.update(job["id"], status=FAILED, error=error, details=details, lease_until=None)
+            else:
+                delay = self.retry_delay * 2 ** (job["attempts"] - 1)
+                logger.warning(f"jobs: {job['kind']} job {job['id']} failed ({e}), retrying in {delay:.0f}s.")
+                self.store.update(job["id"], status=QUEUED, error=error, details=details,
+                                  run_after=time.time() + delay, lease_until=None)
+            return
+        self.store.update(job["id"], status=SUCCEEDED, result=result, error=None, details=None, lease_until=None)
+
+    def _maybe_prune(self):
+        now = time.time()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        self.store.prune(now - self.retention)
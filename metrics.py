@@ -0,0 +1,91 @@
+import contextlib
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, REGISTRY
+)
+
+import tracing
+
+# With several gunicorn workers, each one writes its samples to PROMETHEUS_MULTIPROC_DIR and
+# /metrics aggregates them (see gunicorn.conf.py); without it the metrics are per process.
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Model calls run for tens of seconds, storage and data store reads for milliseconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+REQUESTS = Counter(
+    "app_http_requests_total", "HTTP requests by route and status code.",
+    ["method", "route", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "app_http_request_duration_seconds",
+    "Time until the response was returned (for SSE: until the stream started).",
+    ["method", "route"], buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "app_http_requests_in_flight", "Requests currently being handled.", multiprocess_mode="livesum"
+)
+UPSTREAM_LATENCY = Histogram(
+    "app_upstream_duration_seconds", "Duration of single upstream calls (each retry and hedge counts).",
+    ["upstream", "operation", "outcome"], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "app_upstream_calls_in_flight", "Upstream calls currently running.",
+    ["upstream"], multiprocess_mode="livesum"
+)
+CACHE_LOOKUPS = Counter(
+    "app_cache_lookups_total", "Cache lookups by cache and result (hit / miss).",
+    ["cache", "result"]
+)
+UPLOADED_BYTES = Counter(
+    "app_uploaded_bytes_total", "Bytes of uploaded files, by upload path (app / chunked / direct).",
+    ["path"]
+)
+MODEL_TOKENS = Counter(
+    "app_model_tokens_total", "Tokens reported in the model's usage metadata.",
+    ["kind"]
+)
+
+
+def route_label(request):
+    """The matched URL rule, so path parameters don't explode the label set."""
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@contextlib.contextmanager
+def observe_upstream(upstream, operation):
+    """Times one upstream call, tracks it as in flight and traces it as a span of the request."""
+    UPSTREAM_IN_FLIGHT.labels(upstream).inc()
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        with tracing.span(f"{upstream}.{operation}"):
+            yield
+        outcome = "ok"
+    finally:
+        UPSTREAM_IN_FLIGHT.labels(upstream).dec()
+        UPSTREAM_LATENCY.labels(upstream, operation, outcome).observe(time.monotonic() - started)
+
+
+def record_token_usage(response):
+    """Counts the tokens of a (final) model response, if it carries usage metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    for kind, field in (("prompt", "prompt_token_count"), ("candidates", "candidates_token_count"),
+                        ("total", "total_token_count")):
+        count = getattr(usage, field, 0)
+        if count:
+            MODEL_TOKENS.labels(kind).inc(count)
+
+
+def exposition():
+    """Returns (body, content_type) of the current metrics."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
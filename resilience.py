@@ -0,0 +1,494 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a call is shed instead of being sent upstream."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for calls to one upstream.
+
+    Each success made while the limit was in use raises it by 1/limit
+    (about +1 per `limit` calls); an overload signal from upstream
+    (`is_overload(exc)`, e.g. 429) multiplies it by `backoff_ratio`, at
+    most once per `decrease_cooldown` so one burst of rejections counts
+    once. Callers beyond the limit wait up to `queue_timeout`; when more
+    than `max_queue` are already waiting, or the wait runs out, the call
+    is shed with Overloaded.
+    """
+
+    def __init__(self, name, initial_limit=8, min_limit=1, max_limit=64, backoff_ratio=0.5,
+                 queue_timeout=2.0, max_queue=32, decrease_cooldown=2.0, is_overload=None):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.decrease_cooldown = decrease_cooldown
+        self.is_overload = is_overload or (lambda exc: False)
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiting = 0
+        self._shed = 0
+        self._last_decrease = 0.0
+        # Smoothed call duration, used for Retry-After hints
+        self._latency = 1.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return max(self.min_limit, int(self._limit))
+
+    def retry_after(self):
+        """Seconds a shed client should wait: roughly one call duration per queued batch."""
+        with self._cond:
+            batches = (self._waiting + self._in_flight) / max(1, self.limit)
+            return max(1, min(60, math.ceil(self._latency * max(1.0, batches))))
+
+    def _overloaded(self, reason):
+        with self._cond:
+            self._shed += 1
+        return Overloaded(f"{self.name}: {reason}", retry_after=self.retry_after())
+
+    def _try_acquire(self):
+        # Caller holds self._cond
+        if self._in_flight < self.limit:
+            self._in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        """Blocks until a slot is free; raises Overloaded when the call is shed."""
+        with self._cond:
+            if self._try_acquire():
+                return
+            if self._waiting >= self.max_queue:
+                reason = "too many queued calls"
+            else:
+                self._waiting += 1
+                try:
+                    if self._cond.wait_for(self._try_acquire, timeout=self.queue_timeout):
+                        return
+                finally:
+                    self._waiting -= 1
+                reason = "no capacity within the queue timeout"
+        raise self._overloaded(reason)
+
+    async def acquire_async(self, poll_interval=0.05):
+        """Like acquire, but waits without blocking the event loop."""
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            if self._try_acquire():
+                return
+            queue_full = self._waiting >= self.max_queue
+            if not queue_full:
+                self._waiting += 1
+        if queue_full:
+            raise self._overloaded("too many queued calls")
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(poll_interval)
+                with self._cond:
+                    if self._try_acquire():
+                        return
+        finally:
+            with self._cond:
+                self._waiting -= 1
+        raise self._overloaded("no capacity within the queue timeout")
+
+    def release(self, started, error=None):
+        """Frees a slot and adapts the limit to the call's outcome."""
+        duration = time.monotonic() - started
+        with self._cond:
+            saturated = self._in_flight >= self.limit
+            self._in_flight -= 1
+            if isinstance(error, Exception) and self.is_overload(error):
+                now = time.monotonic()
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+                    self._last_decrease = now
+            elif error is None:
+                self._latency = 0.8 * self._latency + 0.2 * duration
+                # Only grow while the limit is actually what's holding calls back
+                if saturated or self._waiting:
+                    self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+            self._cond.notify()
+
+    def _convert(self, error):
+        """Upstream overload surfaces as Overloaded, so callers shed it the same way."""
+        if isinstance(error, Exception) and self.is_overload(error):
+            return Overloaded(f"{self.name}: upstream overloaded ({error})", retry_after=self.retry_after())
+        return None
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        # BaseException: a closed generator or cancelled task must still free its slot
+        except BaseException as e:
+            self.release(started, e)
+            overloaded = self._convert(e)
+            if overloaded is not None:
+                raise overloaded from e
+            raise
+        self.release(started)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        await self.acquire_async()
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.release(started, e)
+            overloaded = self._convert(e)
+            if overloaded is not None:
+                raise overloaded from e
+            raise
+        self.release(started)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "name": self.name,
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "shed": self._shed,
+                "latency_seconds": round(self._latency, 3),
+            }
+
+
+class RetryBudget:
+    """Caps retries at a fraction of calls, so retries can't multiply an outage.
+
+    Every call deposits `ratio` tokens (up to `max_tokens`); every retry or
+    hedge spends one and is skipped when less than one is left.
+    """
+
+    def __init__(self, ratio=0.2, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    """Retries transient failures with capped exponential backoff and full jitter.
+
+    `call(fn)` invokes fn(timeout), where timeout is the time left until the
+    call's deadline (None without one), so each attempt can pass it on as
+    its own RPC timeout. No retry is started that couldn't finish before
+    the deadline or that the budget doesn't allow.
+    """
+
+    def __init__(self, name, is_retryable, max_attempts=3, base_delay=0.2, max_delay=5.0,
+                 deadline=None, budget=None):
+        self.name = name
+        self.is_retryable = is_retryable
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.budget = budget
+
+    def _start(self, deadline):
+        deadline = deadline if deadline is not None else self.deadline
+        if self.budget is not None:
+            self.budget.deposit()
+        return time.monotonic() + deadline if deadline else None
+
+    def _backoff(self, attempt, error, deadline_at):
+        """Delay before the next attempt, or None if `error` should be raised."""
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            logger.warning(f"{self.name}: retry budget exhausted, not retrying: {error}")
+            return None
+        logger.warning(f"{self.name}: attempt {attempt} failed ({error}), retrying in {delay:.2f}s.")
+        return delay
+
+    @staticmethod
+    def _remaining(deadline_at):
+        return max(0.0, deadline_at - time.monotonic()) if deadline_at else None
+
+    def call(self, fn, deadline=None):
+        deadline_at = self._start(deadline)
+        attempt = 1
+        while True:
+            try:
+                return fn(self._remaining(deadline_at))
+            except Exception as e:
+                delay = self._backoff(attempt, e, deadline_at)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, fn, deadline=None):
+        """Like call, for a coroutine function fn(timeout)."""
+        deadline_at = self._start(deadline)
+        attempt = 1
+        while True:
+            try:
+                return await fn(self._remaining(deadline_at))
+            except Exception as e:
+                delay = self._backoff(attempt, e, deadline_at)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class LatencyTracker:
+    """Sliding window of call durations."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q):
+        """The q-quantile of the window, or None until there are enough samples."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        # Nearest-rank definition
+        return samples[max(0, math.ceil(q * len(samples)) - 1)]
+
+
+class Hedger:
+    """Sends a second copy of a slow idempotent read and takes whichever answers first.
+
+    The hedge goes out once the first attempt has taken longer than the
+    `quantile` of recent latencies (so about 1 - quantile of calls are
+    hedged), and only while the budget allows it. The losing attempt is
+    left to finish in the background.
+    """
+
+    def __init__(self, name, quantile=0.95, min_delay=0.05, max_workers=32, budget=None):
+        self.name = name
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.budget = budget
+        self.latency = LatencyTracker()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"hedge-{name}")
+
+    def _timed(self, fn):
+        started = time.monotonic()
+        result = fn()
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    def _submit(self, fn):
+        # Each attempt runs in the caller's context, so its trace spans nest under the caller's
+        return self._pool.submit(contextvars.copy_context().run, self._timed, fn)
+
+    def call(self, fn):
+        threshold = self.latency.percentile(self.quantile)
+        if threshold is None:
+            # Not enough history to know what "slow" is yet
+            return self._timed(fn)
+        if self.budget is not None:
+            self.budget.deposit()
+
+        first = self._submit(fn)
+        done, _ = wait([first], timeout=max(self.min_delay, threshold))
+        if done or (self.budget is not None and not self.budget.withdraw()):
+            return first.result()
+
+        logger.info(f"{self.name}: no answer after {threshold:.3f}s, sending hedged request.")
+        pending = {first, self._submit(fn)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name}: circuit open, failing fast")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing, and probes it for recovery.
+
+    Outcomes of the last `window` seconds are kept; a call fails if it
+    raises an error `is_failure` accepts or takes longer than
+    `slow_call_seconds`. Once at least `min_calls` were made and the share
+    of failures reaches `failure_rate`, the circuit opens: calls raise
+    CircuitOpen for `open_seconds`. Then it half-opens and lets
+    `half_open_probes` calls through; a successful probe closes it again,
+    a failed one re-opens it.
+    """
+
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, name, is_failure, failure_rate=0.5, min_calls=10, window=60.0,
+                 slow_call_seconds=None, open_seconds=30.0, half_open_probes=1):
+        self.name = name
+        self.is_failure = is_failure
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._state = self.CLOSED
+        self._outcomes = collections.deque()
+        self._opened_at = None
+        self._probes = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def _open(self, now, reason):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        logger.warning(f"{self.name}: circuit opened ({reason}).")
+
+    def _retry_after(self, now):
+        return max(1, math.ceil(self._opened_at + self.open_seconds - now))
+
+    def before_call(self):
+        """Admits a call; returns True if it is a half-open probe. Raises CircuitOpen otherwise."""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == self.OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    self._rejected += 1
+                    raise CircuitOpen(self.name, self._retry_after(now))
+                self._state = self.HALF_OPEN
+                self._probes = 0
+                logger.info(f"{self.name}: circuit half-open, probing.")
+            if self._state == self.HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self._rejected += 1
+                    raise CircuitOpen(self.name, 1)
+                self._probes += 1
+                return True
+            return False
+
+    def after_call(self, probe, failed):
+        """Records an outcome: failed is True/False, or None if the call was abandoned."""
+        now = time.monotonic()
+        with self._lock:
+            if probe:
+                self._probes -= 1
+                if failed:
+                    self._open(now, "probe failed")
+                elif failed is False and self._state == self.HALF_OPEN:
+                    self._state = self.CLOSED
+                    logger.info(f"{self.name}: circuit closed, upstream recovered.")
+                return
+            # Late outcomes of calls started before the circuit opened don't count
+            if failed is None or self._state != self.CLOSED:
+                return
+            self._outcomes.append((now, failed))
+            self._prune(now)
+            failures = sum(1 for _, outcome in self._outcomes if outcome)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                self._open(now, f"{failures}/{len(self._outcomes)} calls failed in {self.window:.0f}s")
+
+    def _failed(self, error, started):
+        if error is not None:
+            # A closed generator or cancelled task says nothing about the upstream
+            return self.is_failure(error) if isinstance(error, Exception) else None
+        return self.slow_call_seconds is not None and time.monotonic() - started > self.slow_call_seconds
+
+    @contextlib.contextmanager
+    def guard(self):
+        probe = self.before_call()
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.after_call(probe, self._failed(e, started))
+            raise
+        self.after_call(probe, self._failed(None, started))
+
+    @contextlib.asynccontextmanager
+    async def async_guard(self):
+        probe = self.before_call()
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.after_call(probe, self._failed(e, started))
+            raise
+        self.after_call(probe, self._failed(None, started))
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return self.HALF_OPEN
+            return self._state
+
+    def stats(self):
+        now = time.monotonic()
+        state = self.state
+        with self._lock:
+            self._prune(now)
+            failures = sum(1 for _, outcome in self._outcomes if outcome)
+            stats = {
+                "name": self.name,
+                "state": state,
+                "calls": len(self._outcomes),
+                "failure_rate": round(failures / len(self._outcomes), 4) if self._outcomes else 0.0,
+                "rejected": self._rejected,
+            }
+            if state == self.OPEN:
+                stats["retry_after"] = self._retry_after(now)
+            return stats
@@ -0,0 +1,342 @@
+import contextlib
+import hashlib
+import io
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from pypdf import PdfReader
+
+from vector_index import VectorIndex
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"\w+")
+# Frequent German and English function words; they carry no topic and bloat the postings
+STOPWORDS = frozenset("""
+aber als am an auch auf aus bei bin bis da dabei damit dann das dass dem den der des die dies diese dieser
+dieses doch dort du durch ein eine einem einen einer eines er es für hat hatte hier ich ihr im in ist ja
+kann kein man mehr mit muss nach nicht noch nur ob oder sein sich sie sind so über um und uns vom von vor
+war was wenn werden wie wir wird zu zum zur zwischen
+a an and are as at be by for from has have in is it its of on or that the this to was were will with
+""".split())
+
+
+def tokenize(text):
+    """Lower-cased word tokens without stopwords, single characters and bare numbers."""
+    return [t for t in _TOKEN.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS and not t.isdigit()]
+
+
+def extract_pages(pdf_bytes):
+    """Returns [(page number, text)] of a PDF's text layer (scanned pages come back empty, unreadable files without pages)."""
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        numbered = list(enumerate(reader.pages, start=1))
+    except Exception as e:
+        logger.warning(f"Could not read PDF: {e}")
+        return []
+    pages = []
+    for number, page in numbered:
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:
+            logger.warning(f"Could not extract text of page {number}: {e}")
+            text = ""
+        pages.append((number, " ".join(text.split())))
+    return pages
+
+
+def chunk_pages(pages, words=200, overlap=40):
+    """Splits page texts into overlapping windows of `words` words; each chunk keeps its first page."""
+    tagged = [(word, number) for number, text in pages for word in text.split()]
+    chunks = []
+    step = max(1, words - overlap)
+    for start in range(0, len(tagged), step):
+        window = tagged[start:start + words]
+        chunks.append({"page": window[0][1], "text": " ".join(word for word, _ in window)})
+        if start + words >= len(tagged):
+            break
+    return chunks
+
+
+# --- Embeddings ---
+class HashingEmbedder:
+    """Offline embeddings: signed feature hashing of word unigrams and bigrams.
+
+    No model and no network, so it works anywhere; it captures shared
+    vocabulary, not meaning. Use VertexEmbedder for semantic similarity.
+    """
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+                digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                vectors[row, digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return _normalize(vectors)
+
+
+class VertexEmbedder:
+    """Embeddings from a Vertex AI text embedding model (e.g. text-multilingual-embedding-002)."""
+
+    BATCH_SIZE = 100
+
+    def __init__(self, model_name):
+        self.name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts):
+        from vertexai.language_models import TextEmbeddingModel
+
+        with self._lock:
+            if self._model is None:
+                self._model = TextEmbeddingModel.from_pretrained(self.name)
+        vectors = []
+        for start in range(0, len(texts), self.BATCH_SIZE):
+            vectors.extend(e.values for e in self._model.get_embeddings(texts[start:start + self.BATCH_SIZE]))
+        return _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1))
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+# --- Index ---
+class LocalRetriever:
+    """BM25 and embedding retrieval over the chunks of PDFs.
+
+    Chunk texts and the inverted index (term -> chunk, term frequency) live
+    in one SQLite file, the chunk embeddings in a memory-mapped VectorIndex
+    next to it (chunks.vector is the row). All gunicorn workers of an
+    instance share both and see each other's additions. Results of the two
+    rankings are merged with reciprocal rank fusion.
+    """
+
+    RRF_K = 60
+
+    def __init__(self, path, embedder, chunk_words=200, chunk_overlap=40, k1=1.5, b=0.75, vector_dtype="float16"):
+        self.path = path
+        self.embedder = embedder
+        self.chunk_words = chunk_words
+        self.chunk_overlap = chunk_overlap
+        self.k1 = k1
+        self.b = b
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.vectors = VectorIndex(f"{os.path.splitext(path)[0]}-vectors", vector_dtype)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(chunks)")]
+            if "embedding" in columns:
+                # Embeddings used to be BLOBs in the chunks table; documents get re-indexed on demand
+                logger.warning(f"Dropping local index {path} of an earlier format.")
+                conn.execute("DROP TABLE chunks")
+                conn.execute("DROP TABLE postings")
+                conn.execute("DROP TABLE documents")
+            # executescript would commit, so the statements run one by one inside the transaction
+            for statement in (
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+                "CREATE TABLE IF NOT EXISTS documents (uri TEXT PRIMARY KEY, version TEXT, chunks INTEGER, indexed_at REAL)",
+                # AUTOINCREMENT: IDs of deleted chunks are never handed out again, so stale vector rows can't alias
+                "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY AUTOINCREMENT, uri TEXT, ordinal INTEGER, "
+                "page INTEGER, text TEXT, length INTEGER, vector INTEGER)",
+                "CREATE INDEX IF NOT EXISTS chunks_uri ON chunks (uri, ordinal)",
+                "CREATE TABLE IF NOT EXISTS postings (term TEXT, chunk_id INTEGER, tf INTEGER, "
+                "PRIMARY KEY (term, chunk_id)) WITHOUT ROWID",
+            ):
+                conn.execute(statement)
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('embedder', ?)", (embedder.name,))
+            built_with = conn.execute("SELECT value FROM meta WHERE key = 'embedder'").fetchone()[0]
+            # The two stores are written together; if one was lost (e.g. a wiped directory) start over
+            highest_row = conn.execute("SELECT MAX(vector) FROM chunks").fetchone()[0]
+            if highest_row is not None and highest_row >= len(self.vectors):
+                logger.warning(f"Vectors of local index {path} are missing, rebuilding.")
+                conn.execute("DELETE FROM postings")
+                conn.execute("DELETE FROM chunks")
+                conn.execute("DELETE FROM documents")
+                self.vectors.clear()
+            elif highest_row is None and len(self.vectors):
+                self.vectors.clear()
+            conn.execute("COMMIT")
+        if built_with != embedder.name:
+            raise ValueError(f"Index {path} was built with embedder '{built_with}', not '{embedder.name}'.")
+
+    def _connect(self):
+        # One connection per call: sqlite3 connections can't be shared across threads
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return contextlib.closing(conn)
+
+    def document_version(self, uri):
+        """The version an indexed document was added with, or None if it isn't indexed."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT version FROM documents WHERE uri = ?", (uri,)).fetchone()
+        return row[0] if row else None
+
+    def has_document(self, uri):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM documents WHERE uri = ?", (uri,)).fetchone() is not None
+
+    def add_document(self, uri, pdf_bytes, version=None):
+        """Extracts, chunks, embeds and indexes a PDF (replacing an earlier version); returns its chunk count."""
+        chunks = chunk_pages(extract_pages(pdf_bytes), self.chunk_words, self.chunk_overlap)
+        embeddings = self.embedder.embed([chunk["text"] for chunk in chunks]) if chunks else []
+        with self._connect() as conn:
+            # The SQLite write lock also serializes appends to the vector index across processes
+            conn.execute("BEGIN IMMEDIATE")
+            rows, replaced = [], []
+            try:
+                replaced = self._delete(conn, uri)
+                chunk_ids = []
+                for ordinal, chunk in enumerate(chunks):
+                    terms = tokenize(chunk["text"])
+                    chunk_id = conn.execute(
+                        "INSERT INTO chunks (uri, ordinal, page, text, length) VALUES (?, ?, ?, ?, ?)",
+                        (uri, ordinal, chunk["page"], chunk["text"], len(terms))
+                    ).lastrowid
+                    chunk_ids.append(chunk_id)
+                    counts = {}
+                    for term in terms:
+                        counts[term] = counts.get(term, 0) + 1
+                    conn.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                     [(term, chunk_id, tf) for term, tf in counts.items()])
+                rows = self.vectors.append(chunk_ids, embeddings)
+                conn.executemany("UPDATE chunks SET vector = ? WHERE id = ?", zip(rows, chunk_ids))
+                conn.execute("INSERT INTO documents VALUES (?, ?, ?, ?)", (uri, version, len(chunks), time.time()))
+                # Last before the commit, so the earlier version stays searchable as long as possible
+                self.vectors.delete([row for row, _ in replaced])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self.vectors.delete(rows)
+                self._restore(replaced)
+                raise
+        return len(chunks)
+
+    def remove_document(self, uri):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            stale = []
+            try:
+                stale = self._delete(conn, uri)
+                self.vectors.delete([row for row, _ in stale])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                self._restore(stale)
+                raise
+
+    def _delete(self, conn, uri):
+        """Deletes a document's rows and returns the (vector row, chunk ID) pairs that become stale with it.
+
+        The caller tombstones the rows before committing: the vector index only
+        takes writes under the SQLite write lock.
+        """
+        stale = conn.execute("SELECT vector, id FROM chunks WHERE uri = ? AND vector IS NOT NULL", (uri,)).fetchall()
+        conn.execute("DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE uri = ?)", (uri,))
+        conn.execute("DELETE FROM chunks WHERE uri = ?", (uri,))
+        conn.execute("DELETE FROM documents WHERE uri = ?", (uri,))
+        return stale
+
+    def _restore(self, stale):
+        """Undoes tombstones of a rolled-back delete; the rows' vectors were never overwritten."""
+        if stale:
+            self.vectors.restore(*zip(*stale))
+
+    def search(self, query, k=8, uri=None):
+        """Top-k chunks for a free-text query, optionally within one document."""
+        with self._connect() as conn:
+            lexical = self._bm25(conn, tokenize(query), uri, limit=k * 4)
+            rows = self._vector_rows(conn, uri)[1] if uri is not None else None
+            semantic, _ = self.vectors.search(self.embedder.embed([query])[0], k * 4, rows=rows)
+            return self._passages(conn, self._fuse(lexical, semantic)[:k])
+
+    def document_passages(self, uri, k=12):
+        """The k chunks that best represent a whole document, in reading order.
+
+        There is no user question when analyzing a document, so chunks are
+        ranked by closeness to the document's mean embedding and by BM25
+        against the document's most distinctive terms.
+        """
+        with self._connect() as conn:
+            ids, rows = self._vector_rows(conn, uri)
+            if len(ids) <= k:
+                return self._passages(conn, ids)
+            matrix = self.vectors.get(rows)
+            centroid = _normalize(matrix.mean(axis=0, keepdims=True))[0]
+            semantic = [ids[i] for i in np.argsort(-(matrix @ centroid))]
+            lexical = self._bm25(conn, self._key_terms(conn, uri), uri, limit=len(ids))
+            chosen = self._fuse(lexical, semantic)[:k]
+            passages = self._passages(conn, chosen)
+        return sorted(passages, key=lambda passage: passage["ordinal"])
+
+    def _key_terms(self, conn, uri, count=20):
+        """The document's terms with the highest tf-idf."""
+        total = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        rows = conn.execute(
+            "SELECT p.term, SUM(p.tf), (SELECT COUNT(*) FROM postings q WHERE q.term = p.term) "
+            "FROM postings p JOIN chunks c ON c.id = p.chunk_id WHERE c.uri = ? GROUP BY p.term",
+            (uri,)
+        ).fetchall()
+        ranked = sorted(rows, key=lambda row: -row[1] * math.log(1 + total / row[2]))
+        return [row[0] for row in ranked[:count]]
+
+    def _bm25(self, conn, terms, uri, limit):
+        terms = list(dict.fromkeys(terms))
+        if not terms:
+            return []
+        total, average_length = conn.execute("SELECT COUNT(*), AVG(length) FROM chunks").fetchone()
+        if not total:
+            return []
+        placeholders = ", ".join("?" * len(terms))
+        document_frequency = dict(conn.execute(
+            f"SELECT term, COUNT(*) FROM postings WHERE term IN ({placeholders}) GROUP BY term", terms
+        ).fetchall())
+        query = (f"SELECT p.term, p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c ON c.id = p.chunk_id "
+                 f"WHERE p.term IN ({placeholders})")
+        params = list(terms)
+        if uri is not None:
+            query += " AND c.uri = ?"
+            params.append(uri)
+        scores = {}
+        for term, chunk_id, tf, length in conn.execute(query, params):
+            df = document_frequency[term]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            norm = tf + self.k1 * (1 - self.b + self.b * length / (average_length or 1))
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+    def _vector_rows(self, conn, uri):
+        """Chunk IDs of a document and their rows in the vector index."""
+        rows = conn.execute("SELECT id, vector FROM chunks WHERE uri = ? ORDER BY ordinal", (uri,)).fetchall()
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def _fuse(self, *rankings):
+        scores = {}
+        for ranking in rankings:
+            for rank, chunk_id in enumerate(ranking):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (self.RRF_K + rank + 1)
+        return sorted(scores, key=scores.get, reverse=True)
+
+    def _passages(self, conn, chunk_ids):
+        if not chunk_ids:
+            return []
+        rows = conn.execute(
+            f"SELECT id, uri, ordinal, page, text FROM chunks WHERE id IN ({', '.join('?' * len(chunk_ids))})",
+            list(chunk_ids)
+        ).fetchall()
+        by_id = {row[0]: {"uri": row[1], "ordinal": row[2], "page": row[3], "text": row[4]} for row in rows}
+        return [by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in by_id]
@@ -0,0 +1,270 @@
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+
+class _Call:
+    """An in-flight execution that followers in the same process wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Streamed calls: the items so far, announced through `changed`
+        self.items = []
+        self.changed = threading.Condition()
+        self.followers = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into a single execution.
+
+    Within a process, followers block on the leader's call and receive its
+    result (or exception). Across gunicorn workers, leaders serialize on an
+    flock'ed file in `lock_dir`; a worker that had to wait re-checks `lookup`
+    (usually a shared cache) before running the call itself. `stream` does the
+    same for generators, handing every item to the followers as it arrives.
+    """
+
+    def __init__(self, lock_dir=None, poll_interval=0.2, wait_timeout=120):
+        self.lock_dir = lock_dir
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key, fn, lookup=None):
+        """Runs `fn` once per concurrent `key`. Returns (result, shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        shared = False
+        try:
+            call.result, shared = self._run_exclusive(key, fn, lookup)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, shared
+
+    def stream(self, key, fn, lookup=None):
+        """Iterates the generator `fn()` once per concurrent `key`. Returns (iterator, shared).
+
+        The items are kept while the call runs: a follower replays those it
+        missed, then gets the rest as the leader produces them. If the leader's
+        consumer goes away, the leader drains `fn()` for its followers. A leader
+        that waited on another worker's lock iterates `lookup()` instead, unless
+        that returns None. The iterator must be consumed right away.
+        """
+        with self._lock:
+            call = self._streams.get(key)
+            if call is not None:
+                call.followers += 1
+                return self._follow(call), True
+            call = self._streams[key] = _Call()
+        return self._lead(key, call, fn, lookup), False
+
+    def _lead(self, key, call, fn, lookup):
+        detached = False
+        try:
+            with self._exclusive(key) as waited:
+                items = lookup() if waited and lookup is not None else None
+                for item in (items if items is not None else fn()):
+                    with call.changed:
+                        call.items.append(item)
+                        call.changed.notify_all()
+                    if detached:
+                        continue
+                    try:
+                        yield item
+                    except GeneratorExit:
+                        with self._lock:
+                            if not call.followers:
+                                # Nobody else waits; unlisted first, so nobody joins a stream that stops here
+                                del self._streams[key]
+                                call.error = RuntimeError("The streamed call was abandoned.")
+                                raise
+                        detached = True
+        except Exception as e:
+            call.error = e
+            # A detached leader has nobody to raise to; its followers get the error
+            if not detached:
+                raise
+        finally:
+            with self._lock:
+                if self._streams.get(key) is call:
+                    del self._streams[key]
+            with call.changed:
+                call.done.set()
+                call.changed.notify_all()
+
+    def _follow(self, call):
+        seen = 0
+        try:
+            while True:
+                with call.changed:
+                    while seen == len(call.items) and not call.done.is_set():
+                        call.changed.wait()
+                    items, finished = call.items[seen:], call.done.is_set()
+                yield from items
+                seen += len(items)
+                if finished:
+                    break
+        finally:
+            with self._lock:
+                call.followers -= 1
+        if call.error is not None:
+            raise call.error
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls) + len(self._streams)
+
+    @contextlib.contextmanager
+    def _exclusive(self, key):
+        """Holds the cross-worker lock of `key`; yields True if another worker held it first."""
+        if not self.lock_dir:
+            yield False
+            return
+
+        # Lock files are never removed: unlinking a file another worker is
+        # about to lock would let two leaders run at once.
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest() + ".lock"
+        with open(os.path.join(self.lock_dir, name), "a") as lock_file:
+            waited = self._acquire(lock_file)
+            try:
+                yield waited
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run_exclusive(self, key, fn, lookup):
+        with self._exclusive(key) as waited:
+            if waited and lookup is not None:
+                value = lookup()
+                if value is not None:
+                    return value, True
+            return fn(), False
+
+    def _acquire(self, lock_file):
+        """Takes the file lock, returning True if another worker held it first."""
+        waited = False
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return waited
+            except BlockingIOError:
+                waited = True
+                if time.monotonic() >= deadline:
+                    # Give up on coalescing rather than failing the request
+                    return waited
+                time.sleep(self.poll_interval)
+
+
+class _Stream:
+    """Items of an async generator a flight-owned task drains, for any number of readers."""
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Condition()
+        self.task = None
+
+
+class AsyncSingleFlight:
+    """asyncio counterpart of SingleFlight, coalescing within one event loop.
+
+    The call runs in a task owned by the flight, which every caller (the first
+    one included) awaits shielded: a caller being cancelled or disconnecting
+    never cancels the call for the others, and the call still finishes if all
+    of them leave. `stream` does the same for async generators. There is no
+    cross-worker locking; callers check their shared cache first.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+
+    async def do(self, key, fn):
+        """Awaits `fn()` once per concurrent `key`. Returns (result, shared)."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = self._calls[key] = asyncio.get_running_loop().create_task(fn())
+            task.add_done_callback(lambda t: self._finished(key, t))
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark it retrieved so a call whose callers all left doesn't log a warning
+        if not task.cancelled():
+            task.exception()
+
+    def stream(self, key, fn):
+        """Iterates the async generator `fn()` once per concurrent `key`. Returns (async iterator, shared).
+
+        Every caller reads the items from the start, as the task produces them.
+        """
+        stream = self._streams.get(key)
+        shared = stream is not None
+        if not shared:
+            stream = self._streams[key] = _Stream()
+            # Referenced from the stream, so the task isn't garbage collected mid-run
+            stream.task = asyncio.get_running_loop().create_task(self._drain(key, stream, fn()))
+        return self._read(stream), shared
+
+    async def _drain(self, key, stream, items):
+        try:
+            async for item in items:
+                async with stream.changed:
+                    stream.items.append(item)
+                    stream.changed.notify_all()
+        except asyncio.CancelledError as e:
+            stream.error = e
+            raise
+        except Exception as e:
+            stream.error = e
+        finally:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+            async with stream.changed:
+                stream.done = True
+                stream.changed.notify_all()
+
+    async def _read(self, stream):
+        seen = 0
+        while True:
+            async with stream.changed:
+                await stream.changed.wait_for(lambda: seen < len(stream.items) or stream.done)
+                items, finished = stream.items[seen:], stream.done
+            for item in items:
+                yield item
+            seen += len(items)
+            if finished:
+                break
+        if stream.error is not None:
+            raise stream.error
+
+    def in_flight(self):
+        return len(self._calls) + len(self._streams)
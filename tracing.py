@@ -0,0 +1,211 @@
+import contextlib
+import contextvars
+import json
+import logging
+import queue
+import re
+import secrets
+import threading
+import time
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_METRIC_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class Span:
+    """One timed stage of a request, in OpenTelemetry's data model."""
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self, service):
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "service": service,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "attributes": self.attributes,
+            "status": "ERROR" if self.error else "OK",
+            **({"error": self.error} if self.error else {}),
+        }
+
+
+class _Trace:
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+
+class _NoopSpan:
+    """Stands in for a span outside of a traced request (background jobs, worker threads)."""
+
+    def set(self, **attributes):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Tracer:
+    """Collects the spans of a request and exports them when it finishes.
+
+    Spans go to a JSON-lines file and/or an OTLP/HTTP collector
+    (`otlp_endpoint`, e.g. http://localhost:4318/v1/traces) from a
+    background thread, so exporting never delays a response.
+    """
+
+    def __init__(self, service, file_path=None, otlp_endpoint=None, max_pending=1000):
+        self.service = service
+        self.file_path = file_path
+        self.otlp_endpoint = otlp_endpoint
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def exporting(self):
+        return bool(self.file_path or self.otlp_endpoint)
+
+    def start(self, name, traceparent=None, **attributes):
+        """Starts the root span of a request; continues the caller's trace if given a W3C traceparent."""
+        match = _TRACEPARENT.match(traceparent or "")
+        trace = _Trace(match.group(1) if match else secrets.token_hex(16))
+        root = Span(trace, name, parent_id=match.group(2) if match else None, attributes=attributes)
+        trace.add(root)
+        return root, _current_span.set(root)
+
+    def finish(self, root, token):
+        """Ends the request's root span and queues its spans for export."""
+        root.end()
+        _current_span.reset(token)
+        if self.exporting:
+            try:
+                self._queue.put_nowait(list(root.trace.spans))
+                self._ensure_started()
+            except queue.Full:
+                logger.warning("Trace export queue full, dropping trace.")
+
+    @staticmethod
+    def server_timing(root):
+        """Server-Timing header value: each stage's total duration (retries add up), then the total."""
+        durations = {}
+        with root.trace.lock:
+            spans = [span for span in root.trace.spans if span is not root and span.end_ns is not None]
+        for span in spans:
+            name = _METRIC_NAME.sub("_", span.name)
+            durations[name] = durations.get(name, 0.0) + span.duration_ms
+        entries = [f"{name};dur={duration:.1f}" for name, duration in durations.items()]
+        entries.append(f"total;dur={root.duration_ms:.1f}")
+        return ", ".join(entries)
+
+    def _ensure_started(self):
+        # Lazily, so the thread lives in the gunicorn worker rather than the master
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            if self.file_path:
+                try:
+                    with open(self.file_path, "a", encoding="utf-8") as f:
+                        f.write("".join(json.dumps(span.to_dict(self.service)) + "\n" for span in spans))
+                except OSError as e:
+                    logger.warning(f"Could not write spans to {self.file_path}: {e}")
+            if self.otlp_endpoint:
+                try:
+                    self._post_otlp(spans)
+                except Exception as e:
+                    logger.warning(f"Could not export spans to {self.otlp_endpoint}: {e}")
+
+    def _post_otlp(self, spans):
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", self.service)]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [_otlp_span(span) for span in spans]}],
+        }]}
+        req = urllib.request.Request(
+            self.otlp_endpoint, data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(req, timeout=5):
+            pass
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Times a stage as a child of the current span; does nothing outside of a traced request."""
+    parent = _current_span.get()
+    if parent is None or parent.end_ns is not None:
+        yield _NOOP
+        return
+    child = Span(parent.trace, name, parent_id=parent.span_id, attributes=attributes)
+    parent.trace.add(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.end()
+        _current_span.reset(token)
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_span(span):
+    otlp = {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # SERVER for a request's root span, INTERNAL for its stages
+        "kind": 2 if span is span.trace.spans[0] else 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns or span.start_ns),
+        "attributes": [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        otlp["parentSpanId"] = span.parent_id
+    return otlp
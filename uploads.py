@@ -0,0 +1,123 @@
+import base64
+import hashlib
+import hmac
+import json
+import re
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# GCS requires every chunk except the last to be a multiple of 256 KiB
+CHUNK_GRANULARITY = 256 * 1024
+
+_CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+class UploadSessionError(Exception):
+    """Raised when GCS rejects a chunk or the session no longer exists."""
+
+    def __init__(self, status_code, details):
+        super().__init__(details)
+        self.status_code = status_code
+        self.details = details
+
+
+def _signature(payload, secret):
+    return base64.urlsafe_b64encode(hmac.new(secret.encode("utf-8"), payload, hashlib.sha256).digest())
+
+
+def encode_session_token(object_name, session_url, secret):
+    """Builds the opaque upload ID handed to the client.
+
+    Only the session's upload_id is kept, never the URL itself, so a client
+    can't make the server forward data to an arbitrary host. The payload is
+    signed with `secret` (HMAC-SHA256), so object name and session can't be forged.
+    """
+    upload_id = parse_qs(urlparse(session_url).query)["upload_id"][0]
+    payload = base64.urlsafe_b64encode(json.dumps({"n": object_name, "u": upload_id}).encode("utf-8"))
+    return (payload + b"." + _signature(payload, secret)).decode("ascii")
+
+
+def decode_session_token(token, secret):
+    """Returns (object_name, upload_id); raises ValueError for malformed or forged tokens."""
+    try:
+        payload, _, signature = token.encode("ascii").partition(b".")
+    except UnicodeEncodeError as e:
+        raise ValueError(f"Invalid upload ID: {e}")
+    if not signature or not hmac.compare_digest(signature, _signature(payload, secret)):
+        raise ValueError("Invalid upload ID: signature mismatch.")
+    try:
+        data = json.loads(base64.urlsafe_b64decode(payload))
+        return data["n"], data["u"]
+    except Exception as e:
+        raise ValueError(f"Invalid upload ID: {e}")
+
+
+def session_url(api_base, bucket_name, upload_id):
+    query = urlencode({"uploadType": "resumable", "upload_id": upload_id})
+    return f"{api_base.rstrip('/')}/upload/storage/v1/b/{bucket_name}/o?{query}"
+
+
+def parse_content_range(header):
+    """Parses 'bytes start-end/total' into ints; raises ValueError otherwise."""
+    match = _CONTENT_RANGE.match(header or "")
+    if not match:
+        raise ValueError("Content-Range must look like 'bytes <start>-<end>/<total>'.")
+    start, end, total = (int(group) for group in match.groups())
+    if start > end or end >= total:
+        raise ValueError("Content-Range is out of bounds.")
+    return start, end, total
+
+
+def _next_offset(response):
+    # 308 without a Range header means GCS has no bytes yet
+    committed = response.headers.get("Range")
+    return int(committed.split("-")[1]) + 1 if committed else 0
+
+
+class _ChunkBody:
+    """Read-only view of the next `length` bytes of a stream, with a known length.
+
+    requests can't size a plain stream (e.g. werkzeug's request.stream) and then
+    sends it with Transfer-Encoding: chunked, which GCS honours over
+    Content-Length and so misreads the unframed bytes. A sized body goes out
+    with Content-Length only.
+    """
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+        self._remaining = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size) if size else b""
+        self._remaining -= len(data)
+        return data
+
+
+def forward_chunk(http, url, stream, start, end, total):
+    """Streams one chunk into the GCS session.
+
+    Returns (complete, next_offset, object_resource). `stream` is read
+    directly by the HTTP client, so the chunk is never held in memory.
+    """
+    body = _ChunkBody(stream, end - start + 1)
+    response = http.put(url, data=body, headers={"Content-Range": f"bytes {start}-{end}/{total}"})
+    if response.status_code in (200, 201):
+        return True, total, response.json()
+    if response.status_code == 308:
+        return False, _next_offset(response), None
+    raise UploadSessionError(response.status_code, response.text)
+
+
+def query_offset(http, url):
+    """Asks GCS how much of the session has been persisted (for resuming)."""
+    response = http.put(url, data=b"", headers={"Content-Range": "bytes */*", "Content-Length": "0"})
+    if response.status_code in (200, 201):
+        return True, None
+    if response.status_code == 308:
+        return False, _next_offset(response)
+    raise UploadSessionError(response.status_code, response.text)
@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+DTYPES = ("float16", "int8")
+# Rows scored per matrix product, bounding the float32 copy a search makes
+BLOCK_ROWS = 65536
+
+
+class VectorIndex:
+    """Append-only, memory-mapped matrix of unit vectors with a row -> ID table.
+
+    A directory of flat files: meta.json (dim, dtype), vectors.bin (one row
+    per vector, float16 or int8), scales.bin (float32 per row, int8 only)
+    and ids.bin (int64 per row, -1 once deleted). Readers map the files, so
+    opening is O(1) and all processes on a host share one copy through the
+    page cache. A row counts once its ID is written, which happens last, so
+    readers never see half-written rows.
+
+    Appends, deletes and clears must be serialized by the caller
+    (LocalRetriever does all of them inside its SQLite write transactions).
+    Deleted rows stay in the files as tombstones until the index is rebuilt.
+    """
+
+    def __init__(self, directory, dtype="float16"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype '{dtype}', expected one of {', '.join(DTYPES)}.")
+        self.directory = directory
+        self.dtype = dtype
+        self.dim = None
+        os.makedirs(directory, exist_ok=True)
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._vectors_path = os.path.join(directory, "vectors.bin")
+        self._scales_path = os.path.join(directory, "scales.bin")
+        self._ids_path = os.path.join(directory, "ids.bin")
+        self._lock = threading.Lock()
+        self._mapped = (0, None, None, None)
+        self._load_meta()
+
+    def _load_meta(self):
+        # The dimension is fixed by the first append, possibly in another process
+        if self.dim is not None or not os.path.exists(self._meta_path):
+            return
+        with open(self._meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["dtype"] != self.dtype:
+            raise ValueError(f"Vector index {self.directory} stores {meta['dtype']}, not {self.dtype}.")
+        self.dim = meta["dim"]
+
+    def __len__(self):
+        return self._size()
+
+    def _size(self):
+        try:
+            return os.path.getsize(self._ids_path) // 8
+        except FileNotFoundError:
+            return 0
+
+    def _maps(self):
+        """(rows, vectors, scales, ids) mapped up to the current size; remapped only when the index grew."""
+        self._load_meta()
+        size = self._size()
+        with self._lock:
+            if self._mapped[0] != size:
+                if size == 0:
+                    self._mapped = (0, None, None, None)
+                else:
+                    vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode="r", shape=(size, self.dim))
+                    scales = np.memmap(self._scales_path, dtype=np.float32, mode="r", shape=(size,)) if self.dtype == "int8" else None
+                    ids = np.memmap(self._ids_path, dtype=np.int64, mode="r", shape=(size,))
+                    self._mapped = (size, vectors, scales, ids)
+            return self._mapped
+
+    def append(self, ids, vectors):
+        """Appends vectors (rows of a float matrix) under the given IDs; returns their row numbers."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return []
+        self._load_meta()
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self._meta_path, "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim, "dtype": self.dtype}, f)
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Vector index {self.directory} holds {self.dim}-dimensional vectors, got {vectors.shape[1]}.")
+
+        first = self._size()
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self._write(self._vectors_path, first * self.dim, np.round(vectors / scales[:, None]).astype(np.int8))
+            self._write(self._scales_path, first * 4, scales.astype(np.float32))
+        else:
+            self._write(self._vectors_path, first * self.dim * 2, vectors.astype(np.float16))
+        # Last: the rows become visible to readers with their IDs
+        self._write(self._ids_path, first * 8, np.asarray(ids, dtype=np.int64))
+        return list(range(first, first + len(vectors)))
+
+    def _write(self, path, offset, array):
+        # At the row offset rather than the end, so leftovers of an interrupted append get overwritten
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            f.seek(offset)
+            f.write(array.tobytes())
+            f.truncate()
+
+    def clear(self):
+        """Removes all vectors (and the dimension, which the next append sets again)."""
+        for path in (self._ids_path, self._scales_path, self._vectors_path, self._meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.dim = None
+        with self._lock:
+            self._mapped = (0, None, None, None)
+
+    def delete(self, rows):
+        """Tombstones rows; search and get skip them from then on."""
+        self._set_ids(rows, [-1] * len(rows))
+
+    def restore(self, rows, ids):
+        """Gives tombstoned rows their IDs back (undoing a delete that was rolled back)."""
+        self._set_ids(rows, ids)
+
+    def _set_ids(self, rows, ids):
+        if not len(rows):
+            return
+        with open(self._ids_path, "r+b") as f:
+            for row, id_ in zip(rows, ids):
+                f.seek(int(row) * 8)
+                f.write(np.int64(id_).tobytes())
+
+    def get(self, rows):
+        """float32 matrix of the given rows."""
+        _, vectors, scales, _ = self._maps()
+        rows = np.asarray(rows, dtype=np.int64)
+        if vectors is None or not len(rows):
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        matrix = np.asarray(vectors[rows], dtype=np.float32)
+        if scales is not None:
+            matrix *= scales[rows][:, None]
+        return matrix
+
+    def search(self, query, k, rows=None):
+        """Top-k (ids, cosine scores) for a unit query vector, over all live rows or the given ones."""
+        size, vectors, scales, ids = self._maps()
+        if vectors is None or k <= 0:
+            return [], []
+        query = np.asarray(query, dtype=np.float32)
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            scores = self.get(rows) @ query
+            candidate_ids = np.asarray(ids[rows])
+        else:
+            scores = np.empty(size, dtype=np.float32)
+            for start in range(0, size, BLOCK_ROWS):
+                block = slice(start, min(start + BLOCK_ROWS, size))
+                scores[block] = np.asarray(vectors[block], dtype=np.float32) @ query
+            if scales is not None:
+                scores *= scales
+            candidate_ids = np.asarray(ids)
+        scores[candidate_ids < 0] = -np.inf
+        k = min(k, int((candidate_ids >= 0).sum()))
+        if k == 0:
+            return [], []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return candidate_ids[top].tolist(), scores[top].tolist()